@@ -0,0 +1,218 @@
+"""Benchmarks for BinaryCodec and CompactCodec
+
+Measures dumps and loads throughput, encoded bytes per operation and peak
+memory over a set of representative schemas.  Results can be saved as JSON
+and compared with a saved baseline:
+
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --compare baseline.json
+
+Comparisons exit with status 1 if any benchmark got slower by more than
+the threshold.
+"""
+
+import json
+import multiprocessing
+import optparse
+import platform
+import resource
+import sys
+import time
+
+import thriftit
+
+class Flat(thriftit.Struct):
+    id = thriftit.Field(thriftit.I64Type, 1, int, False)
+    count = thriftit.Field(thriftit.I32Type, 2, int, False)
+    score = thriftit.Field(thriftit.DoubleType, 3, float, False)
+    active = thriftit.Field(thriftit.BooleanType, 4, bool, False)
+    name = thriftit.Field(thriftit.UnicodeType, 5, unicode, False)
+
+class Tree(thriftit.Struct):
+    label = thriftit.Field(thriftit.ByteStringType, 1, str, False)
+    weight = thriftit.Field(thriftit.I32Type, 2, int, False)
+
+Tree.add_field('left', thriftit.Field(Tree, 3, lambda: None, True))
+Tree.add_field('right', thriftit.Field(Tree, 4, lambda: None, True))
+
+class Wide(thriftit.Struct):
+    pass
+
+for i in xrange(1, 101):
+    Wide.add_field('field%d' % (i, ), thriftit.Field(thriftit.I64Type if i % 2 else thriftit.ByteStringType, i, int if i % 2 else str, False))
+
+class Blob(thriftit.Struct):
+    data = thriftit.Field(thriftit.ByteStringType, 1, str, False)
+    text = thriftit.Field(thriftit.UnicodeType, 2, unicode, False)
+
+class Numbers(thriftit.Struct):
+    doubles = thriftit.Field(thriftit.ListType.subtype(thriftit.DoubleType), 1, list, False)
+    longs = thriftit.Field(thriftit.ListType.subtype(thriftit.I64Type), 2, list, False)
+    table = thriftit.Field(thriftit.MapType.subtype(thriftit.I32Type, thriftit.DoubleType), 3, dict, False)
+
+class Cons(thriftit.Struct):
+    head = thriftit.Field(thriftit.I32Type, 1, int, False)
+
+Cons.add_field('tail', thriftit.Field(Cons, 2, lambda: None, True))
+
+def _tree(depth):
+    if not depth:
+        return None
+    return Tree(label='node%d' % (depth, ), weight=depth, left=_tree(depth - 1), right=None)
+
+def _wide():
+    values = {}
+    for i in xrange(1, 101):
+        values['field%d' % (i, )] = i * 1000003 if i % 2 else 'value %d' % (i, )
+    return Wide(**values)
+
+def _cons(length):
+    cons = None
+    for i in xrange(length):
+        cons = Cons(head=i, tail=cons)
+    return cons
+
+# name -> (type, function making the value)
+CASES = [
+    ('flat', Flat, lambda: Flat(id=1 << 40, count=17, score=0.5, active=True, name=u'flat struct')),
+    ('nested', Tree, lambda: _tree(64)),
+    ('wide', Wide, _wide),
+    ('blob', Blob, lambda: Blob(data='\x00\xff' * (1 << 19), text=u'\xe9t\xe9 ' * (1 << 14))),
+    ('numbers', Numbers, lambda: Numbers(doubles=[i * 0.25 for i in xrange(100000)],
+                                         longs=range(-50000, 50000),
+                                         table=dict((i, i * 0.5) for i in xrange(10000)))),
+    ('cons', Cons, lambda: _cons(500)),
+]
+
+CODECS = [
+    ('binary', thriftit.BinaryCodec),
+    ('compact', thriftit.CompactCodec),
+]
+
+def _time(function, argument, min_time):
+    """Return the best time per call of function(argument) over several
+    runs of at least min_time seconds"""
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            function(argument)
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else 1 + int(min_time / max(elapsed, 1e-6))
+    best = elapsed / number
+    for run in xrange(2):
+        start = time.time()
+        for i in xrange(number):
+            function(argument)
+        best = min(best, (time.time() - start) / number)
+    return best
+
+def _max_rss():
+    """Peak resident memory of this process in kilobytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+def run_case(codec_name, case_name, operation, min_time=0.2):
+    """Run one benchmark in this process, returning its measurements"""
+    codec = dict(CODECS)[codec_name]()
+    for name, thrift_type, make in CASES:
+        if name == case_name:
+            break
+    else:
+        raise ValueError("unknown case %r" % (case_name, ))
+    value = make()
+    buf = codec.dumps(thrift_type, value)
+    if operation == 'dumps':
+        function, argument = lambda v: codec.dumps(thrift_type, v), value
+    elif operation == 'loads':
+        function, argument = lambda b: codec.loads(thrift_type, b), buf
+    else:
+        raise ValueError("unknown operation %r" % (operation, ))
+    rss = _max_rss()
+    seconds = _time(function, argument, min_time)
+    return {
+        'ops_per_sec': 1.0 / seconds,
+        'mb_per_sec': len(buf) / seconds / (1 << 20),
+        'bytes_per_op': len(buf),
+        'peak_memory_kb': _max_rss() - rss,
+    }
+
+def _run_in_child(queue, args):
+    queue.put(run_case(*args))
+
+def run(codecs=None, cases=None, min_time=0.2):
+    """Run the benchmarks, each in a fresh process so their peak memory
+    can be told apart, and return the results keyed by
+    codec/case/operation"""
+    results = {}
+    for codec_name, _ in CODECS:
+        if codecs and codec_name not in codecs:
+            continue
+        for case_name, _, _ in CASES:
+            if cases and case_name not in cases:
+                continue
+            for operation in ('dumps', 'loads'):
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=_run_in_child, args=(queue, (codec_name, case_name, operation, min_time)))
+                process.start()
+                result = queue.get()
+                process.join()
+                results['%s/%s/%s' % (codec_name, case_name, operation)] = result
+    return results
+
+def compare(baseline, results, threshold=0.1):
+    """Compare results with baseline results
+
+    Returns a list of (key, baseline ops/sec, ops/sec, change) for every
+    benchmark in both, and the list of those which are slower by more than
+    threshold (a fraction).
+    """
+    rows = []
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        before = baseline[key]['ops_per_sec']
+        after = results[key]['ops_per_sec']
+        row = (key, before, after, after / before - 1.0)
+        rows.append(row)
+        if row[3] < -threshold:
+            regressions.append(row)
+    return rows, regressions
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--output', help='save the results to a JSON file')
+    parser.add_option('--compare', metavar='BASELINE', help='compare with results saved by --output')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='slowdown (a fraction) which counts as a regression [%default]')
+    parser.add_option('--codec', action='append', help='only run this codec (binary or compact)')
+    parser.add_option('--case', action='append', help='only run this case')
+    parser.add_option('--min-time', type='float', default=0.2, help='seconds to time each benchmark for [%default]')
+    options, args = parser.parse_args(argv)
+    results = run(options.codec, options.case, options.min_time)
+    for key in sorted(results):
+        result = results[key]
+        print '%-28s %12.1f ops/s %9.2f MB/s %10d bytes/op %8d KB peak' % (
+            key, result['ops_per_sec'], result['mb_per_sec'], result['bytes_per_op'], result['peak_memory_kb'])
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        rows, regressions = compare(baseline, results, options.threshold)
+        print
+        for key, before, after, change in rows:
+            flag = '  REGRESSION' if (key, before, after, change) in regressions else ''
+            print '%-28s %12.1f -> %12.1f ops/s %+7.1f%%%s' % (key, before, after, change * 100, flag)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
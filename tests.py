@@ -1,6 +1,14 @@
+import json
+import mmap
+import os
+import shutil
+import socket
 import StringIO
+import tempfile
+import threading
 import unittest
 
+import benchmarks
 import thriftit
 
 class BasicTestCase(unittest.TestCase):
@@ -32,7 +40,478 @@ class Foo(thriftit.Struct):
     numbers = thriftit.Field(thriftit.ListType.subtype(thriftit.DoubleType), 10, list, False)
     friends = thriftit.Field(thriftit.SetType.subtype(thriftit.UnicodeType), 11, set, False)
     age_to_person = thriftit.Field(thriftit.MapType.subtype(thriftit.DoubleType, thriftit.UnicodeType), 12, dict, False)
+
+class FooSubset(thriftit.Struct):
+    msg = thriftit.Field(thriftit.UnicodeType, 2, unicode, False)
+    num = thriftit.Field(thriftit.DoubleType, 9, float, False)
+
+class Unrelated(thriftit.Struct):
+    other = thriftit.Field(thriftit.I32Type, 100, int, False)
+
+class Cons(thriftit.Struct):
+    head = thriftit.Field(thriftit.ByteStringType, 1, str, False)
+
+Cons.add_field('tail', thriftit.Field(Cons, 2, lambda: None, True))
+
+class Host(thriftit.FrozenStruct):
+    name = thriftit.Field(thriftit.ByteStringType, 1, str, False)
+    port = thriftit.Field(thriftit.I32Type, 2, int, False)
+    aliases = thriftit.Field(thriftit.ListType.subtype(thriftit.ByteStringType), 3, list, False)
+
+class Reading(thriftit.FrozenStruct):
+    values = thriftit.Field(thriftit.ListType.subtype(thriftit.I32Type), 1, list, False)
+
+class Cluster(thriftit.Struct):
+    hosts = thriftit.Field(thriftit.SetType.subtype(Host), 1, set, False)
+    primary = thriftit.Field(Host, 2, lambda: None, True)
+
+class Label(thriftit.Struct):
+    name = thriftit.Field(thriftit.UnicodeType, 1, unicode, False, intern=True)
+    tags = thriftit.Field(thriftit.MapType.subtype(thriftit.ByteStringType, thriftit.I32Type), 2, dict, False, intern=True)
+    text = thriftit.Field(thriftit.UnicodeType, 3, unicode, False)
+
+class Point(thriftit.CompactStruct):
+    __slots__ = ('next', )
+    x = thriftit.Field(thriftit.I32Type, 1, int, False)
+    y = thriftit.Field(thriftit.DoubleType, 2, float, False)
+    label = thriftit.Field(thriftit.UnicodeType, 3, unicode, False)
+
+Point.add_field('next', thriftit.Field(Point, 4, lambda: None, True))
+
+SCHEMA = {
+    'Node': {
+        'type': 'struct',
+        'fields': [
+            ['name', 'string'],
+            ['weight', 'i64', {'optional': True, 'tag': 5}],
+            ['children', 'list', {'value': 'Node'}],
+            ['attributes', 'map', {'key': 'string', 'value': 'i32'}],
+        ],
+    },
+}
+
+class Wide(thriftit.Struct):
+    pass
+
+for i in xrange(1, 41):
+    Wide.add_field('field%d' % (i, ), thriftit.Field(thriftit.I32Type, i * 3, int, False))
             
+class CompactStructTestCase(unittest.TestCase):
+    def test_slots(self):
+        point = Point(x=1, y=2.5)
+        self.assertFalse(hasattr(point, '__dict__'))
+        self.assertEquals(point.label, u'')
+        self.assertEquals(point, Point._make(1, 2.5, u'', None))
+        self.assertNotEquals(point, Point(x=2, y=2.5))
+        self.assertEquals(repr(point), 'Point(%r)' % ({'x': 1, 'y': 2.5, 'label': u'', 'next': None}, ))
+        self.assertRaises(ValueError, Point.add_field, 'z', thriftit.Field(thriftit.I32Type, 5, int, False))
+
+    def test_types_from_config(self):
+        for compact in [False, True]:
+            types = thriftit.types_from_config(SCHEMA, compact)
+            Node = types['Node']
+            self.assertEquals(issubclass(Node, thriftit.CompactStruct), compact)
+            self.assertEquals(Node.fields()['weight'].tag, 5)
+            node = Node(name=u'root', children=[Node(name=u'leaf', weight=3)], attributes={u'a': 1})
+            for codec in [thriftit.BinaryCodec(), thriftit.CompactCodec()]:
+                result = codec.loads(Node, codec.dumps(Node, node))
+                self.assertEquals(result.children[0].name, u'leaf')
+                self.assertEquals(result.children[0].weight, 3)
+                self.assertEquals(result.attributes, {u'a': 1})
+
+    def test_lazy_types(self):
+        config = dict(SCHEMA)
+        config['Tree'] = {'type': 'struct', 'fields': [['node', 'Node'], ['forest', 'list', {'value': 'Tree'}]]}
+        config['Other'] = {'type': 'struct', 'fields': [['x', 'i32']]}
+        types = thriftit.types_from_config(config, lazy=True)
+        self.assertEquals(types.materialized(), [])
+        self.assertTrue('Other' in types)
+        self.assertEquals(sorted(types), sorted(list(thriftit._default_types) + ['Node', 'Other', 'Tree']))
+        Tree = types['Tree']
+        self.assertEquals(sorted(types.materialized()), ['Node', 'Tree'])
+        self.assertTrue(types['Node'] is Tree.fields()['node'].type)
+        self.assertTrue(Tree.fields()['forest'].type.value_type is Tree)
+        Node = types['Node']
+        tree = Tree(node=Node(name=u'n'), forest=[Tree(node=Node())])
+        codec = thriftit.CompactCodec()
+        self.assertEquals(codec.loads(Tree, codec.dumps(Tree, tree)).node.name, u'n')
+        self.assertRaises(KeyError, types.__getitem__, 'Missing')
+        self.assertRaises(ValueError, thriftit.types_from_config, config, lazy=True, codecs=[codec])
+        self.assertRaises(ValueError, thriftit.types_from_json, json.dumps(config), lazy=True, cache_dir=tempfile.gettempdir())
+
+class RecordFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'records')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        codec = thriftit.CompactCodec()
+        with thriftit.RecordWriter(self.path, Cons, codec) as writer:
+            self.assertEquals(writer.append(Cons(head='first')), 0)
+        with thriftit.RecordWriter(self.path, Cons, codec) as writer:
+            writer.extend(Cons(head=str(i), tail=Cons(head='t')) for i in xrange(1, 100))
+            self.assertEquals(len(writer), 100)
+        with thriftit.RecordReader(self.path, Cons, codec) as reader:
+            self.assertEquals(len(reader), 100)
+            self.assertEquals(reader[0].head, 'first')
+            self.assertEquals(reader[-1].head, '99')
+            self.assertEquals([c.head for c in reader[10:15]], ['10', '11', '12', '13', '14'])
+            self.assertEquals(len(list(reader)), 100)
+            self.assertEquals(reader.lazy(50).tail.head, 't')
+            self.assertRaises(IndexError, reader.__getitem__, 100)
+        stream = open(self.path, 'rb')
+        self.assertEquals(len(list(codec.iter_load(Cons, stream, 'length-prefixed'))), 100)
+        stream.close()
+
+    def test_empty(self):
+        thriftit.RecordWriter(self.path, Cons, thriftit.BinaryCodec()).close()
+        reader = thriftit.RecordReader(self.path, Cons, thriftit.BinaryCodec())
+        self.assertEquals((len(reader), reader[:]), (0, []))
+
+class SchemaCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, types, codecs):
+        Node = types['Node']
+        node = Node(name=u'root', children=[Node(name=u'leaf', weight=3)], attributes={u'a': 1})
+        for codec in codecs:
+            result = codec.loads(Node, codec.dumps(Node, node))
+            self.assertEquals(result.children[0].weight, 3)
+            self.assertEquals(result.attributes, {u'a': 1})
+            self.assertTrue(Node in codec._plans['dump'])
+
+    def test_cache(self):
+        for compact in [False, True]:
+            codecs = [thriftit.BinaryCodec(), thriftit.CompactCodec()]
+            self.check(thriftit.types_from_config(SCHEMA, compact, self.directory, codecs), codecs)
+            files = sorted(os.listdir(self.directory))
+            codecs = [thriftit.BinaryCodec(), thriftit.CompactCodec()]
+            types = thriftit.types_from_json(json.dumps(SCHEMA, sort_keys=True), compact, self.directory, codecs)
+            self.assertEquals(issubclass(types['Node'], thriftit.CompactStruct), compact)
+            self.assertEquals(types['Node'].fields()['weight'].tag, 5)
+            self.check(types, codecs)
+            # Loaded from the cache:
+            self.assertEquals(sorted(os.listdir(self.directory)), files)
+            self.assertTrue(codecs[0]._plan_code is None)
+        changed = {'Node': {'type': 'struct', 'fields': [['name', 'string', {'default': u'x'}]]}}
+        types = thriftit.types_from_config(changed, False, self.directory)
+        self.assertEquals(len(os.listdir(self.directory)), len(files) + 1)
+        self.assertEquals(types['Node']().name, u'x')
+
+IDL = """
+include "shared.thrift"
+namespace py tutorial
+
+typedef i32 MyInteger
+const MyInteger LIMIT = 100
+const map<string, list<double>> RANGES = {"unit": [0, 1.5]}
+
+enum Operation {
+    ADD = 1,
+    SUBTRACT,
+    DIVIDE = 4 (deprecated = "no")
+}
+
+/* Operations on two numbers */
+struct Work {
+    1: i32 num1 = LIMIT,
+    2: required i32 num2,
+    3: Operation op = Operation.DIVIDE,
+    4: optional string comment, // left out when None
+    5: list<set<MyInteger>> groups
+}
+
+const Work DEFAULT_WORK = {"num2": 2, "comment": "default"}
+
+union Value { 1: i64 number; 2: shared.Point point }
+
+exception InvalidOperation {
+    1: Operation op
+    2: string why
+}
+
+service Calculator extends shared.Base {
+    i32 calculate(1: i32 logid, 2: Work w) throws (1: InvalidOperation ouch),
+    oneway void zip()
+}
+"""
+
+SHARED_IDL = """
+struct Point { 1: double x; 2: double y }
+service Base { void ping() }
+"""
+
+class IdlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'shared.thrift'), 'w') as f:
+            f.write(SHARED_IDL)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse(self):
+        types, constants = thriftit.parse_idl(IDL, compact=True, include_dirs=[self.directory])
+        Work = types['Work']
+        self.assertEquals((types['Operation'].ADD, types['Operation'].SUBTRACT, types['Operation'].DIVIDE), (1, 2, 4))
+        self.assertTrue(types['MyInteger'] is thriftit.I32Type)
+        self.assertTrue(issubclass(Work, thriftit.CompactStruct))
+        self.assertTrue(issubclass(types['InvalidOperation'], thriftit.Exception))
+        self.assertEquals(types['shared.Point'].fields()['y'].tag, 2)
+        work = Work()
+        self.assertEquals((work.num1, work.num2, work.op, work.comment, work.groups), (100, 0, 4, None, []))
+        self.assertEquals(Work.fields()['groups'].type.value_type.value_type, thriftit.I32Type)
+        self.assertEquals(constants['RANGES'], {u'unit': [0.0, 1.5]})
+        self.assertEquals(constants['DEFAULT_WORK'], Work(num2=2, comment=u'default'))
+        self.assertEquals(sorted(types['Calculator'].methods()), ['calculate', 'ping', 'zip'])
+        self.assertTrue(types['Calculator'].methods()['zip'].oneway)
+        self.assertTrue(types['Value'].fields()['point'].optional)
+        value = types['Value'](point=types['shared.Point'](x=1.0, y=2.0))
+        codec = thriftit.CompactCodec()
+        self.assertEquals(codec.loads(types['Value'], codec.dumps(types['Value'], value)), value)
+
+    def test_errors(self):
+        for idl, message in [
+                ('struct A {\n 1: B b\n}', '<idl>:2: unknown type B'),
+                ('struct A { i32 a }', '<idl>:1: field A.a has no id'),
+                ('struct A {\n 1: i32 a,\n 1: i32 b }', 'already defined'),
+                ('enum E { A = "x" }', 'expected an integer value'),
+                ('const i32 X = "x"', "'x' isn't a I32Type value"),
+                ('typedef A B\ntypedef B A', 'refers to itself'),
+                ('include "missing.thrift"', "can't find included"),
+                ('struct A {', 'unexpected end of file')]:
+            try:
+                thriftit.types_from_idl(idl)
+            except thriftit.ParseError, e:
+                self.assertTrue(message in str(e), (idl, str(e)))
+            else:
+                self.fail(idl)
+
+    def test_module(self):
+        types, constants = thriftit.parse_idl(IDL, compact=True, include_dirs=[self.directory])
+        source = thriftit.module_source(types, constants, origin='tutorial.thrift')
+        module = {'__name__': 'tutorial_thrift'}
+        exec compile(source, 'tutorial_thrift.py', 'exec') in module
+        Work = module['Work']
+        self.assertTrue(Work is module['types']['Work'] and Work is not types['Work'])
+        self.assertEquals(module['DEFAULT_WORK'].comment, u'default')
+        work = Work(num1=1, num2=2, op=module['Operation'].ADD, comment=u'c', groups=[set([1, 2]), set()])
+        self.assertEquals(repr(work), repr(types['Work'](num1=1, num2=2, op=1, comment=u'c', groups=[set([1, 2]), set()])))
+        for name, reference in [('binary_codec', thriftit.BinaryCodec()), ('compact_codec', thriftit.CompactCodec())]:
+            codec = module[name]
+            plans = dict(codec._plans['dump'])
+            self.assertTrue(Work in plans)
+            # Structs defined later don't make the codec drop its plans
+            class Later(thriftit.Struct):
+                a = thriftit.Field(thriftit.I32Type, 1, int, False)
+            buf = codec.dumps(Work, work)
+            self.assertEquals(buf, reference.dumps(types['Work'], types['Work'](**dict((n, getattr(work, n)) for n in Work.fields()))))
+            self.assertEquals(codec.loads(Work, buf), work)
+            self.assertTrue(codec._plans['dump'][Work] is plans[Work])
+            method = module['Calculator'].methods()['calculate']
+            self.assertTrue(method.args_type in codec._plans['load'])
+
+    def test_main(self):
+        path = os.path.join(self.directory, 'tutorial.thrift')
+        with open(path, 'w') as f:
+            f.write(IDL)
+        output = os.path.join(self.directory, 'tutorial_thrift.py')
+        self.assertEquals(thriftit.main([path, '-o', output]), 0)
+        with open(output) as f:
+            self.assertTrue('Generated by thriftit from tutorial.thrift' in f.read())
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_run_case(self):
+        for operation in ['dumps', 'loads']:
+            result = benchmarks.run_case('compact', 'cons', operation, min_time=0.001)
+            self.assertEquals(result['bytes_per_op'], len(thriftit.CompactCodec().dumps(benchmarks.Cons, benchmarks._cons(500))))
+            self.assertTrue(result['ops_per_sec'] > 0)
+
+    def test_compare(self):
+        baseline = {'a': {'ops_per_sec': 100.0}, 'b': {'ops_per_sec': 100.0}, 'c': {'ops_per_sec': 1.0}}
+        results = {'a': {'ops_per_sec': 95.0}, 'b': {'ops_per_sec': 50.0}, 'd': {'ops_per_sec': 1.0}}
+        rows, regressions = benchmarks.compare(baseline, results, 0.1)
+        self.assertEquals([row[0] for row in rows], ['a', 'b'])
+        self.assertEquals(regressions, [('b', 100.0, 50.0, -0.5)])
+
+class DivideError(thriftit.Exception):
+    message = thriftit.Field(thriftit.ByteStringType, 1, str, False)
+
+class Calculator(thriftit.Service):
+    add = thriftit.Method(thriftit.I32Type, {
+        'a': thriftit.Field(thriftit.I32Type, 1, int, False),
+        'b': thriftit.Field(thriftit.I32Type, 2, int, False)})
+    divide = thriftit.Method(thriftit.DoubleType, {
+        'a': thriftit.Field(thriftit.DoubleType, 1, float, False),
+        'b': thriftit.Field(thriftit.DoubleType, 2, float, False)},
+        exceptions={'error': thriftit.Field(DivideError, 1, lambda: None, True)})
+    wait = thriftit.Method(None, {})
+    notify = thriftit.Method(None, {'note': thriftit.Field(thriftit.ByteStringType, 1, str, False)}, oneway=True)
+
+class CalculatorHandler(object):
+    def __init__(self):
+        self.released = threading.Event()
+        self.notes = []
+
+    def add(self, a, b):
+        return a + b
+
+    def divide(self, a, b):
+        if b == 0:
+            raise DivideError(message='divide by zero')
+        return a / b
+
+    def wait(self):
+        self.released.wait(5)
+
+    def notify(self, note):
+        if note == 'fail':
+            raise ValueError(note)
+        self.notes.append(note)
+
+class ServerTestCase(unittest.TestCase):
+    def serve(self, address=('127.0.0.1', 0), **options):
+        self.handler = CalculatorHandler()
+        self.server = thriftit.Server(Calculator, self.handler, **options)
+        address = self.server.listen(address)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.close)
+        return address
+
+    def start(self, address=('127.0.0.1', 0), **options):
+        address = self.serve(address, **options)
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        self.addCleanup(sock.close)
+        self.sock = sock
+        return sock.makefile('rwb')
+
+    def call(self, stream, codec, name, seqid, framed=True, message_type=thriftit.MESSAGE_CALL, **args):
+        method = Calculator.methods()[name]
+        message = codec.dumps_message(name, message_type, seqid, method.args_type, method.args_type(**args))
+        if framed:
+            stream.write(thriftit._S_I.pack(len(message)))
+        stream.write(message)
+
+    def reply(self, stream, codec, framed=True):
+        if framed:
+            size, = thriftit._S_I.unpack(stream.read(4))
+            buf = stream.read(size)
+        else:
+            buf = self.sock.recv(4096)
+        (name, message_type, seqid), offset = codec.load_message_header(buf)
+        if message_type == thriftit.MESSAGE_EXCEPTION:
+            result_type = thriftit.ApplicationError
+        else:
+            result_type = Calculator.methods()[name].result_type
+        return name, seqid, codec.loads(result_type, buffer(buf, offset))
+
+    def test_message_header(self):
+        for codec in [thriftit.BinaryCodec(), thriftit.CompactCodec()]:
+            buf = codec.dumps_message('add', thriftit.MESSAGE_CALL, -5, thriftit.I32Type, 7)
+            header, offset = codec.load_message_header(buf)
+            self.assertEquals(header, ('add', thriftit.MESSAGE_CALL, -5))
+            self.assertEquals(codec.loads(thriftit.I32Type, buf[offset:]), 7)
+            self.assertRaises(thriftit.TruncatedError, codec.load_message_header, buf[:offset - 1])
+        # Old style binary headers:
+        self.assertEquals(thriftit.BinaryCodec().load_message_header('\0\0\0\x03add\x01\0\0\0\x09'), (('add', 1, 9), 12))
+
+    def test_calls(self):
+        codec = thriftit.BinaryCodec()
+        stream = self.start()
+        self.call(stream, codec, 'add', 1, a=2, b=3)
+        self.call(stream, codec, 'divide', 2, a=1.0, b=0.0)
+        self.call(stream, codec, 'notify', 3, note='hi')
+        message = codec.dumps_message('nope', thriftit.MESSAGE_CALL, 4, Cons, Cons(head='x'))
+        stream.write(thriftit._S_I.pack(len(message)) + message)
+        stream.flush()
+        replies = dict((seqid, (name, result)) for name, seqid, result in [self.reply(stream, codec) for i in xrange(3)])
+        self.assertEquals(replies[1][1].success, 5)
+        self.assertEquals(replies[2][1].error.message, 'divide by zero')
+        self.assertEquals(replies[4][1].type, thriftit.ApplicationError.UNKNOWN_METHOD)
+        self.assertEquals(self.handler.notes, ['hi'])
+
+    def test_oneway_errors(self):
+        # Failed oneway calls get no reply, so the first reply is add's
+        for framed in [True, False]:
+            codec = thriftit.BinaryCodec()
+            stream = self.start(framed=framed)
+            self.call(stream, codec, 'notify', 1, framed, thriftit.MESSAGE_ONEWAY, note='fail')
+            self.call(stream, codec, 'notify', 2, framed, note='fail')
+            message = codec.dumps_message('nope', thriftit.MESSAGE_ONEWAY, 3, Cons, Cons(head='x'))
+            stream.write(thriftit._S_I.pack(len(message)) + message if framed else message)
+            self.call(stream, codec, 'add', 4, framed, a=1, b=2)
+            stream.flush()
+            name, seqid, result = self.reply(stream, codec, framed)
+            self.assertEquals((name, seqid, result.success), ('add', 4, 3))
+
+    def test_pipelining(self):
+        # A call which blocks doesn't hold up the calls behind it
+        codec = thriftit.CompactCodec()
+        stream = self.start(codec=codec)
+        self.call(stream, codec, 'wait', 1)
+        self.call(stream, codec, 'add', 2, a=1, b=1)
+        stream.flush()
+        self.assertEquals(self.reply(stream, codec)[1], 2)
+        self.handler.released.set()
+        self.assertEquals(self.reply(stream, codec)[1], 1)
+
+    def test_unframed_unix(self):
+        path = os.path.join(tempfile.mkdtemp(), 'socket')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        codec = thriftit.BinaryCodec()
+        stream = self.start(path, framed=False, workers=0)
+        self.call(stream, codec, 'add', 7, framed=False, a=20, b=22)
+        stream.flush()
+        name, seqid, result = self.reply(stream, codec, framed=False)
+        self.assertEquals((name, seqid, result.success), ('add', 7, 42))
+
+    def test_client(self):
+        address = self.serve(codec=thriftit.CompactCodec())
+        client = thriftit.Client(Calculator, address, codec=thriftit.CompactCodec(), pool_size=2)
+        self.addCleanup(client.close)
+        self.assertEquals(client.add(2, b=3), 5)
+        self.assertRaises(DivideError, client.divide, 1.0, 0.0)
+        self.assertEquals(client.notify('hi'), None)
+        results = []
+        def add_many(start):
+            results.extend(client.add(i, 1) for i in xrange(start, start + 100))
+        threads = [threading.Thread(target=add_many, args=(i * 100, )) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(results), range(1, 401))
+        self.assertRaises(TypeError, client.add, 1, 2, 3)
+
+    def test_client_async(self):
+        address = self.serve()
+        client = thriftit.Client(Calculator, address, pool_size=1)
+        self.addCleanup(client.close)
+        waiting = client.call_async('wait')
+        self.assertRaises(thriftit.TimeoutError, waiting.result, 0.01)
+        finished = []
+        added = client.call_async('add', 1, 2)
+        added.add_done_callback(finished.append)
+        self.assertEquals(added.result(5), 3)
+        self.assertEquals(finished, [added])
+        self.assertFalse(waiting.done())
+        self.handler.released.set()
+        # Replies to calls which timed out are dropped
+        self.assertEquals(client.add(2, 2), 4)
+        self.server.close()
+        self.assertRaises((thriftit.Error, socket.error), client.call, 'wait')
+
 class CodecTestCase:
     def test_struct(self):
         codec = self.codec
@@ -83,6 +562,392 @@ class CodecTestCase:
         self._assert_round_trip(thriftit.UnicodeType, u'hi  how are you')
 
 
+    def test_recursive_struct(self):
+        cons = Cons(head='a', tail=Cons(head='b', tail=Cons(head='c')))
+        buf = self.codec.dumps(Cons, cons)
+        result = self.codec.loads(Cons, buf)
+        self.assertEquals(result.head, 'a')
+        self.assertEquals(result.tail.tail.head, 'c')
+        self.assertEquals(result.tail.tail.tail, None)
+
+    def test_wide_struct(self):
+        wide = Wide(**dict(('field%d' % (i, ), i * i) for i in xrange(1, 41)))
+        result = self.codec.loads(Wide, self.codec.dumps(Wide, wide))
+        for i in xrange(1, 41):
+            self.assertEquals(getattr(result, 'field%d' % (i, )), i * i)
+
+    def test_plans_are_cached(self):
+        codec = self.codec
+        load = codec._function(Foo, 'load')
+        self.assertTrue(codec._function(Foo, 'load') is load)
+
+    def test_compact_struct(self):
+        point = Point(x=3, y=-1.5, label=u'caf\xe9', next=Point(x=4))
+        result = self.codec.loads(Point, self.codec.dumps(Point, point))
+        self.assertEquals(result, point)
+        self.assertFalse(hasattr(result, '__dict__'))
+
+    def test_lazy(self):
+        codec = self.codec
+        f = Foo(msg=u'hi', bool_true=True, int_neg=-23, long_large=2**62, numbers=[1.5, 2.5], friends=set([u'Alice']), age_to_person={15.0: u'Alice'})
+        buf = codec.dumps(Foo, f)
+        view = codec.loads_lazy(Foo, buf)
+        self.assertEquals(view.int_neg, -23)
+        self.assertEquals(view.bool_true, True)
+        self.assertEquals(codec.dumps(Foo, view), buf)
+        self.assertEquals(view.numbers, [1.5, 2.5])
+        self.assertFalse('friends' in view._values)
+        view.long_large = 7
+        result = codec.loads(Foo, codec.dumps(Foo, view))
+        self.assertEquals(result.long_large, 7)
+        self.assertEquals(result.friends, set([u'Alice']))
+        self.assertEquals(result.age_to_person, {15.0: u'Alice'})
+        self.assertEquals(view.materialize().msg, u'hi')
+
+    def test_lazy_nested(self):
+        codec = self.codec
+        buf = codec.dumps(Cons, Cons(head='a', tail=Cons(head='b', tail=Cons(head='c'))))
+        view = codec.loads_lazy(Cons, buf)
+        self.assertTrue(isinstance(view.tail, thriftit.LazyStruct))
+        self.assertEquals(view.tail.tail.head, 'c')
+        view.tail.head = 'B'
+        result = codec.loads(Cons, codec.dumps(Cons, view))
+        self.assertEquals([result.head, result.tail.head, result.tail.tail.head], ['a', 'B', 'c'])
+        self.assertRaises(thriftit.Error, codec.loads_lazy, Cons, buf[:-1])
+
+    def test_unknown_fields(self):
+        codec = self.codec
+        f = Foo(msg=u'hi', bool_true=True, num=2.5, numbers=[1.5] * 20, friends=set([u'Alice']), age_to_person={15.0: u'Alice'})
+        result = codec.loads(FooSubset, codec.dumps(Foo, f))
+        self.assertEquals((result.msg, result.num), (u'hi', 2.5))
+        result = codec.loads(Unrelated, codec.dumps(Point, Point(x=1, next=Point(x=2, label=u'x'))))
+        self.assertEquals(result.other, 0)
+
+    def test_projection(self):
+        codec = self.codec
+        f = Foo(msg=u'hi', bool_true=True, num=2.5, numbers=[1.5], int_neg=-3)
+        result = codec.loads(Foo, codec.dumps(Foo, f), fields=['msg', 'bool_true'])
+        self.assertEquals((result.msg, result.bool_true), (u'hi', True))
+        self.assertEquals((result.num, result.numbers, result.int_neg), (0.0, [], 0))
+        self.assertRaises(ValueError, codec.loads, Foo, codec.dumps(Foo, f), ['nope'])
+
+    def test_long_list(self):
+        self._assert_round_trip(thriftit.ListType.subtype(thriftit.I64Type), range(-50, 50))
+        self._assert_round_trip(thriftit.ListType.subtype(thriftit.ByteStringType), ['x' * i for i in xrange(30)])
+
+    def test_load_from_buffers(self):
+        codec = self.codec
+        cons = Cons(head='abc', tail=Cons(head='d'))
+        buf = 'xx' + codec.dumps(Cons, cons) + codec.dumps(thriftit.I64Type, -7)
+        for view in [buf, bytearray(buf), memoryview(buf), buffer(buf)]:
+            result, offset = codec.load_from(Cons, view, 2)
+            self.assertEquals(result.tail.head, 'd')
+            self.assertEquals(codec.load_from(thriftit.I64Type, view, offset), (-7, len(buf)))
+
+    def test_load_consecutive(self):
+        codec = self.codec
+        stream = StringIO.StringIO(codec.dumps(Cons, Cons(head='a')) + codec.dumps(Cons, Cons(head='b')))
+        self.assertEquals(Cons.load(codec, stream).head, 'a')
+        self.assertEquals(Cons.load(codec, stream).head, 'b')
+        self.assertEquals(stream.read(1), '')
+
+    def test_load_pipe(self):
+        codec = self.codec
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(write_fd, 'w') as f:
+            f.write(codec.dumps(Cons, Cons(head='a' * 1000, tail=Cons(head='b'))) + codec.dumps(Cons, Cons(head='c')) + 'rest')
+        with os.fdopen(read_fd) as stream:
+            self.assertEquals(Cons.load(codec, stream).tail.head, 'b')
+            self.assertEquals(Cons.load(codec, stream).head, 'c')
+            self.assertEquals(stream.read(), 'rest')
+            self.assertRaises(thriftit.TruncatedError, Cons.load, codec, stream)
+
+    def test_truncated(self):
+        codec = self.codec
+        buf = codec.dumps(Cons, Cons(head='abc', tail=Cons(head='d')))
+        for i in xrange(len(buf)):
+            self.assertRaises(thriftit.Error, codec.loads, Cons, buf[:i])
+
+    def test_dumps_buffer(self):
+        codec = self.codec
+        buf = bytearray()
+        self.assertTrue(codec.dumps(Cons, Cons(head='a'), buf) is buf)
+        codec.dumps(thriftit.I32Type, 12345, buf)
+        self.assertEquals(str(buf), codec.dumps(Cons, Cons(head='a')) + codec.dumps(thriftit.I32Type, 12345))
+
+    def test_dump_into(self):
+        codec = self.codec
+        expected = codec.dumps(Cons, Cons(head='abc'))
+        for buf in [bytearray(64), mmap.mmap(-1, 64)]:
+            end = codec.dump_into(Cons, Cons(head='abc'), buf, 3)
+            self.assertEquals(end, 3 + len(expected))
+            self.assertEquals(buf[3:end], expected)
+            self.assertEquals(codec.load_from(Cons, buf, 3)[0].head, 'abc')
+        self.assertRaises(thriftit.Error, codec.dump_into, Cons, Cons(head='abc'), bytearray(4), 0)
+        # Every kind of value, frozen structs whose encodings are saved, and
+        # lazy views which are copied
+        host = Host(name='a', port=1, aliases=['b'])
+        for thrift_type, value in [(Foo, Foo(msg=u'hello', int_large=1 << 30, num=0.5, friends=set([u'a']), bool_true=True)),
+                                   (Cluster, Cluster(hosts=set([host]), primary=host)),
+                                   (Cons, codec.loads_lazy(Cons, codec.dumps(Cons, Cons(head='a', tail=Cons(head='b')))))]:
+            expected = codec.dumps(thrift_type, value)
+            buf = mmap.mmap(-1, len(expected) + 10)
+            buf[:] = 'x' * len(buf)
+            end = codec.dump_into(thrift_type, value, buf, 5)
+            self.assertEquals(buf[:], 'x' * 5 + expected + 'x' * 5)
+            self.assertEquals(end, 5 + len(expected))
+            self.assertRaises(thriftit.Error, codec.dump_into, thrift_type, value, mmap.mmap(-1, len(expected) - 1))
+
+    def test_arrays(self):
+        codec = self.codec
+        array_codec = type(codec)(arrays=True)
+        for elem_type, values in [(thriftit.DoubleType, [1.5, -2.25, 1e300]),
+                                  (thriftit.I64Type, [0, -1, 1 << 40, -(1 << 62)]),
+                                  (thriftit.I32Type, [5, -70000, 2 ** 31 - 1]),
+                                  (thriftit.I16Type, [-300, 32767]),
+                                  (thriftit.I8Type, [0, 200, 255])]:
+            list_type = thriftit.ListType.subtype(elem_type)
+            buf = codec.dumps(list_type, values)
+            result = array_codec.loads(list_type, buf)
+            self.assertEquals(list(result), values)
+            self.assertFalse(isinstance(result, list))
+            self.assertEquals(codec.dumps(list_type, result), buf)
+            self.assertEquals(list(array_codec.loads(list_type, codec.dumps(list_type, []))), [])
+            for i in xrange(1, len(buf)):
+                self.assertRaises(thriftit.Error, array_codec.loads, list_type, buf[:i])
+
+    def test_iter_load(self):
+        codec = self.codec
+        conses = [Cons(head='x' * i, tail=Cons(head=str(i))) for i in xrange(200)]
+        for framing in ['none', 'length-prefixed']:
+            stream = StringIO.StringIO()
+            self.assertEquals(codec.dump_many(Cons, conses, stream, framing, buffer_size=100), 200)
+            for chunk_size in [1, 7, 65536]:
+                stream.seek(0)
+                result = list(codec.iter_load(Cons, stream, framing, chunk_size=chunk_size))
+                self.assertEquals([(c.head, c.tail.head) for c in result], [(c.head, c.tail.head) for c in conses])
+            truncated = StringIO.StringIO(stream.getvalue()[:-1])
+            self.assertRaises(thriftit.TruncatedError, list, codec.iter_load(Cons, truncated, framing))
+            self.assertEquals(list(codec.iter_load(Cons, StringIO.StringIO(''), framing)), [])
+        self.assertRaises(ValueError, codec.dump_many, Cons, conses, StringIO.StringIO(), 'zip')
+
+    def test_many(self):
+        codec = self.codec
+        numbers = thriftit.ListType.subtype(thriftit.I32Type)
+        conses = [Cons(head=str(i), tail=Cons(head='t')) for i in xrange(50)]
+        foos = codec.dumps_many(Foo, [Foo(age_to_person={1.0: u'x'})] * 20)
+        with thriftit.CodecPool(codec, [numbers], processes=2, threshold=10, chunk_size=7) as pool:
+            for batch_pool in [None, pool]:
+                buffers = codec.dumps_many(Cons, conses, batch_pool)
+                self.assertEquals(buffers, [codec.dumps(Cons, cons) for cons in conses])
+                self.assertEquals([cons.head for cons in codec.loads_many(Cons, buffers, batch_pool)], [str(i) for i in xrange(50)])
+                lists = [range(i) for i in xrange(30)]
+                self.assertEquals(codec.loads_many(numbers, codec.dumps_many(numbers, lists, batch_pool), batch_pool), lists)
+                self.assertEquals(codec.loads_many(Foo, foos, batch_pool)[-1].age_to_person, {1.0: u'x'})
+            self.assertRaises(ValueError, type(codec)(arrays=True).dumps_many, Cons, conses, pool)
+
+    def test_stats(self):
+        self.assertRaises(thriftit.Error, self.codec.stats)
+        codec = type(self.codec)(instrument=True)
+        buf = codec.dumps(Cons, Cons(head='a', tail=Cons(head='b')))
+        codec.loads(Cons, buf)
+        codec.loads(Cons, buf, fields=['head'])
+        codec.dumps(thriftit.I32Type, 5)
+        stats = codec.stats()
+        self.assertEquals(stats['structs']['Cons']['encode']['count'], 2)
+        self.assertEquals(stats['structs']['Cons']['decode']['count'], 3)
+        self.assertEquals(stats['types'][thriftit.T_I32]['encode']['count'], 1)
+        self.assertTrue(stats['structs']['Cons']['encode']['bytes'] > len(buf))
+        codec.reset_stats()
+        self.assertEquals(codec.stats(), {'types': {}, 'structs': {}})
+
+    def test_frozen(self):
+        codec = self.codec
+        host = Host(name='a', port=1, aliases=['b'])
+        self.assertRaises(AttributeError, setattr, host, 'port', 2)
+        self.assertEquals(host, Host(name='a', port=1, aliases=['b']))
+        self.assertEquals(len(set([host, Host(name='a', port=1, aliases=['b']), host.replace(port=2)])), 2)
+        cluster = Cluster(hosts=set([host, host.replace(port=2)]), primary=host)
+        buf = codec.dumps(Cluster, cluster)
+        result = codec.loads(Cluster, buf)
+        self.assertEquals(result.hosts, cluster.hosts)
+        self.assertEquals(result.primary, host)
+        self.assertRaises(AttributeError, setattr, result.primary, 'port', 2)
+        # The saved encoding is used the second time:
+        self.assertTrue(codec._wire_format in host._FrozenStruct__encoded)
+        host._FrozenStruct__encoded[codec._wire_format] = codec.dumps(Host, host.replace(port=3))
+        self.assertEquals(codec.loads(Cluster, codec.dumps(Cluster, Cluster(primary=host))).primary.port, 3)
+        arrays = type(codec)(arrays=True)
+        reading = arrays.loads(Reading, arrays.dumps(Reading, Reading(values=[1, 2, 3])))
+        self.assertFalse(isinstance(reading.values, list))
+        self.assertEquals(len(set([reading, Reading(values=[1, 2, 3])])), 1)
+        self.assertEquals({reading: 1}[Reading(values=[1, 2, 3])], 1)
+
+    def test_patch(self):
+        codec = self.codec
+        foo = Foo(msg=u'hello', int_large=1, num=0.5, friends=set([u'a']))
+        buf = bytearray(codec.dumps(Foo, foo))
+        self.assertTrue(codec.patch(Foo, buf, {'num': 2.5}) is buf)
+        self.assertEquals(codec.loads(Foo, buf).num, 2.5)
+        patched = codec.patch(Foo, str(buf), {'msg': u'a longer message', 'int_large': 1 << 30, 'bool_true': True})
+        result = codec.loads(Foo, patched)
+        self.assertEquals((result.msg, result.int_large, result.bool_true, result.num, result.friends),
+                          (u'a longer message', 1 << 30, True, 2.5, set([u'a'])))
+        cons = codec.dumps(Cons, Cons(head='a', tail=Cons(head='b')))
+        self.assertEquals(codec.loads(Cons, codec.patch(Cons, cons, {'tail': None})).tail, None)
+        self.assertEquals(codec.loads(Cons, codec.patch(Cons, 'x' + cons, {'head': 'c'}, 1)[1:]).head, 'c')
+        for view in [memoryview(cons), buffer(cons)]:
+            self.assertEquals(codec.patch(Cons, view, {'head': 'c'}), codec.patch(Cons, cons, {'head': 'c'}))
+            self.assertEquals(codec.loads(Cons, codec.patch(Cons, view, {'head': 'long head'})).head, 'long head')
+        self.assertRaises(ValueError, codec.patch, Cons, cons, {'other': 1})
+
+    def test_load_into(self):
+        codec = self.codec
+        buf = codec.dumps(Cons, Cons(head='a', tail=Cons(head='b')))
+        cons = Cons(head='x', tail=Cons(head='y', tail=Cons(head='z')))
+        tail = cons.tail
+        self.assertEquals(codec.load_into(cons, buf), len(buf))
+        self.assertTrue(cons.tail is tail)
+        self.assertEquals((cons.head, cons.tail.head, cons.tail.tail), ('a', 'b', None))
+        point = Point(x=5, next=Point(x=6))
+        codec.load_into(point, codec.dumps(Point, Point(y=1.5, label=u'p')))
+        self.assertEquals(point, Point(y=1.5, label=u'p'))
+        self.assertRaises(TypeError, codec.load_into, Host(), buf)
+        self.assertRaises(thriftit.TruncatedError, codec.load_into, Cons(), buf[:-2])
+        pool = thriftit.StructPool(Cons, max_size=1)
+        first = pool.loads(codec, buf)
+        self.assertEquals(first.tail.head, 'b')
+        pool.put(first)
+        pool.put(Cons())
+        self.assertEquals(len(pool), 1)
+        self.assertTrue(pool.loads(codec, buf) is first)
+        self.assertRaises(TypeError, pool.put, Point())
+
+    def test_references(self):
+        codec = type(self.codec)(references=True)
+        # A chain of n shared subtrees encodes 2 ** n structs without references:
+        shared = Cons(head='leaf')
+        for i in xrange(40):
+            shared = Cons(head=str(i), tail=Cons(head='', tail=shared))
+        lists = thriftit.ListType.subtype(Cons)
+        buf = codec.dumps(lists, [shared, shared, Cons(head='other', tail=shared.tail)])
+        self.assertTrue(len(buf) < 2000)
+        first, second, other = codec.loads(lists, buf)
+        self.assertTrue(first is second)
+        self.assertTrue(other.tail is first.tail)
+        self.assertEquals(first.tail.tail.head, '38')
+        # Cycles:
+        loop = Cons(head='a', tail=Cons(head='b'))
+        loop.tail.tail = loop
+        result = codec.loads(Cons, codec.dumps(Cons, loop))
+        self.assertTrue(result.tail.tail is result)
+        self.assertEquals(result.tail.head, 'b')
+        point = Point(x=1)
+        point.next = point
+        result = codec.loads(Point, codec.dumps(Point, point))
+        self.assertTrue(result.next is result)
+        # Readers without references skip them:
+        self.assertEquals(self.codec.loads(Cons, codec.dumps(Cons, loop)).tail.tail.head, '')
+        self.assertRaises(thriftit.Error, codec.loads_lazy, Cons, buf)
+        stats_codec = type(self.codec)(references=True, instrument=True)
+        self.assertEquals(stats_codec.loads(Cons, stats_codec.dumps(Cons, loop)).tail.tail.tail.head, 'b')
+
+    def test_compressed(self):
+        records = [self.codec.dumps(Foo, Foo(msg=u'message from host%d' % (i % 7, ), int_large=i,
+                                             friends=set([u'alice', u'bob']), age_to_person={float(i % 3): u'carol'}))
+                   for i in xrange(200)]
+        dictionary = thriftit.train_dictionary(records[:100], size=1024)
+        self.assertTrue(0 < len(dictionary) <= 1024)
+        codec = thriftit.CompressedCodec(self.codec, dictionary)
+        plain = thriftit.CompressedCodec(self.codec)
+        sizes = [sum(len(c.compress(record)) for record in records[100:]) for c in (codec, plain)]
+        self.assertTrue(sizes[0] < sizes[1] < sum(len(record) for record in records[100:]) * 2)
+        foo = self.codec.loads(Foo, records[150])
+        self.assertEquals(codec.loads(Foo, codec.dumps(Foo, foo)).msg, foo.msg)
+        # Readers pick the dictionary from the frame header:
+        reader = thriftit.CompressedCodec(self.codec, dictionaries=[dictionary])
+        self.assertEquals(reader.decompress(codec.compress(records[0])), records[0])
+        self.assertEquals(reader.decompress(plain.compress(records[0])), records[0])
+        self.assertRaises(thriftit.Error, plain.decompress, codec.compress(records[0]))
+        stream = StringIO.StringIO()
+        self.assertEquals(codec.dump_many(Cons, [Cons(head='a'), Cons(head='b')], stream), 2)
+        stream.seek(0)
+        self.assertEquals([cons.head for cons in codec.iter_load(Cons, stream)], ['a', 'b'])
+
+    def test_columns(self):
+        codec = self.codec
+        foos = [Foo(msg=u'row %d' % (i, ), bool_true=i % 2 == 0, int_large=i, num=i * 0.5,
+                    friends=set([u'f%d' % (i, )]), age_to_person={1.0: u'p'}) for i in xrange(100)]
+        batch = codec.loads_columns(Foo, codec.dumps_columns(Foo, foos))
+        self.assertEquals(len(batch), 100)
+        self.assertEquals(list(batch.column('int_large')), range(100))
+        self.assertEquals(sum(batch.column('num')), sum(i * 0.5 for i in xrange(100)))
+        self.assertEquals(list(batch.column('bool_true'))[:3], [True, False, True])
+        self.assertEquals(batch.column('msg')[7], u'row 7')
+        self.assertEquals(batch.mask('msg'), None)
+        row = batch[-1]
+        self.assertEquals((row.msg, row.int_large, row.friends, row.age_to_person), (u'row 99', 99, set([u'f99']), {1.0: u'p'}))
+        self.assertEquals([foo.num for foo in batch][:2], [0.0, 0.5])
+        conses = [Cons(head='a', tail=Cons(head='b')), Cons(head='c')]
+        batch = codec.loads_columns(Cons, codec.dumps_columns(Cons, conses))
+        self.assertEquals(batch.mask('tail'), [True, False])
+        self.assertEquals(batch[0].tail.head, 'b')
+        self.assertEquals(batch[1].tail, None)
+        self.assertRaises(IndexError, batch.__getitem__, 2)
+        self.assertRaises(thriftit.TruncatedError, codec.loads_columns, Cons, codec.dumps_columns(Cons, conses)[:-1])
+
+    def test_decoder(self):
+        codec = self.codec
+        values = [Foo(msg=u'message %d' % (i, ), numbers=[0.5] * i, friends=set([u'a', u'b']),
+                      age_to_person={1.0: u'x', 2.0: u'y'}, bool_false=False) for i in xrange(20)]
+        values.append(Foo())
+        for framing in ['none', 'length-prefixed']:
+            stream = StringIO.StringIO()
+            codec.dump_many(Foo, values, stream, framing)
+            data = stream.getvalue()
+            for piece_size in [1, 7, 1000]:
+                decoder = codec.decoder(Foo, framing)
+                results = []
+                for i in xrange(0, len(data), piece_size):
+                    results.extend(decoder.feed(data[i:i + piece_size]))
+                    self.assertTrue(decoder.pending() < 1000)
+                decoder.close()
+                self.assertEquals([foo.msg for foo in results], [foo.msg for foo in values])
+                self.assertEquals(results[5].numbers, [0.5] * 5)
+        lists = thriftit.ListType.subtype(Cons)
+        data = codec.dumps(lists, [Cons(head='a', tail=Cons(head='b'))] * 3)
+        decoder = codec.decoder(lists)
+        self.assertEquals(decoder.feed(data[:-1]), [])
+        self.assertRaises(thriftit.TruncatedError, decoder.close)
+        self.assertEquals([cons.tail.head for cons in decoder.feed(data[-1:])[0]], ['b'] * 3)
+
+    def test_intern(self):
+        codec = self.codec
+        buf = codec.dumps(Label, Label(name=u'label', tags={'host': 1}, text=u'text'))
+        first, second = codec.loads(Label, buf), codec.loads(Label, buf)
+        self.assertTrue(first.name is second.name)
+        self.assertTrue(first.tags.keys()[0] is second.tags.keys()[0])
+        self.assertFalse(first.text is second.text)
+        self.assertEquals(codec.intern_table.stats(), {'hits': 2, 'misses': 2, 'hit_rate': 0.5, 'size': 2})
+        table = thriftit.InternTable(max_size=4, max_length=8)
+        codec = type(codec)(intern=table)
+        buf = codec.dumps(Foo, Foo(msg=u'message', friends=set([u'a', u'b'])))
+        first, second = codec.loads(Foo, buf), codec.loads(Foo, buf)
+        self.assertTrue(first.msg is second.msg)
+        self.assertEquals(len(table), 3)
+        for i in xrange(10):
+            table.intern(str(i))
+        self.assertTrue(len(table) <= 4)
+        long_string = 'long string'
+        self.assertTrue(table.intern(long_string) is long_string)
+        self.assertFalse((str, long_string) in table._recent)
+        # Byte and text strings with the same contents stay apart
+        codec = type(codec)(intern=True)
+        buf = codec.dumps(Label, Label(name=u'host', tags={'host': 1}, text=u'host'))
+        for i in xrange(2):
+            result = codec.loads(Label, buf)
+            self.assertEquals((type(result.name), type(result.tags.keys()[0])), (unicode, str))
+
     def _assert_round_trip(self, thrift_type, value):
         buf = self.codec.dumps(thrift_type, value)
         expected_value = self.codec.loads(thrift_type, buf)
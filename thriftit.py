@@ -2,19 +2,41 @@
 
 __author__ = "Brandon Bickford <bickfordb@gmail.com>"
 
+import asyncore
+import collections
+import errno
+import exceptions
+import fcntl
+import hashlib
+import heapq
+import itertools
+import keyword
+import marshal
+import mmap
+import multiprocessing
+import optparse
 import os
+import Queue
+import re
+import socket
+import struct
 import sys
+import threading
+import time
+import zlib
+from array import array
 from struct import pack, unpack
+from types import MemberDescriptorType
 
 try:
-    import cStringIO as StringIO
+    import json
 except ImportError:
-    import StringIO as StringIO
+    import simplejson as json
 
 try:
-    import json
+    import numpy
 except ImportError:
-    import simplejson as json
+    numpy = None
 
 # Type IDs
 T_BOOL   = 2 # Boolean 
@@ -66,407 +88,2321 @@ _type_to_symbol = {
 }
 
 VERSION_MASK = -65536
+VERSION_1 = -2147418112 # Version of strict binary message headers
 
-class Codec(object):
-    """Base codec class"""
-    def dump(self, thrift_type, object, stream):
-        """Encode an object to an output stream"""
-        return self._dump_handlers[thrift_type.type_id](thrift_type, object, stream)
-
-    def load(self, thrift_type, stream):
-        """Decode an object from an input stream"""
-        return self._load_handlers[thrift_type.type_id](thrift_type, stream)
-
-    def dumps(self, thrift_type, object):
-        """Encode an object and return a bytestring"""
-        out = StringIO.StringIO()
-        self.dump(thrift_type, object, out)
-        return out.getvalue()
-
-    def loads(self, thrift_type, buf):
-        """Decode a bytestring to an object"""
-        stream = StringIO.StringIO(buf)
-        return self.load(thrift_type, stream)
-
-    def __init__(self):
-        self._dump_handlers = {
-            T_BOOL   : self._dump_bool,
-            T_BYTE   : self._dump_byte,
-            T_I8    : self._dump_byte,
-            T_DOUBLE : self._dump_double,
-            T_I16    : self._dump_i16,
-            T_I32    : self._dump_i32,
-            T_I64    : self._dump_i64,
-            T_STRING : self._dump_string,
-            T_STRUCT : self._dump_struct,
-            T_MAP    : self._dump_map,
-            T_SET    : self._dump_set,
-            T_LIST   : self._dump_list,
-            T_UTF8   : self._dump_utf8,
-            T_UTF16  : self._dump_utf16
-        }
+# Message Types
+MESSAGE_CALL = 1
+MESSAGE_REPLY = 2
+MESSAGE_EXCEPTION = 3
+MESSAGE_ONEWAY = 4
 
-        self._load_handlers = {
-            T_BOOL   : self._load_bool,
-            T_BYTE   : self._load_byte,
-            T_I8    : self._load_byte,
-            T_DOUBLE : self._load_double,
-            T_I16    : self._load_i16,
-            T_I32    : self._load_i32,
-            T_I64    : self._load_i64,
-            T_STRING : self._load_string,
-            T_STRUCT : self._load_struct,
-            T_MAP    : self._load_map,
-            T_SET    : self._load_set,
-            T_LIST   : self._load_list,
-            T_UTF8   : self._load_utf8,
-            T_UTF16  : self._load_utf16
-        }
+COMPACT_PROTOCOL_ID = 0x82
+COMPACT_VERSION = 1
+COMPACT_VERSION_MASK = 0x1f
 
 class Error(Exception): 
     pass
 
-class BinaryCodec(Codec):
-    """Implement the binary codec"""
-    def _dump_struct(self, thrift_type, object, stream):
-        for name, field in thrift_type.fields().iteritems():
-            symbol = _type_to_symbol[field.type.type_id]
-            stream.write(pack('!BH', symbol, field.tag))
-            self.dump(field.type, getattr(object, name), stream)
-        stream.write(chr(SYM_STOP))
-
-    def _load_struct(self, thrift_type, stream):
-        name_fields = thrift_type.fields().iteritems()
-        tag_to_field = dict((field.tag, (name, field)) for name, field in name_fields)
-        vals = {}
-        while True:
-            if ord(stream.read(1)) == SYM_STOP:
-                break
-            tag, = unpack('!H', stream.read(2))
-            name, field = tag_to_field[tag]
-            vals[name] = self.load(field.type, stream)
-        return thrift_type(**vals)
-
-    def _load_map(self, thrift_type, stream):
-        key_type = thrift_type.key_type
-        value_type = thrift_type.value_type
-        key_type_id, val_type_id, size = unpack('!BBi', stream.read(6))
-        result = thrift_type()
-        for i in xrange(size): 
-            key = self.load(key_type, stream)
-            value = self.load(value_type, stream)
-            result[key] = value
-        return result
-
-    def _dump_map(self, thrift_type, object, stream):
-        key_type = thrift_type.key_type
-        value_type = thrift_type.value_type
-       
-        stream.write(pack('!BBi',
-            _type_to_symbol[key_type.type_id],
-            _type_to_symbol[value_type.type_id], len(object)))
-        for key, value in object.iteritems():
-            self.dump(key_type, key, stream)
-            self.dump(value_type, value, stream)
+class TruncatedError(Error):
+    """Raised when a buffer ends in the middle of an encoded value"""
 
-    def _dump_utf8(self, thrift_type, object, stream): 
-        self._dump_string(ByteStringType, object.encode('utf-8'), stream)
+class TimeoutError(Error):
+    """Raised when a call isn't answered in time"""
 
-    def _dump_utf16(self, thrift_type, object, stream): 
-        self._dump_string(ByteStringType, object.encode('utf-16'), stream)
+class ParseError(Error):
+    """Raised for malformed or inconsistent Thrift IDL"""
 
-    def _dump_bool(self, thrift_type, val, stream):
-        stream.write(chr(SYM_BOOL_TRUE if val else SYM_BOOL_FALSE))
+_MISSING = object()
 
-    def _dump_byte(self, thrift_type, val, stream):
-        stream.write(pack("!B", val))
+_identifier_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
-    def _dump_i16(self, thrift_type, val, stream):
-        stream.write(pack("!h", val))
+def _safe_name(name):
+    """Make a string usable as part of a Python identifier"""
+    return re.sub(r'[^A-Za-z0-9_]', '_', name)
 
-    def _dump_i32(self, thrift_type, val, stream):
-        stream.write(pack("!i", val))
+def _sorted_fields(thrift_type):
+    """Get the (name, field) pairs of a struct ordered by tag"""
+    return sorted(thrift_type.fields().iteritems(), key=lambda item: item[1].tag)
 
-    def _dump_i64(self, thrift_type, val, stream):
-        stream.write(pack("!q", val))
+class _Source(object):
+    """Accumulate the source of the functions generated for a codec plan"""
+    def __init__(self, codec):
+        self.codec = codec
+        self.lines = []
+        self.depth = 0
+        # Whether the strings being decoded are interned
+        self.intern = False
 
-    def _dump_double(self, thrift_type, val, stream):
-        stream.write(pack("!d", val))
+    def line(self, text):
+        self.lines.append('    ' * self.depth + text)
 
-    def _dump_string(self, thrift_type, val, stream):
-        stream.write(pack("!I", len(val)) + val)
+    def indent(self):
+        self.depth += 1
 
-    def _dump_seq(self, thrift_type, object, stream):
-        sym = _type_to_symbol[thrift_type.value_type.type_id]
-        stream.write(pack('!BI', sym, len(object)))
-        for value in object:
-            self.dump(thrift_type.value_type, value, stream)
+    def dedent(self):
+        self.depth -= 1
 
-    _dump_set = _dump_seq
-    _dump_list = _dump_seq
+    def local(self, prefix):
+        """Allocate a fresh local variable name"""
+        return self.codec._unique(prefix)
 
-    def _load_seq(self, thrift_type, stream):
-        etype, size = unpack('!BI', stream.read(5))
-        items = []
-        for i in xrange(size):
-            yield self.load(thrift_type.value_type, stream)
-
-    def _load_list(self, thrift_type, stream):
-        return list(self._load_seq(thrift_type, stream))
-
-    def _load_set(self, thrift_type, stream):
-        return set(self._load_seq(thrift_type, stream))
-
-    def _load_utf8(self, thrift_type, stream):
-        return self._load_string(thrift_type, stream).decode('utf-8')
-
-    def _load_utf16(self, thrift_type, stream):
-        return self._load_string(thrift_type, stream).decode('utf-16')
-
-    def _load_bool(self, thrift_type, stream):
-        """Load a byte string"""
-        return unpack('!B', stream.read(1))[0] != SYM_BOOL_FALSE 
-
-    def _load_byte(self, thrift_type, stream):
-        buf = stream.read(1)
-        if not buf:
-            raise Error("unexpected end of stream")
-        val, = unpack('!B', buf)
-        return val
-
-    def _load_i16(self, thrift_type, stream):
-        """Load a signed 16 bit integer"""
-        buf = stream.read(2)
-        if len(buf) != 2:
-            raise Error("unexpected end of stream")
-        val, = unpack('!h', buf)
-        return val
-
-    def _load_i32(self, thrift_type, stream):
-        """Load a signed 32 bit integer"""
-        buf = stream.read(4)
-        if len(buf) != 4:
-            raise Error("unexpected end of stream")
-        val, = unpack('!i', buf)
-        return val
-
-    def _load_i64(self, thrift_type, stream):
-        """Load a signed 64 bit integer"""
-        buf = stream.read(8)
-        if len(buf) != 8:
-            raise Error("unexpected end of stream")
-        val, = unpack('!q', buf)
-        return val
-
-    def _load_double(self, thrift_type, stream):
-        """Load a IEEE 754 double"""
-        buf = stream.read(8)
-        if len(buf) != 8:
-            raise Error("unexpected end of stream")
-        val, = unpack('!d', buf)
-        return val
-
-    def _load_string(self, thrift_type, stream):
-        """Load a byte string"""
-        num = self._load_i32(I32Type, stream)
-        assert num >= 0
-        if num > 0:
-            buf = stream.read(num)
-            if len(buf) != num:
-                raise Error("unexpected end of stream")
-        else:
-            buf = ''
-        return buf
-
-_by_tag = lambda (name, field): field.tag
+    def const(self, value, prefix):
+        """Bind value in the plan namespace and return its name"""
+        return self.codec._const(value, prefix)
 
-class CompactCodec(Codec):
-    """Thrift Compact Encoding"""
+    def struct(self, fmt):
+        """Get the name of a precompiled struct.Struct for fmt"""
+        return self.codec._struct(fmt)
 
-    def _dump_bool(self, thrift_type, val, stream):
-        stream.write(chr(SYM_BOOL_TRUE if val else SYM_BOOL_FALSE))
-
-    def _dump_struct(self, thrift_type, object, stream):
-        last_field_id = 0
-        
-        for name, field in sorted(thrift_type.fields().iteritems(), key=_by_tag):
-            # Boolean fields are written as part of the field into one byte:
-            if field.type.type_id == T_BOOL:
-                boolean_field = field
-                val = getattr(object, name)
-                the_type = SYM_BOOL_TRUE if val else SYM_BOOL_FALSE
-            else:  
-                the_type = field.type.type_id
-            delta = field.tag - last_field_id
-            if delta > 0 and delta <= 15:
-                stream.write(chr((delta << 4) | the_type))
-            else:
-                stream.write(pack('!BH', the_type, field.tag))
-            if field.type.type_id != T_BOOL:
-                self.dump(field.type, getattr(object, name), stream)
-            last_field_id = field.tag
-        stream.write(chr(SYM_STOP))
+    def attr(self, obj, name):
+        if _identifier_re.match(name):
+            return '%s.%s' % (obj, name)
+        return 'getattr(%s, %r)' % (obj, name)
 
-    def _dump_seq(self, thrift_type, object, stream):
-        """Dump a set or a list of values"""
-        sz = len(object)
-        elem_type = thrift_type.value_type.type_id
-        if sz <= 14:
-            stream.write(chr((sz << 4) | elem_type))
+def _read_varint(buf, pos, num):
+    """Finish reading an unsigned varint whose first byte was num
 
-        else:
-            stream.write(chr(0xF0 | elem_type))
-            self._dump_varint(sz, stream)
-        for value in object:
-            self.dump(thrift_type.value_type, value, stream)
+    Returns the number and the offset just past it.
+    """
+    num &= 0x7f
+    shift = 7
+    while True:
+        byte = ord(buf[pos])
+        pos += 1
+        num |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return num, pos
+        shift += 7
+
+def _framed(framing):
+    """Check a framing name, returning True for length prefixed records"""
+    if framing == 'length-prefixed':
+        return True
+    elif framing == 'none':
+        return False
+    raise ValueError("unknown framing: %r" % (framing, ))
+
+def _read_exactly(stream, size):
+    """Read size bytes from a stream, stopping early only at its end"""
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    chunks = [data]
+    size -= len(data)
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _readable(buf):
+    """Get a view of buf which indexes to characters and slices to bytestrings
+
+    A memoryview is copied, as Python 2's buffer() can't wrap one.
+    """
+    if isinstance(buf, bytearray):
+        return buffer(buf)
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return buf
+
+def _write_mmap(target, offset, data):
+    """Copy a bytearray into an mmap at offset.  mmap slices only take
+    strings, but write takes a buffer of the bytearray, so this doesn't
+    copy data first."""
+    position = target.tell()
+    target.seek(offset)
+    target.write(buffer(data))
+    target.seek(position)
 
-    _dump_list = _dump_seq
-    _dump_set = _dump_seq
+class Codec(object):
+    """Base codec class
 
-    def _dump_varint(self, num, stream):
+    The first time a codec sees a type it generates and compiles a
+    specialized encoder and decoder for it (and for every struct reachable
+    from it), so encoding and decoding run without per-field dispatch.
+    """
+    def dump(self, thrift_type, object, stream):
+        """Encode an object to an output stream"""
+        out = bytearray()
+        self._function(thrift_type, 'dump')(object, out)
+        stream.write(out)
+
+    def load(self, thrift_type, stream, chunk_size=65536):
+        """Decode an object from an input stream
+
+        Seekable streams are read in chunks of chunk_size bytes and left
+        positioned just after the object.  From other streams, such as
+        pipes and sockets, only the bytes of the object are read, so the
+        objects after it can be loaded in turn.
+        """
+        try:
+            start = stream.tell()
+        except (AttributeError, IOError):
+            start = None
+        data = bytearray()
+        stack = _scan_stack(thrift_type)
+        pos = 0
         while True:
-            if (num & ~0x7F) == 0:
-                stream.write(chr(num & 0xFF)) 
+            pos = self._scan(buffer(data), pos, stack)
+            if not stack:
                 break
+            need = self._scan_need(buffer(data), pos, stack)
+            if start is None:
+                chunk = _read_exactly(stream, need)
             else:
-                stream.write(chr((num & 0x7F) | 0x80))
-                num >>= 7
-
-    def _dump_map(self, thrift_type, object, stream):
-        size = len(object)
-        key_type = thrift_type.key_type
-        value_type = thrift_type.value_type
-        self._dump_varint(size, stream)
-        if size > 0:
-            key_type_id = _type_to_symbol[key_type.type_id]
-            value_type_id = _type_to_symbol[value_type.type_id]
-            kv_type_id = (key_type_id << 4) | value_type_id
-            stream.write(chr(kv_type_id))
-            for key, value in object.iteritems():
-                self.dump(key_type, key, stream)
-                self.dump(value_type, value, stream)
-        
-    def _dump_i16(self, thrift_type, object, stream):
-        self._dump_varint(int_to_zigzag(object), stream)
-
-    def _dump_i32(self, thrift_type, object, stream):
-        self._dump_varint(int_to_zigzag(object), stream)
-
-    def _dump_i64(self, thrift_type, object, stream):
-        self._dump_varint(long_to_zigzag(object), stream)
-
-    def _dump_double(self, thrift_type, val, stream):
-        stream.write(pack("!d", val))
-
-    def _dump_utf8(self, thrift_type, val, stream):
-        self._dump_string(thrift_type, val.encode('utf-8'), stream)
-
-    def _dump_utf16(self, thrift_type, val, stream):
-        self._dump_string(thrift_type, val.encode('utf-16'), stream)
-
-    def _dump_string(self, thrift_type, val, stream):
-        self._dump_varint(len(val), stream)
-        stream.write(val)
+                chunk = stream.read(max(need, chunk_size, len(data)))
+            if len(chunk) < need:
+                raise TruncatedError("unexpected end of stream")
+            data += chunk
+        value, end = self._run(self._function(thrift_type, 'load'), buffer(data), 0)
+        if start is not None:
+            stream.seek(start + end)
+        return value
+
+    def load_from(self, thrift_type, buf, offset=0, fields=None):
+        """Decode an object from a buffer starting at offset
+
+        buf may be a bytestring, bytearray, buffer, memoryview or mmap.
+        Returns the object and the offset just past its encoding.  Only a
+        memoryview is copied before decoding, since Python 2's buffer()
+        can't wrap one; pass a bytestring, bytearray, buffer or mmap to
+        decode without copying the payload.
+
+        If fields (a collection of field names) is given only those fields
+        of a struct are decoded; the others are skipped and get their
+        initial values.
+        """
+        if fields is None:
+            function = self._function(thrift_type, 'load')
+        else:
+            function = self._projection(thrift_type, fields)
+        return self._run(function, _readable(buf), offset)
+
+    def dumps(self, thrift_type, object, buffer=None):
+        """Encode an object and return a bytestring
+
+        If buffer (a bytearray) is given the encoding is appended to it and
+        buffer is returned instead, so many objects can share one buffer.
+        """
+        if buffer is not None:
+            self._function(thrift_type, 'dump')(object, buffer)
+            return buffer
+        out = bytearray()
+        self._function(thrift_type, 'dump')(object, out)
+        return str(out)
+
+    def dump_into(self, thrift_type, object, buffer, offset=0):
+        """Encode an object into a writable buffer at offset
+
+        buffer may be a bytearray, mmap or anything else pack_into accepts
+        and must have room for the encoding.  Returns the offset just past
+        the encoding.  The object is encoded into a bytearray, as with
+        dumps, which is then copied into buffer once.  (Writing each header
+        and value into buffer as it's encoded is several times slower, for
+        all but long strings, since every write is a Python call.)
+        bytearrays and mmaps are copied into directly; other buffers get
+        a bytestring copy of the encoding first.
+        """
+        out = bytearray()
+        self._function(thrift_type, 'dump')(object, out)
+        end = offset + len(out)
+        if end > len(buffer):
+            raise Error("buffer too small: %d bytes needed" % (end, ))
+        if isinstance(buffer, bytearray):
+            buffer[offset:end] = out
+        elif isinstance(buffer, mmap.mmap):
+            _write_mmap(buffer, offset, out)
+        else:
+            struct.pack_into('%ds' % (len(out), ), buffer, offset, str(out))
+        return end
+
+    def loads(self, thrift_type, buf, fields=None):
+        """Decode a bytestring to an object
+
+        buf may be any buffer load_from accepts; a memoryview is copied
+        first.  If fields is given only those fields of a struct are
+        decoded.
+        """
+        return self.load_from(thrift_type, buf, 0, fields)[0]
+
+    def dump_many(self, thrift_type, objects, stream, framing='none', buffer_size=65536):
+        """Encode a sequence of objects to an output stream
+
+        Encodings are collected in a buffer which is written out whenever it
+        grows past buffer_size bytes.  Returns the number of objects written.
+
+        Arguments:
+        framing -- 'none' to concatenate the encodings or 'length-prefixed'
+            to put each one after its length as a 4 byte big-endian integer
+        """
+        prefixed = _framed(framing)
+        function = self._function(thrift_type, 'dump')
+        out = bytearray()
+        count = 0
+        for object in objects:
+            if prefixed:
+                start = len(out)
+                out += '\0\0\0\0'
+                function(object, out)
+                _S_I.pack_into(out, start, len(out) - start - 4)
+            else:
+                function(object, out)
+            count += 1
+            if len(out) >= buffer_size:
+                stream.write(out)
+                out = bytearray()
+        if out:
+            stream.write(out)
+        return count
+
+    def iter_load(self, thrift_type, stream, framing='none', chunk_size=65536):
+        """Iterate over the objects encoded one after another in a stream
+
+        The stream is read chunk_size bytes at a time and only the records
+        which haven't been decoded yet are kept in memory.  Iteration stops
+        at the end of the stream; TruncatedError is raised if it ends in the
+        middle of a record.
+
+        Arguments:
+        framing -- 'none' or 'length-prefixed', as with dump_many
+        """
+        if _framed(framing):
+            return self._iter_load_framed(thrift_type, stream)
+        return self._iter_load_concatenated(thrift_type, stream, chunk_size)
+
+    def _iter_load_framed(self, thrift_type, stream):
+        function = self._function(thrift_type, 'load')
+        while True:
+            header = _read_exactly(stream, 4)
+            if not header:
+                return
+            if len(header) < 4:
+                raise TruncatedError("unexpected end of stream")
+            size, = _S_I.unpack(header)
+            record = _read_exactly(stream, size)
+            if len(record) < size:
+                raise TruncatedError("unexpected end of stream")
+            value, end = self._run(function, record, 0)
+            if end != size:
+                raise Error("record of %d bytes has %d trailing bytes" % (size, size - end))
+            yield value
+
+    def _iter_load_concatenated(self, thrift_type, stream, chunk_size):
+        function = self._function(thrift_type, 'load')
+        data = bytearray()
+        pos = 0
+        want = chunk_size
+        eof = False
+        while True:
+            if pos < len(data):
+                try:
+                    value, pos = self._run(function, buffer(data), pos)
+                except TruncatedError:
+                    if eof:
+                        raise
+                else:
+                    want = chunk_size
+                    yield value
+                    continue
+            elif eof:
+                return
+            # Drop the records decoded so far and read more.  Reads double
+            # while a record is incomplete so a large record isn't decoded
+            # over and over again:
+            del data[:pos]
+            pos = 0
+            chunk = stream.read(want)
+            if chunk:
+                data += chunk
+                want = max(want, len(data))
+            else:
+                eof = True
+
+    def decoder(self, thrift_type, framing='none'):
+        """Get a StreamDecoder for objects pushed to it as they arrive
+
+        Arguments:
+        framing -- 'none' or 'length-prefixed', as with dump_many
+        """
+        return StreamDecoder(self, thrift_type, framing)
+
+    def dumps_many(self, thrift_type, objects, pool=None):
+        """Encode a sequence of objects, returning a list of bytestrings
+
+        If pool (a CodecPool) is given, batches of at least pool.threshold
+        objects are split into chunks which are encoded by its processes.
+        """
+        if pool is not None:
+            objects = list(objects)
+            if len(objects) >= pool.threshold:
+                return pool._map(self, 'dump', thrift_type, objects)
+        function = self._function(thrift_type, 'dump')
+        results = []
+        for object in objects:
+            out = bytearray()
+            function(object, out)
+            results.append(str(out))
+        return results
+
+    def loads_many(self, thrift_type, buffers, pool=None):
+        """Decode a sequence of bytestrings, returning a list of objects
+
+        If pool (a CodecPool) is given, batches of at least pool.threshold
+        buffers are split into chunks which are decoded by its processes.
+        """
+        if pool is not None:
+            buffers = list(buffers)
+            if len(buffers) >= pool.threshold:
+                return pool._map(self, 'load', thrift_type, [_readable(buf)[:] for buf in buffers])
+        function = self._function(thrift_type, 'load')
+        return [self._run(function, _readable(buf), 0)[0] for buf in buffers]
+
+    def dumps_columns(self, thrift_type, rows):
+        """Encode a sequence of structs as a batch of columns
+
+        Each field is stored contiguously: numbers and bools as arrays of
+        big-endian values, strings as an array of offsets followed by
+        their bytes, and other values (structs and containers) like
+        strings, encoded with this codec.  Optional fields have a bitmap of
+        the rows where they aren't None.  Read batches with loads_columns.
+        """
+        if thrift_type.type_id != T_STRUCT:
+            raise TypeError("only structs can be encoded as columns")
+        rows = list(rows)
+        fields = _sorted_fields(thrift_type)
+        out = bytearray(_S_columns.pack(_COLUMNS_MAGIC, len(rows), len(fields)))
+        for name, field in fields:
+            values = [getattr(row, name) for row in rows]
+            body = bytearray()
+            nullable = _optional(field)
+            if nullable:
+                body += _dump_bitmap([value is not None for value in values])
+            type_id = field.type.type_id
+            fmt = _column_formats.get(type_id)
+            if fmt is not None:
+                if nullable:
+                    values = [0 if value is None else value for value in values]
+                body += _dump_fixed_array(values, fmt)
+            else:
+                encoding = _string_encoding(field.type)
+                if type_id != T_STRING:
+                    values = [None if value is None else self.dumps(field.type, value) for value in values]
+                elif encoding:
+                    values = [None if value is None else value.encode(encoding) for value in values]
+                offsets = [0]
+                for value in values:
+                    offsets.append(offsets[-1] + (len(value) if value is not None else 0))
+                body += _dump_fixed_array(offsets, 'i')
+                for value in values:
+                    if value is not None:
+                        body += value
+            out += _S_column.pack(field.tag, type_id, nullable, len(body))
+            out += body
+        return str(out)
+
+    def loads_columns(self, thrift_type, buf):
+        """Get a ColumnBatch of a batch encoded with dumps_columns"""
+        return ColumnBatch(self, thrift_type, _readable(buf))
+
+    def dumps_message(self, name, message_type, seqid, thrift_type, object, buffer=None):
+        """Encode an RPC message: a header followed by a struct of arguments
+        or results
+
+        Returns a bytestring, or appends to buffer (a bytearray) and returns
+        it if it's given.
+        """
+        out = bytearray() if buffer is None else buffer
+        self._dump_message_header(out, _utf8(name), message_type, seqid)
+        self._function(thrift_type, 'dump')(object, out)
+        if buffer is None:
+            return str(out)
+        return out
+
+    def load_message_header(self, buf, offset=0):
+        """Decode an RPC message header
+
+        Returns (name, message_type, seqid) and the offset of the struct
+        which follows the header.
+        """
+        buf = _readable(buf)
+        try:
+            header, end = self._load_message_header(buf, offset)
+        except (struct.error, IndexError):
+            raise TruncatedError("unexpected end of buffer")
+        if end > len(buf):
+            raise TruncatedError("unexpected end of buffer")
+        return header, end
+
+    def loads_lazy(self, thrift_type, buf, offset=0):
+        """Get a LazyStruct view of the struct encoded in buf at offset
+
+        Only the field offsets are read up front; each field is decoded the
+        first time it is accessed.
+        """
+        return self._view(thrift_type, _readable(buf), offset)[0]
+
+    def load_into(self, instance, buf, offset=0):
+        """Decode the struct encoded in buf at offset into an existing
+        instance of it, returning the offset of its end
+
+        Every field of instance is overwritten.  Nested structs are decoded
+        into the instances already held by their fields where there are
+        any, so decoding into the same instance again and again allocates
+        little.  If decoding fails, instance may be partly overwritten.
+        """
+        thrift_type = type(instance)
+        if getattr(thrift_type, 'type_id', None) != T_STRUCT or thrift_type._frozen:
+            raise TypeError("expected an instance of a (not frozen) struct")
+        if self.references:
+            raise Error("reference tracking codecs can't decode in place")
+        function = self._function(thrift_type, 'into')
+        buf = _readable(buf)
+        try:
+            end = function(instance, buf, offset)
+        except (struct.error, IndexError):
+            raise TruncatedError("unexpected end of buffer")
+        if end > len(buf):
+            raise TruncatedError("unexpected end of buffer")
+        return end
+
+    def patch(self, thrift_type, buf, changes, offset=0):
+        """Change some fields of the struct encoded in buf at offset without
+        decoding and encoding the whole struct
+
+        Arguments:
+        changes -- dict of field name to new value
+
+        Fields whose new encoding is as long as the old one, like fixed
+        width numbers in the binary encoding, are overwritten in place.
+        Otherwise only the changed fields are encoded and the rest of the
+        struct is copied.  bytearrays are patched in place (resizing them
+        if needed) and returned; for other buffers a new string is
+        returned.
+        """
+        if thrift_type.type_id != T_STRUCT:
+            raise TypeError("only structs can be patched")
+        fields = thrift_type.fields()
+        for name in changes:
+            if name not in fields:
+                raise ValueError("unknown field %r" % (name, ))
+        readable = _readable(buf)
+        view, end = self._view(thrift_type, readable, offset)
+        offsets = view._offsets
+        replacements = []
+        for name, value in changes.iteritems():
+            if name not in offsets or (value is None and _optional(fields[name])):
+                # Adding or dropping a field, or changing a value kept in
+                # a field header (compact bools):
+                replacements = None
+                break
+            start, stop = offsets[name]
+            encoded = self.dumps(fields[name].type, value)
+            if len(encoded) != stop - start:
+                replacements = None
+                break
+            replacements.append((start, stop, encoded))
+        if replacements is None:
+            for name, value in changes.iteritems():
+                setattr(view, name, value)
+            replacements = [(offset, end, self.dumps(thrift_type, view))]
+        if isinstance(buf, bytearray):
+            for start, stop, encoded in replacements:
+                buf[start:stop] = encoded
+            return buf
+        pieces = []
+        last = 0
+        for start, stop, encoded in sorted(replacements):
+            pieces.append(readable[last:start])
+            pieces.append(encoded)
+            last = stop
+        pieces.append(readable[last:])
+        return ''.join(pieces)
+
+    def __init__(self, arrays=False, instrument=False, intern=False, references=False):
+        """Create a codec
+
+        Arguments:
+        arrays -- bool, decode lists of numbers to numpy arrays (or to
+            array.array objects when numpy isn't installed)
+        instrument -- bool, count the values encoded and decoded, their
+            bytes and the time taken, for stats()
+        intern -- bool or InternTable, share the objects of repeated
+            decoded strings, including map keys and set members, through
+            an InternTable.  Without it, only fields declared with
+            intern=True are interned.
+        references -- bool, encode a struct which appears more than once
+            in a value (the same object, not just an equal one) only the
+            first time, and refer back to it after that, so shared
+            subtrees are encoded once and cycles can be encoded at all.
+            Decoding restores the sharing.  A reference is encoded as a
+            struct with just an i32 field of tag 32767, so other readers
+            can still skip it.  Decoders must know every field holding
+            structs, and can't decode lazily, partially or in place.
+        """
+        self.references = references
+        self.arrays = arrays
+        self.instrument = instrument
+        self._stats = _Stats() if instrument else None
+        if isinstance(intern, InternTable):
+            self.intern, self.intern_table = True, intern
+        else:
+            self.intern, self.intern_table = bool(intern), InternTable()
+        self._plan_lock = threading.RLock()
+        self._reset_plans()
+        # Codecs with equal wire formats can splice each other's encodings
+        self._wire_format = (type(self).__name__, )
+        if references:
+            self._wire_format += ('references', )
+            # The field header starting a reference
+            self._reference_header = type(self)().dumps(_Reference, _Reference(index=0))[:3]
+
+        self._dump_emitters = {
+            T_BOOL   : self._emit_dump_bool,
+            T_BYTE   : self._emit_dump_byte,
+            T_I8    : self._emit_dump_byte,
+            T_DOUBLE : self._emit_dump_double,
+            T_I16    : self._emit_dump_i16,
+            T_I32    : self._emit_dump_i32,
+            T_I64    : self._emit_dump_i64,
+            T_STRING : self._emit_dump_string,
+            T_STRUCT : self._emit_dump_struct,
+            T_MAP    : self._emit_dump_map,
+            T_SET    : self._emit_dump_seq,
+            T_LIST   : self._emit_dump_seq,
+            T_UTF8   : self._emit_dump_string,
+            T_UTF16  : self._emit_dump_string
+        }
 
-    def _dump_byte(self, thrift_type, val, stream):
-        stream.write(chr(val))
+        self._load_emitters = {
+            T_BOOL   : self._emit_load_bool,
+            T_BYTE   : self._emit_load_byte,
+            T_I8    : self._emit_load_byte,
+            T_DOUBLE : self._emit_load_double,
+            T_I16    : self._emit_load_i16,
+            T_I32    : self._emit_load_i32,
+            T_I64    : self._emit_load_i64,
+            T_STRING : self._emit_load_string,
+            T_STRUCT : self._emit_load_struct,
+            T_MAP    : self._emit_load_map,
+            T_SET    : self._emit_load_seq,
+            T_LIST   : self._emit_load_seq,
+            T_UTF8   : self._emit_load_string,
+            T_UTF16  : self._emit_load_string
+        }
 
-    def _load_bool(self, thrift_type, stream):
-        return ord(stream.read(1)) == SYM_BOOL_TRUE
+        self._skip_emitters = {
+            T_BOOL   : self._emit_skip_bool,
+            T_BYTE   : self._emit_skip_byte,
+            T_I8    : self._emit_skip_byte,
+            T_DOUBLE : self._emit_skip_double,
+            T_I16    : self._emit_skip_i16,
+            T_I32    : self._emit_skip_i32,
+            T_I64    : self._emit_skip_i64,
+            T_STRING : self._emit_skip_string,
+            T_STRUCT : self._emit_skip_struct,
+            T_MAP    : self._emit_skip_map,
+            T_SET    : self._emit_skip_seq,
+            T_LIST   : self._emit_skip_seq,
+            T_UTF8   : self._emit_skip_string,
+            T_UTF16  : self._emit_skip_string
+        }
 
-    def _load_byte(self, thrift_type, stream):
-        return ord(stream.read(1))
+    def _run(self, function, buf, offset):
+        """Run a compiled decoding function, checking for truncation"""
+        try:
+            value, offset = function(buf, offset)
+        except (struct.error, IndexError):
+            raise TruncatedError("unexpected end of buffer")
+        if offset > len(buf):
+            raise TruncatedError("unexpected end of buffer")
+        return value, offset
+
+    def _view(self, thrift_type, buf, offset):
+        """Scan the struct encoded in buf at offset into a LazyStruct"""
+        if self.references:
+            raise Error("reference tracking codecs can't decode lazily")
+        offsets = {}
+        values = {}
+        try:
+            end = self._function(thrift_type, 'scan')(buf, offset, offsets, values)
+        except (struct.error, IndexError):
+            raise TruncatedError("unexpected end of buffer")
+        if end > len(buf):
+            raise TruncatedError("unexpected end of buffer")
+        return LazyStruct(self, thrift_type, buf, offsets, values), end
+
+    def _projection(self, thrift_type, fields):
+        """Get the decoder of a struct which only decodes some fields"""
+        fields = frozenset(fields)
+        if thrift_type.type_id != T_STRUCT:
+            raise TypeError("only structs can be decoded partially")
+        if self.references:
+            raise Error("reference tracking codecs can't decode partially")
+        for name in fields:
+            if name not in thrift_type.fields():
+                raise ValueError("unknown field %r" % (name, ))
+        return self._function((thrift_type, fields), 'project')
+
+    def _reset_plans(self):
+        self._plans = dict((kind, {}) for kind in _plan_kinds)
+        self._plan_names = {}
+        self._plan_pending = []
+        self._plan_consts = {}
+        self._plan_counter = 0
+        self._plan_revision = StructType.revision
+        # The code and source of every plan compiled, while recording for
+        # the cache or a generated module
+        self._plan_code = None
+        self._plan_source = None
+        self._namespace = {
+            '_Error': Error,
+            '_MISSING': _MISSING,
+            '_RAW': _RAW,
+            '_LazyStruct': LazyStruct,
+            '_pack': pack,
+            '_unpack_from': struct.unpack_from,
+            '_read_varint': _read_varint,
+            '_binary_skip': _binary_skip,
+            '_compact_skip': _compact_skip,
+            '_ARRAY_TYPES': _array_types,
+            '_load_fixed_array': _load_fixed_array,
+            '_dump_fixed_array': _dump_fixed_array,
+            '_intern': self.intern_table.intern,
+        }
 
-    def _load_double(self, thrift_type, stream):
-        return unpack('!d', stream.read(8))[0]
+    def _function(self, thrift_type, kind):
+        """Get the compiled function of a kind ('dump', 'load', 'skip',
+        'scan', 'splice', 'project' or 'into') for thrift_type
+
+        'project' functions are keyed by (thrift_type, field names).
+        """
+        if self._plan_revision != StructType.revision:
+            with self._plan_lock:
+                self._check_revision()
+        function = self._plans[kind].get(thrift_type)
+        if function is None:
+            with self._plan_lock:
+                function = self._plans[kind].get(thrift_type)
+                if function is None:
+                    function = self._compile(thrift_type, kind)
+        return function
+
+    def _check_revision(self):
+        """Drop the plans if the fields of a struct they were compiled for
+        have changed since.  Structs defined since don't matter."""
+        for thrift_type, kind in self._plan_names:
+            if isinstance(thrift_type, tuple):
+                thrift_type = thrift_type[0]
+            if getattr(thrift_type, '_revision', 0) > self._plan_revision:
+                self._reset_plans()
+                return
+        self._plan_revision = StructType.revision
+
+    def _compile(self, thrift_type, kind):
+        """Generate the kind function for thrift_type and every function of
+        other types it calls"""
+        self._function_name(thrift_type, kind)
+        src = _Source(self)
+        compiled = []
+        while self._plan_pending:
+            a_type, a_kind = self._plan_pending.pop()
+            name = self._plan_names[a_type, a_kind]
+            getattr(self, '_emit_%s_function' % (a_kind, ))(src, a_type, name)
+            compiled.append((a_type, a_kind))
+        source = '\n'.join(src.lines) + '\n'
+        code = compile(source, '<thriftit %s plan>' % (type(self).__name__, ), 'exec')
+        if self._plan_code is not None:
+            self._plan_code.append(code)
+            self._plan_source.append(source)
+        exec code in self._namespace
+        self._install(compiled)
+        return self._plans[kind][thrift_type]
+
+    def _install(self, compiled):
+        """Make the functions just defined in the namespace for (type, kind)
+        pairs available as plans"""
+        for a_type, a_kind in compiled:
+            name = self._plan_names[a_type, a_kind]
+            if self._stats is not None and a_kind in _instrumented_kinds:
+                # Generated code calls other plans through the namespace, so
+                # nested structs are counted too
+                self._namespace[name] = self._stats.wrap(self._namespace[name], a_type, a_kind)
+            self._plans[a_kind][a_type] = self._namespace[name]
+
+    def _precompile(self, types, record=False):
+        """Compile the encoders and decoders of every struct in a mapping of
+        types, and of the arguments and results of the methods of every
+        service.  With record, and if the codec has no plans yet, keep their
+        code for _saved_plans and their source for module_source."""
+        structs = []
+        for name in sorted(types):
+            thrift_type = types[name]
+            if getattr(thrift_type, 'type_id', None) == T_STRUCT:
+                structs.append(thrift_type)
+            elif isinstance(thrift_type, ServiceType):
+                for _, method in sorted(thrift_type.methods().iteritems()):
+                    structs.extend((method.args_type, method.result_type))
+        with self._plan_lock:
+            if self._plan_revision != StructType.revision:
+                self._check_revision()
+            if record and not self._plan_names:
+                self._plan_code = []
+                self._plan_source = []
+            for thrift_type in structs:
+                for kind in ('dump', 'load'):
+                    self._function_name(thrift_type, kind)
+            # Compile them all at once:
+            if self._plan_pending:
+                self._compile(*self._plan_pending[-1])
+
+    def _saved_plans(self, types):
+        """Get the plans recorded by _precompile in a form which can be
+        marshalled and restored with _restore_plans, or None if they refer
+        to objects which can't be found from types"""
+        if self._plan_code is None:
+            return None
+        paths, makes = _schema_paths(types)
+        paths[id(self._wire_format)] = ('wire', )
+        consts = []
+        for (prefix, value_id), name in self._plan_consts.iteritems():
+            if prefix == 'make':
+                # A fresh bound method each time it's looked up
+                path = makes.get(self._namespace[name])
+            else:
+                path = paths.get(value_id)
+            if path is None:
+                return None
+            consts.append((name, prefix, path))
+        entries = []
+        for (thrift_type, kind), name in self._plan_names.iteritems():
+            if id(thrift_type) not in paths:
+                return None
+            entries.append((paths[id(thrift_type)], kind, name))
+        structs = [name for name in self._namespace if name.startswith('_S_')]
+        return (self._plan_code, consts, structs, entries, self._plan_counter)
+
+    def _restore_plans(self, types, plans):
+        """Install plans saved by _saved_plans for types; returns False if
+        they don't fit"""
+        code, consts, structs, entries, counter = plans
+        with self._plan_lock:
+            if self._plan_revision != StructType.revision:
+                self._check_revision()
+            if self._plan_names:
+                return False
+            try:
+                consts = [(name, prefix, self._schema_object(types, path)) for name, prefix, path in consts]
+                entries = [(self._schema_object(types, path), kind, name) for path, kind, name in entries]
+            except (KeyError, AttributeError, TypeError):
+                return False
+            namespace = self._namespace
+            for name, prefix, value in consts:
+                namespace[name] = value
+                self._plan_consts[prefix, id(value)] = name
+            for name in structs:
+                namespace[name] = struct.Struct('!' + name[3:])
+            for chunk in code:
+                exec chunk in namespace
+            for thrift_type, kind, name in entries:
+                self._plan_names[thrift_type, kind] = name
+            self._install([(thrift_type, kind) for thrift_type, kind, name in entries])
+            self._plan_counter = counter
+        return True
+
+    def _adopt_plans(self, plans, counter):
+        """Install plans defined by a module written by module_source; plans
+        is a list of (type, kind, function)"""
+        with self._plan_lock:
+            if self._plan_revision != StructType.revision:
+                self._check_revision()
+            for thrift_type, kind, function in plans:
+                self._plan_names[thrift_type, kind] = function.__name__
+                self._namespace[function.__name__] = function
+            self._install([(thrift_type, kind) for thrift_type, kind, _ in plans])
+            self._plan_counter = max(self._plan_counter, counter)
+
+    def _schema_object(self, types, path):
+        if path == ('wire', ):
+            return self._wire_format
+        return _schema_object(types, path)
+
+    def _cache_key(self):
+        """Identify the codecs whose plans are interchangeable"""
+        return hashlib.sha1(repr((type(self).__name__, self._wire_format, self.arrays, self.intern))).hexdigest()[:16]
+
+    def stats(self):
+        """Get the counters of an instrumented codec
+
+        Returns a dict with 'types', keyed by type_id, and 'structs', keyed
+        by struct class name.  Each value maps 'encode' and 'decode' to a
+        dict of the number of values ('count'), their size in 'bytes' and
+        the total time taken in 'seconds'.  The bytes and time of a nested
+        struct are included in its parents'.
+        """
+        if self._stats is None:
+            raise Error("codec isn't instrumented")
+        return self._stats.snapshot()
+
+    def reset_stats(self):
+        """Zero the counters of an instrumented codec"""
+        if self._stats is None:
+            raise Error("codec isn't instrumented")
+        self._stats.reset()
+
+    def _function_name(self, thrift_type, kind):
+        """Get the name of the kind function for thrift_type, scheduling its
+        generation if it doesn't exist yet"""
+        name = self._plan_names.get((thrift_type, kind))
+        if name is None:
+            if isinstance(thrift_type, tuple):
+                type_name = thrift_type[0].__name__
+            else:
+                type_name = thrift_type.__name__
+            name = self._plan_names[thrift_type, kind] = '_%s_%s_%d' % (
+                kind, _safe_name(type_name), len(self._plan_names))
+            self._plan_pending.append((thrift_type, kind))
+        return name
+
+    def _unique(self, prefix):
+        self._plan_counter += 1
+        return '%s%d' % (prefix, self._plan_counter)
+
+    def _const(self, value, prefix):
+        key = (prefix, id(value))
+        name = self._plan_consts.get(key)
+        if name is None:
+            name = self._plan_consts[key] = self._unique('_' + prefix)
+            self._namespace[name] = value
+        return name
+
+    def _struct(self, fmt):
+        name = '_S_' + fmt.lstrip('!')
+        if name not in self._namespace:
+            self._namespace[name] = struct.Struct(fmt)
+        return name
+
+    def _emit_dump(self, src, thrift_type, value):
+        """Emit statements writing the local variable value"""
+        self._dump_emitters[thrift_type.type_id](src, thrift_type, value)
+
+    def _emit_load(self, src, thrift_type, target):
+        """Emit statements reading a value into the local variable target"""
+        self._load_emitters[thrift_type.type_id](src, thrift_type, target)
+
+    def _emit_skip(self, src, thrift_type):
+        """Emit statements advancing pos past a value"""
+        self._skip_emitters[thrift_type.type_id](src, thrift_type)
+
+    def _emit_dump_function(self, src, thrift_type, name):
+        if self.references:
+            # refs maps the id of each struct written to its index
+            src.line('def %s(obj, out, refs=None):' % (name, ))
+            src.indent()
+            src.line('if refs is None:')
+            src.line('    refs = {}')
+        else:
+            src.line('def %s(obj, out):' % (name, ))
+            src.indent()
+        if thrift_type.type_id == T_STRUCT:
+            wire = src.const(self._wire_format, 'wire')
+            src.line('if obj.__class__ is _LazyStruct and obj._codec._wire_format == %s:' % (wire, ))
+            src.line('    return obj._splice(out)')
+            if self.references:
+                index = src.local('i')
+                src.line('%s = refs.get(id(obj))' % (index, ))
+                src.line('if %s is not None:' % (index, ))
+                src.indent()
+                src.line('out += %r' % (self._reference_header, ))
+                self._emit_dump(src, I32Type, index)
+                src.line('out.append(%d)' % (SYM_STOP, ))
+                src.line('return')
+                src.dedent()
+                src.line('refs[id(obj)] = len(refs)')
+            elif thrift_type._frozen:
+                # Encodings with references depend on what came before, so
+                # are only saved without them
+                # Encode each instance once, then copy the saved bytes:
+                src.line("encoded = obj.__dict__.get('_FrozenStruct__encoded')")
+                src.line('if encoded is None:')
+                src.line("    encoded = obj.__dict__['_FrozenStruct__encoded'] = {}")
+                src.line('elif %s in encoded:' % (wire, ))
+                src.line('    out += encoded[%s]' % (wire, ))
+                src.line('    return')
+                src.line('start = len(out)')
+            self._emit_dump_fields(src, thrift_type)
+            if thrift_type._frozen and not self.references:
+                src.line('encoded[%s] = str(out[start:])' % (wire, ))
+        else:
+            self._emit_dump(src, thrift_type, 'obj')
+        src.dedent()
+
+    def _emit_splice_function(self, src, thrift_type, name):
+        src.line('def %s(view, out):' % (name, ))
+        src.indent()
+        src.line('buf = view._buf')
+        src.line('offsets = view._offsets')
+        src.line('values = view._values')
+        self._emit_dump_fields(src, thrift_type, splice=True)
+        src.dedent()
+
+    def _emit_load_function(self, src, thrift_type, name, projection=None):
+        if self.references:
+            # refs lists the structs read so far by index
+            src.line('def %s(buf, pos, refs=None):' % (name, ))
+            src.indent()
+            src.line('if refs is None:')
+            src.line('    refs = []')
+        else:
+            src.line('def %s(buf, pos):' % (name, ))
+            src.indent()
+        if thrift_type.type_id == T_STRUCT:
+            if self.references:
+                header = self._reference_header
+                src.line('if buf[pos:pos + %d] == %r:' % (len(header), header))
+                src.indent()
+                src.line('pos += %d' % (len(header), ))
+                index = src.local('i')
+                self._emit_load(src, I32Type, index)
+                src.line('return refs[%s], pos + 1' % (index, ))
+                src.dedent()
+                # Registered before its fields are read, for cycles:
+                cls = src.const(thrift_type, 'cls')
+                src.line('obj = %s.__new__(%s)' % (cls, cls))
+                src.line('refs.append(obj)')
+            # Fields left out of a projection have no local and are skipped
+            fields = [(name, field, src.local('f') if projection is None or name in projection else None)
+                      for name, field in _sorted_fields(thrift_type)]
+            decoded = [var for _, _, var in fields if var]
+            if decoded:
+                src.line(' = '.join(decoded) + ' = _MISSING')
+            def emit_case((name, field, var), header_value):
+                if var is None:
+                    if header_value:
+                        src.line('pass')
+                    else:
+                        self._emit_skip(src, field.type)
+                elif header_value:
+                    src.line('%s = %s' % (var, header_value))
+                else:
+                    src.intern = field.intern
+                    self._emit_load(src, field.type, var)
+                    src.intern = False
+            self._emit_field_loop(src, fields, emit_case)
+            self._emit_construct(src, thrift_type, fields)
+        else:
+            self._emit_load(src, thrift_type, 'val')
+            src.line('return val, pos')
+        src.dedent()
+
+    def _emit_into_function(self, src, thrift_type, name):
+        src.line('def %s(obj, buf, pos):' % (name, ))
+        src.indent()
+        fields = [(name, field, src.local('f')) for name, field in _sorted_fields(thrift_type)]
+        if fields:
+            src.line(' = '.join(var for _, _, var in fields) + ' = _MISSING')
+        def emit_case((name, field, var), header_value):
+            if header_value:
+                src.line('%s = %s' % (var, header_value))
+            elif field.type.type_id == T_STRUCT and not field.type._frozen:
+                # Reuse the instance already in the field:
+                src.line('%s = %s' % (var, src.attr('obj', name)))
+                src.line('if %s.__class__ is %s:' % (var, src.const(field.type, 'cls')))
+                src.line('    pos = %s(%s, buf, pos)' % (self._function_name(field.type, 'into'), var))
+                src.line('else:')
+                src.indent()
+                self._emit_load(src, field.type, var)
+                src.dedent()
+            else:
+                src.intern = field.intern
+                self._emit_load(src, field.type, var)
+                src.intern = False
+        self._emit_field_loop(src, fields, emit_case)
+        for name, field, var in fields:
+            src.line('%s = %s() if %s is _MISSING else %s' % (
+                src.attr('obj', name), src.const(field.initial, 'initial'), var, var))
+        src.line('return pos')
+        src.dedent()
+
+    def _emit_project_function(self, src, (thrift_type, projection), name):
+        self._emit_load_function(src, thrift_type, name, projection)
+
+    def _emit_skip_function(self, src, thrift_type, name):
+        src.line('def %s(buf, pos):' % (name, ))
+        src.indent()
+        if thrift_type.type_id == T_STRUCT:
+            fields = [(name, field, None) for name, field in _sorted_fields(thrift_type)]
+            def emit_case((name, field, var), header_value):
+                if header_value:
+                    src.line('pass')
+                else:
+                    self._emit_skip(src, field.type)
+            self._emit_field_loop(src, fields, emit_case)
+        else:
+            self._emit_skip(src, thrift_type)
+        src.line('return pos')
+        src.dedent()
+
+    def _emit_scan_function(self, src, thrift_type, name):
+        src.line('def %s(buf, pos, offsets, values):' % (name, ))
+        src.indent()
+        fields = [(name, field, None) for name, field in _sorted_fields(thrift_type)]
+        def emit_case((name, field, var), header_value):
+            if header_value:
+                src.line('values[%r] = %s' % (name, header_value))
+            else:
+                src.line('start = pos')
+                self._emit_skip(src, field.type)
+                src.line('offsets[%r] = start, pos' % (name, ))
+        self._emit_field_loop(src, fields, emit_case)
+        src.line('return pos')
+        src.dedent()
+
+    def _emit_dump_struct(self, src, thrift_type, value):
+        src.line('%s(%s, out%s)' % (self._function_name(thrift_type, 'dump'), value, ', refs' if self.references else ''))
+
+    def _emit_load_struct(self, src, thrift_type, target):
+        src.line('%s, pos = %s(buf, pos%s)' % (target, self._function_name(thrift_type, 'load'), ', refs' if self.references else ''))
+
+    def _emit_skip_struct(self, src, thrift_type):
+        src.line('pos = %s(buf, pos)' % (self._function_name(thrift_type, 'skip'), ))
+
+    def _emit_dump_string(self, src, thrift_type, value):
+        encoding = _string_encoding(thrift_type)
+        if encoding:
+            src.line('%s = %s.encode(%r)' % (value, value, encoding))
+        self._emit_dump_bytes(src, value)
+
+    def _emit_load_string(self, src, thrift_type, target):
+        self._emit_load_bytes(src, target)
+        encoding = _string_encoding(thrift_type)
+        if encoding:
+            # Byte strings cut short by the end of the buffer are caught once
+            # decoding finishes, but text has to be checked before decoding:
+            src.line('if pos > len(buf):')
+            src.line('    raise IndexError(pos)')
+            src.line('%s = %s.decode(%r)' % (target, target, encoding))
+        if self.intern or src.intern:
+            src.line('%s = _intern(%s)' % (target, target))
+
+    def _emit_field_value(self, src, name, field, splice):
+        """Emit statements fetching a field value into a new local
+
+        When splicing a LazyStruct the local is _RAW for fields whose
+        original encoding can be copied.
+        """
+        value = src.local('v')
+        if splice:
+            src.line('%s = values.get(%r, _MISSING)' % (value, name))
+            src.line('if %s is _MISSING:' % (value, ))
+            src.line('    %s = _RAW if %r in offsets else %s()' % (value, name, src.const(field.initial, 'initial')))
+        else:
+            src.line('%s = %s' % (value, src.attr('obj', name)))
+        return value
+
+    def _emit_field_dump(self, src, name, field, value, splice):
+        """Emit statements writing a field value, or copying it when splicing"""
+        if splice:
+            src.line('if %s is _RAW:' % (value, ))
+            src.line('    start, end = offsets[%r]' % (name, ))
+            src.line('    out += buf[start:end]')
+            src.line('else:')
+            src.indent()
+            self._emit_dump(src, field.type, value)
+            src.dedent()
+        else:
+            self._emit_dump(src, field.type, value)
+
+    def _emit_construct(self, src, thrift_type, fields):
+        """Emit statements building a struct from the field locals"""
+        values = []
+        for name, field, var in fields:
+            initial = src.const(field.initial, 'initial')
+            if var is None:
+                values.append('%s()' % (initial, ))
+            else:
+                values.append('%s() if %s is _MISSING else %s' % (initial, var, var))
+        if thrift_type._compact and not self.references:
+            thrift_type._compile_compact()
+            src.line('return %s(%s), pos' % (src.const(thrift_type._make, 'make'), ', '.join(values)))
+            return
+        if not self.references:
+            # (With references obj was made before reading the fields)
+            cls = src.const(thrift_type, 'cls')
+            src.line('obj = %s.__new__(%s)' % (cls, cls))
+        if thrift_type._frozen:
+            src.line('attributes = obj.__dict__')
+            for (name, field, var), value in zip(fields, values):
+                src.line('attributes[%r] = %s' % (name, value))
+        else:
+            for (name, field, var), value in zip(fields, values):
+                src.line('%s = %s' % (src.attr('obj', name), value))
+        src.line('return obj, pos')
+
+    def _emit_tag_switch(self, src, tag, cases, emit_case):
+        """Emit a branch on the local tag, bisecting wide structs"""
+        if len(cases) > 8:
+            middle = len(cases) // 2
+            src.line('if %s < %d:' % (tag, cases[middle][1].tag))
+            src.indent()
+            self._emit_tag_switch(src, tag, cases[:middle], emit_case)
+            src.dedent()
+            src.line('else:')
+            src.indent()
+            self._emit_tag_switch(src, tag, cases[middle:], emit_case)
+            src.dedent()
+            return
+        keyword = 'if'
+        for case in cases:
+            src.line('%s %s == %d:' % (keyword, tag, case[1].tag))
+            src.indent()
+            emit_case(case)
+            src.dedent()
+            keyword = 'elif'
+        if keyword == 'if':
+            src.line('if 1:')
+        else:
+            src.line('else:')
+        src.indent()
+        # Fields this struct doesn't know about, such as ones added by a
+        # newer version of the schema, are skipped:
+        self._emit_skip_unknown(src)
+        src.dedent()
+
+_plan_kinds = ('dump', 'load', 'skip', 'scan', 'splice', 'project', 'into')
+
+class InternTable(object):
+    """A bounded table of decoded strings, so repeated values share one
+    object
+
+    Strings longer than max_length aren't interned.  Eviction is an
+    approximate LRU: entries live in a recent and an old generation of up
+    to max_size / 2 each, a hit in the old generation moves the entry to
+    the recent one, and when the recent one fills up the old one is
+    dropped.  The table may be shared between codecs and threads; under
+    concurrent use the counters are approximate.
+    """
+    def __init__(self, max_size=4096, max_length=64):
+        self.max_size = max_size
+        self.max_length = max_length
+        self.clear()
+
+    def clear(self):
+        self._recent = {}
+        self._old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, value):
+        """Get the shared object equal to value, of the same type"""
+        if len(value) > self.max_length:
+            return value
+        # Equal str and unicode values hash the same, so the type is part
+        # of the key
+        key = (type(value), value)
+        shared = self._recent.get(key)
+        if shared is not None:
+            self.hits += 1
+            return shared
+        shared = self._old.pop(key, None)
+        if shared is None:
+            self.misses += 1
+            shared = value
+        else:
+            self.hits += 1
+        if len(self._recent) * 2 >= self.max_size:
+            self._old = self._recent
+            self._recent = {}
+        self._recent[key] = shared
+        return shared
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def stats(self):
+        """Get a dict of the 'hits', 'misses', 'hit_rate' and 'size'"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'size': len(self),
+        }
 
-    def _load_i16(self, thrift_type, stream):
-        return zigzag_to_int(self._load_varint(stream))
+_RAW = object()
 
-    _load_i32 = _load_i16
+_instrumented_kinds = {
+    'dump' : 'encode',
+    'load' : 'decode',
+    'project' : 'decode',
+    'into' : 'decode',
+}
 
-    def _load_i64(self, thrift_type, stream):
-        return zigzag_to_int(self._load_varint(stream))
+class _Stats(object):
+    """Counters of an instrumented codec"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (type_id, struct or None, 'encode' or 'decode') -> [count, bytes, seconds]
+            self._counters = {}
+
+    def wrap(self, function, thrift_type, kind):
+        """Wrap a compiled function to count its calls"""
+        if isinstance(thrift_type, tuple):
+            thrift_type = thrift_type[0]
+        struct_type = thrift_type if thrift_type.type_id == T_STRUCT else None
+        key = (thrift_type.type_id, struct_type, _instrumented_kinds[kind])
+        lock = self._lock
+        clock = time.time
+        def add(size, seconds):
+            with lock:
+                counter = self._counters.get(key)
+                if counter is None:
+                    counter = self._counters[key] = [0, 0, 0.0]
+                counter[0] += 1
+                counter[1] += size
+                counter[2] += seconds
+        if kind == 'dump':
+            def dump(obj, out, *refs):
+                start = len(out)
+                began = clock()
+                function(obj, out, *refs)
+                add(len(out) - start, clock() - began)
+            return dump
+        if kind == 'into':
+            def into(obj, buf, pos):
+                began = clock()
+                end = function(obj, buf, pos)
+                add(end - pos, clock() - began)
+                return end
+            return into
+        def load(buf, pos, *refs):
+            began = clock()
+            value, end = function(buf, pos, *refs)
+            add(end - pos, clock() - began)
+            return value, end
+        return load
+
+    def snapshot(self):
+        types = {}
+        structs = {}
+        with self._lock:
+            counters = [(key, list(counter)) for key, counter in self._counters.iteritems()]
+        for (type_id, struct_type, direction), (count, size, seconds) in counters:
+            tables = [types.setdefault(type_id, {})]
+            if struct_type is not None:
+                tables.append(structs.setdefault(struct_type.__name__, {}))
+            for table in tables:
+                totals = table.setdefault(direction, {'count': 0, 'bytes': 0, 'seconds': 0.0})
+                totals['count'] += count
+                totals['bytes'] += size
+                totals['seconds'] += seconds
+        return {'types': types, 'structs': structs}
+
+def _string_encoding(thrift_type):
+    """Get the text encoding of a string type, or None for byte strings"""
+    if thrift_type.type_id == T_UTF16:
+        return 'utf-16'
+    if thrift_type.type_id == T_UTF8 or issubclass(thrift_type, unicode):
+        return 'utf-8'
+    return None
+
+def _optional(field):
+    """Whether a field is left out of the encoding when its value is None"""
+    return bool(field.optional)
+
+_binary_fixed_formats = {
+    T_BYTE   : 'B',
+    T_I16    : 'h',
+    T_I32    : 'i',
+    T_I64    : 'q',
+    T_DOUBLE : 'd',
+}
 
-    def _load_string(self, thrift_type, stream):
-        num = self._load_varint(stream)
-        buf = stream.read(num)
-        return buf
+_fixed_sizes = {
+    'B' : 1,
+    'h' : 2,
+    'i' : 4,
+    'q' : 8,
+    'd' : 8,
+}
 
-    def _load_utf8(self, thrift_type, stream):
-        return self._load_string(thrift_type, stream).decode('utf-8')
+# Sizes of the fixed width values of the binary encoding
+_binary_sizes = {
+    T_BOOL   : 1,
+    T_BYTE   : 1,
+    T_I16    : 2,
+    T_I32    : 4,
+    T_I64    : 8,
+    T_DOUBLE : 8,
+}
 
-    def _load_utf16(self, thrift_type, stream):
-        return self._load_string(thrift_type, stream).decode('utf-16')
+class BinaryCodec(Codec):
+    """Implement the binary codec"""
+    def _scan(self, buf, pos, stack):
+        return _binary_scan(buf, pos, stack)
+
+    def _scan_need(self, buf, pos, stack):
+        return _binary_scan_need(buf, pos, stack)
+
+    def _dump_message_header(self, out, name, message_type, seqid):
+        out += _S_iI.pack(VERSION_1 | message_type, len(name))
+        out += name
+        out += _S_i.pack(seqid)
+
+    def _load_message_header(self, buf, pos):
+        version, = _S_i.unpack_from(buf, pos)
+        if version >= 0:
+            # Old style headers start with the name
+            name = buf[pos + 4:pos + 4 + version]
+            message_type, seqid = _S_Bi.unpack_from(buf, pos + 4 + version)
+            return (name, message_type, seqid), pos + 9 + version
+        if version & VERSION_MASK != VERSION_1:
+            raise Error("bad message version: 0x%x" % (version & VERSION_MASK & 0xffffffff, ))
+        size, = _S_I.unpack_from(buf, pos + 4)
+        pos += 8
+        name = buf[pos:pos + size]
+        seqid, = _S_i.unpack_from(buf, pos + size)
+        return (name, version & 0xff, seqid), pos + size + 4
+
+    def _emit_dump_fields(self, src, thrift_type, splice=False):
+        for name, field in _sorted_fields(thrift_type):
+            value = self._emit_field_value(src, name, field, splice)
+            if _optional(field):
+                src.line('if %s is not None:' % (value, ))
+                src.indent()
+            symbol = _type_to_symbol[field.type.type_id]
+            fmt = _binary_fixed_formats.get(field.type.type_id)
+            if fmt is not None and not splice:
+                # Fold the field header and the value into a single pack:
+                src.line('out += %s.pack(%d, %d, %s)' % (src.struct('!BH' + fmt), symbol, field.tag, value))
+            elif field.type.type_id == T_STRING and not _string_encoding(field.type) and not splice:
+                src.line('out += %s.pack(%d, %d, len(%s))' % (src.struct('!BHI'), symbol, field.tag, value))
+                src.line('out += %s' % (value, ))
+            else:
+                src.line('out += %r' % (pack('!BH', symbol, field.tag), ))
+                self._emit_field_dump(src, name, field, value, splice)
+            if _optional(field):
+                src.dedent()
+        src.line('out.append(%d)' % (SYM_STOP, ))
+
+    def _emit_field_loop(self, src, fields, emit_case):
+        """Emit a loop over the field headers of a struct, calling
+        emit_case(case, header_value) for each known field"""
+        src.line('while 1:')
+        src.indent()
+        src.line('if buf[pos] == %r:' % (chr(SYM_STOP), ))
+        src.line('    pos += 1')
+        src.line('    break')
+        src.line('tag, = %s.unpack_from(buf, pos + 1)' % (src.struct('!H'), ))
+        src.line('pos += 3')
+        self._emit_tag_switch(src, 'tag', fields, lambda case: emit_case(case, None))
+        src.dedent()
+
+    def _emit_skip_unknown(self, src):
+        src.line('pos = _binary_skip(buf, pos, ord(buf[pos - 3]))')
+
+    def _emit_dump_bool(self, src, thrift_type, value):
+        src.line('out.append(%d if %s else %d)' % (SYM_BOOL_TRUE, value, SYM_BOOL_FALSE))
+
+    def _emit_load_bool(self, src, thrift_type, target):
+        src.line('%s = buf[pos] != %r' % (target, chr(SYM_BOOL_FALSE)))
+        src.line('pos += 1')
+
+    def _emit_skip_fixed(self, src, thrift_type):
+        src.line('pos += %d' % (_binary_sizes[thrift_type.type_id], ))
+
+    _emit_skip_bool = _emit_skip_fixed
+    _emit_skip_byte = _emit_skip_fixed
+    _emit_skip_i16 = _emit_skip_fixed
+    _emit_skip_i32 = _emit_skip_fixed
+    _emit_skip_i64 = _emit_skip_fixed
+    _emit_skip_double = _emit_skip_fixed
+
+    def _emit_skip_string(self, src, thrift_type):
+        src.line('pos += 4 + %s.unpack_from(buf, pos)[0]' % (src.struct('!I'), ))
+
+    def _emit_skip_map(self, src, thrift_type):
+        size = src.local('n')
+        src.line('_, _, %s = %s.unpack_from(buf, pos)' % (size, src.struct('!BBi')))
+        src.line('pos += 6')
+        key_size = _binary_sizes.get(thrift_type.key_type.type_id)
+        value_size = _binary_sizes.get(thrift_type.value_type.type_id)
+        if key_size and value_size:
+            src.line('pos += %d * max(%s, 0)' % (key_size + value_size, size))
+            return
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_skip(src, thrift_type.key_type)
+        self._emit_skip(src, thrift_type.value_type)
+        src.dedent()
+
+    def _emit_skip_seq(self, src, thrift_type):
+        size = src.local('n')
+        src.line('_, %s = %s.unpack_from(buf, pos)' % (size, src.struct('!BI')))
+        src.line('pos += 5')
+        value_size = _binary_sizes.get(thrift_type.value_type.type_id)
+        if value_size:
+            src.line('pos += %d * %s' % (value_size, size))
+            return
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_skip(src, thrift_type.value_type)
+        src.dedent()
+
+    def _emit_dump_fixed(self, src, thrift_type, value):
+        fmt = '!' + _binary_fixed_formats[thrift_type.type_id]
+        src.line('out += %s.pack(%s)' % (src.struct(fmt), value))
+
+    _emit_dump_byte = _emit_dump_fixed
+    _emit_dump_i16 = _emit_dump_fixed
+    _emit_dump_i32 = _emit_dump_fixed
+    _emit_dump_i64 = _emit_dump_fixed
+    _emit_dump_double = _emit_dump_fixed
+
+    def _emit_load_fixed(self, src, thrift_type, target):
+        fmt = _binary_fixed_formats[thrift_type.type_id]
+        src.line('%s, = %s.unpack_from(buf, pos)' % (target, src.struct('!' + fmt)))
+        src.line('pos += %d' % (_fixed_sizes[fmt], ))
+
+    _emit_load_byte = _emit_load_fixed
+    _emit_load_i16 = _emit_load_fixed
+    _emit_load_i32 = _emit_load_fixed
+    _emit_load_i64 = _emit_load_fixed
+    _emit_load_double = _emit_load_fixed
+
+    def _emit_dump_bytes(self, src, value):
+        src.line('out += %s.pack(len(%s))' % (src.struct('!I'), value))
+        src.line('out += %s' % (value, ))
+
+    def _emit_load_bytes(self, src, target):
+        size = src.local('n')
+        src.line('%s, = %s.unpack_from(buf, pos)' % (size, src.struct('!I')))
+        src.line('%s = buf[pos + 4:pos + 4 + %s]' % (target, size))
+        src.line('pos += 4 + %s' % (size, ))
+
+    def _emit_dump_map(self, src, thrift_type, value):
+        key_type = thrift_type.key_type
+        value_type = thrift_type.value_type
+        src.line('out += %s.pack(%d, %d, len(%s))' % (src.struct('!BBi'),
+            _type_to_symbol[key_type.type_id], _type_to_symbol[value_type.type_id], value))
+        key, item = src.local('k'), src.local('v')
+        src.line('for %s, %s in %s.iteritems():' % (key, item, value))
+        src.indent()
+        self._emit_dump(src, key_type, key)
+        self._emit_dump(src, value_type, item)
+        src.dedent()
+
+    def _emit_load_map(self, src, thrift_type, target):
+        size, key, item = src.local('n'), src.local('k'), src.local('v')
+        src.line('_, _, %s = %s.unpack_from(buf, pos)' % (size, src.struct('!BBi')))
+        src.line('pos += 6')
+        src.line('%s = %s()' % (target, src.const(thrift_type, 'map')))
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_load(src, thrift_type.key_type, key)
+        self._emit_load(src, thrift_type.value_type, item)
+        src.line('%s[%s] = %s' % (target, key, item))
+        src.dedent()
+
+    def _emit_dump_seq(self, src, thrift_type, value):
+        value_type = thrift_type.value_type
+        src.line('out += %s.pack(%d, len(%s))' % (src.struct('!BI'), _type_to_symbol[value_type.type_id], value))
+        fmt = _binary_fixed_formats.get(value_type.type_id)
+        if fmt is not None:
+            # Pack every element of a numeric sequence in one call:
+            src.line('if %s.__class__ in _ARRAY_TYPES:' % (value, ))
+            src.line('    out += _dump_fixed_array(%s, %r)' % (value, fmt))
+            src.line('else:')
+            src.line("    out += _pack('!%%d%s' %% len(%s), *%s)" % (fmt, value, value))
+            return
+        item = src.local('v')
+        src.line('for %s in %s:' % (item, value))
+        src.indent()
+        self._emit_dump(src, value_type, item)
+        src.dedent()
+
+    def _emit_load_seq(self, src, thrift_type, target):
+        value_type = thrift_type.value_type
+        container = 'list' if thrift_type.type_id == T_LIST else 'set'
+        size = src.local('n')
+        src.line('_, %s = %s.unpack_from(buf, pos)' % (size, src.struct('!BI')))
+        src.line('pos += 5')
+        fmt = _binary_fixed_formats.get(value_type.type_id)
+        if fmt is not None:
+            if self.arrays and container == 'list':
+                src.line('%s = _load_fixed_array(buf, pos, %s, %r)' % (target, size, fmt))
+            else:
+                src.line("%s = %s(_unpack_from('!%%d%s' %% %s, buf, pos))" % (target, container, fmt, size))
+            src.line('pos += %d * %s' % (_fixed_sizes[fmt], size))
+            return
+        item = src.local('v')
+        src.line('%s = %s()' % (target, container))
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_load(src, value_type, item)
+        src.line('%s.%s(%s)' % (target, 'append' if container == 'list' else 'add', item))
+        src.dedent()
+
+_S_I = struct.Struct('!I')
+_S_BI = struct.Struct('!BI')
+_S_BBi = struct.Struct('!BBi')
+_S_Bi = struct.Struct('!Bi')
+_S_i = struct.Struct('!i')
+_S_iI = struct.Struct('!iI')
+_S_Q = struct.Struct('!Q')
+
+# Sizes of the fixed width values of the binary encoding by type symbol
+_binary_symbol_sizes = {
+    SYM_BOOL   : 1,
+    SYM_BYTE   : 1,
+    SYM_I16    : 2,
+    SYM_I32    : 4,
+    SYM_I64    : 8,
+    SYM_DOUBLE : 8,
+}
 
-    def _load_struct(self, thrift_type, stream):
-        name_fields = thrift_type.fields().iteritems()
-        tag_to_field = dict((field.tag, (name, field)) for name, field in name_fields)
-        vals = {}
-        last_field_id = 0
+def _binary_skip(buf, pos, symbol):
+    """Skip a value of the binary encoding given its type symbol"""
+    size = _binary_symbol_sizes.get(symbol)
+    if size is not None:
+        return pos + size
+    if symbol == SYM_STRING:
+        return pos + 4 + _S_I.unpack_from(buf, pos)[0]
+    if symbol == SYM_STRUCT:
         while True:
-            delta_type = ord(stream.read(1))
+            field_symbol = ord(buf[pos])
+            if field_symbol == SYM_STOP:
+                return pos + 1
+            pos = _binary_skip(buf, pos + 3, field_symbol)
+    if symbol == SYM_MAP:
+        key_symbol, value_symbol, size = _S_BBi.unpack_from(buf, pos)
+        pos += 6
+        key_size = _binary_symbol_sizes.get(key_symbol)
+        value_size = _binary_symbol_sizes.get(value_symbol)
+        if key_size and value_size:
+            return pos + (key_size + value_size) * max(size, 0)
+        for i in xrange(size):
+            pos = _binary_skip(buf, pos, key_symbol)
+            pos = _binary_skip(buf, pos, value_symbol)
+        return pos
+    if symbol == SYM_LIST or symbol == SYM_SET:
+        value_symbol, size = _S_BI.unpack_from(buf, pos)
+        pos += 5
+        value_size = _binary_symbol_sizes.get(value_symbol)
+        if value_size:
+            return pos + value_size * size
+        for i in xrange(size):
+            pos = _binary_skip(buf, pos, value_symbol)
+        return pos
+    raise Error("unexpected type symbol %d" % (symbol, ))
+
+def _write_varint(out, num):
+    """Append an unsigned varint to a bytearray"""
+    while True:
+        if (num & ~0x7F) == 0:
+            out.append(num & 0xFF)
+            break
+        else:
+            out.append((num & 0x7F) | 0x80)
+            num >>= 7
+
+def _varint_at(buf, pos):
+    """Read an unsigned varint, returning it and the offset just past it"""
+    num = ord(buf[pos])
+    if num > 0x7f:
+        return _read_varint(buf, pos + 1, num)
+    return num, pos + 1
+
+def _compact_skip(buf, pos, type_id):
+    """Skip a value of the compact encoding given its type id"""
+    if type_id == T_BOOL or type_id == T_BYTE:
+        return pos + 1
+    if type_id == T_DOUBLE:
+        return pos + 8
+    if type_id == T_I16 or type_id == T_I32 or type_id == T_I64:
+        while buf[pos] > '\x7f':
+            pos += 1
+        return pos + 1
+    if type_id == T_STRING:
+        size, pos = _varint_at(buf, pos)
+        return pos + size
+    if type_id == T_STRUCT:
+        while True:
+            delta_type = ord(buf[pos])
+            pos += 1
+            the_type = delta_type & 0x0f
+            if the_type == SYM_STOP:
+                return pos
+            if not delta_type & 0xf0:
+                pos += 2
+            # Booleans are carried in the type of the field header:
+            if the_type > SYM_BOOL_TRUE:
+                pos = _compact_skip(buf, pos, the_type)
+    if type_id == T_MAP:
+        size, pos = _varint_at(buf, pos)
+        if size:
+            kv_type_id = ord(buf[pos])
+            pos += 1
+            for i in xrange(size):
+                pos = _compact_skip(buf, pos, kv_type_id >> 4)
+                pos = _compact_skip(buf, pos, kv_type_id & 0x0f)
+        return pos
+    if type_id == T_LIST or type_id == T_SET:
+        size_type = ord(buf[pos])
+        pos += 1
+        size = size_type >> 4
+        if size == 15:
+            size, pos = _varint_at(buf, pos)
+        for i in xrange(size):
+            pos = _compact_skip(buf, pos, size_type & 0x0f)
+        return pos
+    raise Error("unexpected type id %d" % (type_id, ))
+
+def _binary_scan(buf, pos, stack):
+    """Advance over as much of a binary encoded value as buf holds
+
+    stack holds what's left of the value.  A ['struct'] entry reads field
+    headers until the stop byte; a [remaining, symbols] entry reads
+    remaining values, cycling through the type symbols (one for lists and
+    sets, the key and value for maps).  Returns the offset after the last
+    header or value read completely; the value is complete when stack is
+    empty.  Only whole headers and values are consumed, so calling again
+    with more data carries on where this left off.
+    """
+    end = len(buf)
+    while stack:
+        top = stack[-1]
+        if len(top) == 1:
+            if pos >= end:
+                return pos
+            symbol = ord(buf[pos])
+            if symbol == SYM_STOP:
+                pos += 1
+                stack.pop()
+                continue
+            if pos + 3 > end:
+                return pos
+            pos += 3
+            stack.append([1, (symbol, )])
+            continue
+        remaining, symbols = top
+        if not remaining:
+            stack.pop()
+            continue
+        symbol = symbols[remaining % len(symbols)]
+        size = _binary_symbol_sizes.get(symbol)
+        if size is not None:
+            count = min(remaining, (end - pos) // size) if len(symbols) == 1 else int(pos + size <= end)
+            if not count:
+                return pos
+            pos += count * size
+            top[0] -= count
+        elif symbol == SYM_STRING:
+            if pos + 4 > end:
+                return pos
+            size = _S_I.unpack_from(buf, pos)[0] + 4
+            if pos + size > end:
+                return pos
+            pos += size
+            top[0] -= 1
+        elif symbol == SYM_STRUCT:
+            top[0] -= 1
+            stack.append(['struct'])
+        elif symbol == SYM_MAP:
+            if pos + 6 > end:
+                return pos
+            key_symbol, value_symbol, size = _S_BBi.unpack_from(buf, pos)
+            pos += 6
+            top[0] -= 1
+            stack.append([2 * max(size, 0), (key_symbol, value_symbol)])
+        elif symbol == SYM_LIST or symbol == SYM_SET:
+            if pos + 5 > end:
+                return pos
+            value_symbol, size = _S_BI.unpack_from(buf, pos)
+            pos += 5
+            top[0] -= 1
+            stack.append([size, (value_symbol, )])
+        else:
+            raise Error("unexpected type symbol %d" % (symbol, ))
+    return pos
+
+def _binary_scan_need(buf, pos, stack):
+    """Get the number of bytes _binary_scan needs after buf to get past
+    pos, where it stopped.  Never more than the rest of the value."""
+    have = len(buf) - pos
+    top = stack[-1]
+    if len(top) == 1:
+        if not have:
+            return 1
+        return 3 - have
+    remaining, symbols = top
+    symbol = symbols[remaining % len(symbols)]
+    size = _binary_symbol_sizes.get(symbol)
+    if size is not None:
+        return size - have
+    if symbol == SYM_STRING:
+        if have < 4:
+            return 4 - have
+        return _S_I.unpack_from(buf, pos)[0] + 4 - have
+    return (6 if symbol == SYM_MAP else 5) - have
+
+def _varint_end(buf, pos, end):
+    """Get the offset after the varint at pos, or None if buf doesn't hold
+    all of it"""
+    while pos < end:
+        if buf[pos] < '\x80':
+            return pos + 1
+        pos += 1
+    return None
+
+_varint_last_re = re.compile('[\x00-\x7f]')
+
+def _compact_scan(buf, pos, stack):
+    """Advance over as much of a compact encoded value as buf holds, like
+    _binary_scan"""
+    end = len(buf)
+    while stack:
+        top = stack[-1]
+        if len(top) == 1:
+            if pos >= end:
+                return pos
+            delta_type = ord(buf[pos])
             the_type = delta_type & 0x0f
-            delta = (delta_type & 0xf0) >> 4
-
             if the_type == SYM_STOP:
+                pos += 1
+                stack.pop()
+                continue
+            size = 1 if delta_type & 0xf0 else 3
+            if pos + size > end:
+                return pos
+            pos += size
+            # Booleans are carried in the type of the field header:
+            if the_type > SYM_BOOL_TRUE:
+                stack.append([1, (the_type, )])
+            continue
+        remaining, symbols = top
+        if not remaining:
+            stack.pop()
+            continue
+        type_id = symbols[remaining % len(symbols)]
+        if type_id in (SYM_BOOL_FALSE, T_BOOL, T_BYTE, T_DOUBLE):
+            size = 8 if type_id == T_DOUBLE else 1
+            count = min(remaining, (end - pos) // size) if len(symbols) == 1 else int(pos + size <= end)
+            if not count:
+                return pos
+            pos += count * size
+            top[0] -= count
+            continue
+        elif type_id == T_I16 or type_id == T_I32 or type_id == T_I64:
+            if len(symbols) == 1:
+                # Find the last bytes of as many varints of a list as are
+                # here in one go:
+                count = 0
+                for count, match in enumerate(itertools.islice(_varint_last_re.finditer(buf, pos, end), remaining), 1):
+                    pass
+                if not count:
+                    return pos
+                pos = match.end()
+                top[0] -= count
+                continue
+            after = _varint_end(buf, pos, end)
+            if after is None:
+                return pos
+            pos = after
+        elif type_id == T_STRING:
+            after = _varint_end(buf, pos, end)
+            if after is None:
+                return pos
+            size = _varint_at(buf, pos)[0]
+            if after + size > end:
+                return pos
+            pos = after + size
+        elif type_id == T_STRUCT:
+            stack.append(['struct'])
+        elif type_id == T_MAP:
+            after = _varint_end(buf, pos, end)
+            if after is None:
+                return pos
+            size = _varint_at(buf, pos)[0]
+            if size:
+                if after >= end:
+                    return pos
+                kv_type_id = ord(buf[after])
+                after += 1
+                stack.append([2 * size, (kv_type_id >> 4, kv_type_id & 0x0f)])
+            pos = after
+        elif type_id == T_LIST or type_id == T_SET:
+            if pos >= end:
+                return pos
+            size_type = ord(buf[pos])
+            size = size_type >> 4
+            after = pos + 1
+            if size == 15:
+                after = _varint_end(buf, after, end)
+                if after is None:
+                    return pos
+                size = _varint_at(buf, pos + 1)[0]
+            stack.append([size, (size_type & 0x0f, )])
+            pos = after
+        else:
+            raise Error("unexpected type id %d" % (type_id, ))
+        top[0] -= 1
+    return pos
+
+def _compact_scan_need(buf, pos, stack):
+    """Get the number of bytes _compact_scan needs after buf to get past
+    pos, like _binary_scan_need"""
+    end = len(buf)
+    top = stack[-1]
+    if len(top) == 1:
+        if pos == end:
+            return 1
+        return 3 - (end - pos)
+    remaining, symbols = top
+    type_id = symbols[remaining % len(symbols)]
+    if type_id == T_DOUBLE:
+        return 8 - (end - pos)
+    if type_id == T_STRING:
+        after = _varint_end(buf, pos, end)
+        if after is not None:
+            return after + _varint_at(buf, pos)[0] - end
+    # Varints are read a byte at a time
+    return 1
+
+# array.array typecodes for the struct formats of numeric list elements
+_array_codes = {}
+for _fmt, _candidates in [('B', 'B'), ('h', 'h'), ('i', 'il'), ('q', 'lq'), ('d', 'd')]:
+    for _code in _candidates:
+        try:
+            if array(_code).itemsize == _fixed_sizes[_fmt]:
+                _array_codes[_fmt] = _code
                 break
+        except ValueError:
+            pass
+
+_numpy_codes = {
+    'B' : 'u1',
+    'h' : 'i2',
+    'i' : 'i4',
+    'q' : 'i8',
+    'd' : 'f8',
+}
 
-            if delta == 0:
-                tag, = unpack('!H', stream.read(2))
-            else:
-                tag = delta + last_field_id
+if numpy is None:
+    _array_types = (array, )
+else:
+    _array_types = (array, numpy.ndarray)
+
+_little_endian = sys.byteorder == 'little'
+
+def _load_fixed_array(buf, pos, count, fmt):
+    """Decode count big-endian numbers of a struct format character into a
+    numpy array, or an array.array when numpy isn't installed"""
+    end = pos + _fixed_sizes[fmt] * count
+    if end > len(buf):
+        raise IndexError(end)
+    if numpy is not None:
+        return numpy.frombuffer(buf, '>' + _numpy_codes[fmt], count, pos).astype(_numpy_codes[fmt])
+    code = _array_codes.get(fmt)
+    if code is None:
+        return list(struct.unpack_from('!%d%s' % (count, fmt), buf, pos))
+    values = array(code)
+    values.fromstring(buf[pos:end])
+    if _little_endian and _fixed_sizes[fmt] > 1:
+        values.byteswap()
+    return values
+
+def _dump_fixed_array(values, fmt):
+    """Encode a numpy array or array.array as big-endian numbers"""
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.astype('>' + _numpy_codes[fmt]).tostring()
+    code = _array_codes.get(fmt)
+    if code is None:
+        return pack('!%d%s' % (len(values), fmt), *values)
+    values = array(code, values)
+    if _little_endian and _fixed_sizes[fmt] > 1:
+        values.byteswap()
+    return values.tostring()
+
+def _load_varint_array(buf, pos, count, fmt):
+    """Decode count zigzag varints into a numpy array, or an array.array
+    when numpy isn't installed
+
+    Returns the array and the offset just past the last varint.
+    """
+    if numpy is not None:
+        if count == 0:
+            return numpy.zeros(0, _numpy_codes[fmt]), pos
+        # A 64 bit varint takes at most ten bytes:
+        limit = min(len(buf) - pos, count * 10)
+        if limit <= 0:
+            raise IndexError(pos)
+        data = numpy.frombuffer(buf, numpy.uint8, limit, pos)
+        ends = numpy.flatnonzero(data < 0x80)[:count]
+        if len(ends) < count:
+            raise IndexError(pos + limit)
+        length = int(ends[-1]) + 1
+        starts = numpy.empty(count, numpy.intp)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        shifts = (numpy.arange(length) - numpy.repeat(starts, ends - starts + 1)) * 7
+        parts = (data[:length].astype(numpy.uint64) & numpy.uint64(0x7f)) << shifts.astype(numpy.uint64)
+        zigzag = numpy.add.reduceat(parts, starts)
+        values = (zigzag >> numpy.uint64(1)).view(numpy.int64) ^ -(zigzag & numpy.uint64(1)).view(numpy.int64)
+        return values.astype(_numpy_codes[fmt]), pos + length
+    values = []
+    for i in xrange(count):
+        num, pos = _varint_at(buf, pos)
+        values.append((num >> 1) ^ -(num & 1))
+    code = _array_codes.get(fmt)
+    if code is not None:
+        values = array(code, values)
+    return values, pos
+
+def _dump_varint_array(values, fmt):
+    """Encode numbers as zigzag varints, vectorized for numpy arrays"""
+    shift = 63 if fmt == 'q' else 31
+    if numpy is None or not isinstance(values, numpy.ndarray):
+        out = bytearray()
+        for num in values:
+            _write_varint(out, (num << 1) ^ (num >> shift))
+        return out
+    if not len(values):
+        return ''
+    signed = values.astype(numpy.int64)
+    zigzag = ((signed << 1) ^ (signed >> shift)).view(numpy.uint64)
+    lengths = numpy.ones(len(zigzag), numpy.intp)
+    for k in xrange(1, 10):
+        lengths += zigzag >= numpy.uint64(1 << (7 * k))
+    ends = numpy.cumsum(lengths)
+    starts = ends - lengths
+    out = numpy.empty(int(ends[-1]), numpy.uint8)
+    for k in xrange(int(lengths.max())):
+        mask = lengths > k
+        byte = ((zigzag[mask] >> numpy.uint64(7 * k)) & numpy.uint64(0x7f)).astype(numpy.uint8)
+        more = (lengths[mask] > k + 1).astype(numpy.uint8) << 7
+        out[starts[mask] + k] = byte | more
+    return out.tostring()
+
+# Types encoded as zigzag varints
+_varint_types = frozenset([T_I16, T_I32, T_I64])
 
-            name, field = tag_to_field[tag]
-            if the_type == SYM_BOOL_TRUE or the_type == SYM_BOOL_FALSE:
-                vals[name] = the_type == SYM_BOOL_TRUE
+class CompactCodec(Codec):
+    """Thrift Compact Encoding"""
+    def _scan(self, buf, pos, stack):
+        return _compact_scan(buf, pos, stack)
+
+    def _scan_need(self, buf, pos, stack):
+        return _compact_scan_need(buf, pos, stack)
+
+    def _dump_message_header(self, out, name, message_type, seqid):
+        out.append(COMPACT_PROTOCOL_ID)
+        out.append((message_type << 5) | COMPACT_VERSION)
+        _write_varint(out, seqid & 0xffffffff)
+        _write_varint(out, len(name))
+        out += name
+
+    def _load_message_header(self, buf, pos):
+        if ord(buf[pos]) != COMPACT_PROTOCOL_ID:
+            raise Error("bad protocol id: 0x%x" % (ord(buf[pos]), ))
+        version_type = ord(buf[pos + 1])
+        if version_type & COMPACT_VERSION_MASK != COMPACT_VERSION:
+            raise Error("bad message version: %d" % (version_type & COMPACT_VERSION_MASK, ))
+        seqid, pos = _varint_at(buf, pos + 2)
+        if seqid > 0x7fffffff:
+            seqid -= 1 << 32
+        size, pos = _varint_at(buf, pos)
+        return (buf[pos:pos + size], version_type >> 5, seqid), pos + size
+
+    def _reset_plans(self):
+        super(CompactCodec, self)._reset_plans()
+        self._namespace['_write_varint'] = _write_varint
+        self._namespace['_load_varint_array'] = _load_varint_array
+        self._namespace['_dump_varint_array'] = _dump_varint_array
+
+    def _emit_dump_fields(self, src, thrift_type, splice=False):
+        # The tag delta in each field header is known while generating the
+        # encoder until an optional field may have been left out; after
+        # that it is tracked at run time in "last".
+        last = 0
+        for name, field in _sorted_fields(thrift_type):
+            value = self._emit_field_value(src, name, field, splice)
+            if _optional(field):
+                if last is not None:
+                    src.line('last = %d' % (last, ))
+                src.line('if %s is not None:' % (value, ))
+                src.indent()
+            is_bool = field.type.type_id == T_BOOL
+            if last is not None:
+                delta = field.tag - last
+                if 0 < delta <= 15:
+                    headers = [chr((delta << 4) | the_type) for the_type in (SYM_BOOL_TRUE, SYM_BOOL_FALSE, field.type.type_id)]
+                else:
+                    headers = [pack('!BH', the_type, field.tag) for the_type in (SYM_BOOL_TRUE, SYM_BOOL_FALSE, field.type.type_id)]
+                if is_bool:
+                    src.line('out += %r if %s else %r' % (headers[0], value, headers[1]))
+                else:
+                    src.line('out += %r' % (headers[2], ))
             else:
-                vals[name] = self.load(field.type, stream)
-            last_field_id = tag
-        return thrift_type(**vals)
-
-    def _load_map(self, thrift_type, stream):
-        sz = self._load_varint(stream)
-        result = thrift_type()
-        if sz > 0:
-            kv_type = ord(stream.read(1))
-            for i in xrange(sz):
-                key = self.load(thrift_type.key_type, stream)
-                value = self.load(thrift_type.value_type, stream) 
-                result[key] = value
-        return result
-
-    def _load_seq(self, thrift_type, stream):
-        """Load a sequence container from a stream"""
-        size_type = ord(stream.read(1))
-        size = (size_type >> 4) & 0x0f
-        type = size_type & 0x0f
-        if size == 15:
-            size = _load_varint(stream)
+                the_type = '(%d if %s else %d)' % (SYM_BOOL_TRUE, value, SYM_BOOL_FALSE) if is_bool else str(field.type.type_id)
+                src.line('if 0 < %d - last <= 15:' % (field.tag, ))
+                src.line('    out.append(((%d - last) << 4) | %s)' % (field.tag, the_type))
+                src.line('else:')
+                src.line('    out += %s.pack(%s, %d)' % (src.struct('!BH'), the_type, field.tag))
+            if not is_bool:
+                self._emit_field_dump(src, name, field, value, splice)
+            if _optional(field):
+                src.line('last = %d' % (field.tag, ))
+                src.dedent()
+                last = None
+            else:
+                last = field.tag
+        src.line('out.append(%d)' % (SYM_STOP, ))
+
+    def _emit_field_loop(self, src, fields, emit_case):
+        """Emit a loop over the field headers of a struct, calling
+        emit_case(case, header_value) for each known field"""
+        src.line('tag = 0')
+        src.line('while 1:')
+        src.indent()
+        src.line('delta_type = ord(buf[pos])')
+        src.line('pos += 1')
+        src.line('the_type = delta_type & 0x0f')
+        src.line('if the_type == %d:' % (SYM_STOP, ))
+        src.line('    break')
+        src.line('if delta_type & 0xf0:')
+        src.line('    tag += delta_type >> 4')
+        src.line('else:')
+        src.line('    tag, = %s.unpack_from(buf, pos)' % (src.struct('!H'), ))
+        src.line('    pos += 2')
+        def emit_field_case(case):
+            # Booleans are carried in the type of the field header:
+            if case[1].type.type_id == T_BOOL:
+                emit_case(case, '(the_type == %d)' % (SYM_BOOL_TRUE, ))
+            else:
+                emit_case(case, None)
+        self._emit_tag_switch(src, 'tag', fields, emit_field_case)
+        src.dedent()
+
+    def _emit_dump_bool(self, src, thrift_type, value):
+        src.line('out.append(%d if %s else %d)' % (SYM_BOOL_TRUE, value, SYM_BOOL_FALSE))
+
+    def _emit_load_bool(self, src, thrift_type, target):
+        src.line('%s = buf[pos] == %r' % (target, chr(SYM_BOOL_TRUE)))
+        src.line('pos += 1')
+
+    def _emit_dump_byte(self, src, thrift_type, value):
+        src.line('out.append(%s)' % (value, ))
+
+    def _emit_load_byte(self, src, thrift_type, target):
+        src.line('%s = ord(buf[pos])' % (target, ))
+        src.line('pos += 1')
+
+    def _emit_dump_double(self, src, thrift_type, value):
+        src.line('out += %s.pack(%s)' % (src.struct('!d'), value))
+
+    def _emit_load_double(self, src, thrift_type, target):
+        src.line('%s, = %s.unpack_from(buf, pos)' % (target, src.struct('!d')))
+        src.line('pos += 8')
+
+    def _emit_dump_varint(self, src, value):
+        src.line('if %s < 0x80:' % (value, ))
+        src.line('    out.append(%s)' % (value, ))
+        src.line('else:')
+        src.line('    _write_varint(out, %s)' % (value, ))
+
+    def _emit_dump_i32(self, src, thrift_type, value):
+        src.line('%s = (%s << 1) ^ (%s >> 31)' % (value, value, value))
+        self._emit_dump_varint(src, value)
+
+    _emit_dump_i16 = _emit_dump_i32
+
+    def _emit_dump_i64(self, src, thrift_type, value):
+        src.line('%s = (%s << 1) ^ (%s >> 63)' % (value, value, value))
+        self._emit_dump_varint(src, value)
+
+    def _emit_load_varint(self, src, target):
+        src.line('%s = ord(buf[pos])' % (target, ))
+        src.line('pos += 1')
+        src.line('if %s > 0x7f:' % (target, ))
+        src.line('    %s, pos = _read_varint(buf, pos, %s)' % (target, target))
+
+    def _emit_skip_unknown(self, src):
+        src.line('if the_type > %d:' % (SYM_BOOL_TRUE, ))
+        src.line('    pos = _compact_skip(buf, pos, the_type)')
+
+    def _emit_skip_varint(self, src):
+        src.line('while buf[pos] > %r:' % (chr(0x7f), ))
+        src.line('    pos += 1')
+        src.line('pos += 1')
+
+    def _emit_skip_i32(self, src, thrift_type):
+        self._emit_skip_varint(src)
+
+    _emit_skip_i16 = _emit_skip_i32
+    _emit_skip_i64 = _emit_skip_i32
+
+    def _emit_skip_byte(self, src, thrift_type):
+        src.line('pos += 1')
+
+    _emit_skip_bool = _emit_skip_byte
+
+    def _emit_skip_double(self, src, thrift_type):
+        src.line('pos += 8')
+
+    def _emit_skip_string(self, src, thrift_type):
+        size = src.local('n')
+        self._emit_load_varint(src, size)
+        src.line('pos += %s' % (size, ))
+
+    def _emit_skip_map(self, src, thrift_type):
+        size = src.local('n')
+        self._emit_load_varint(src, size)
+        src.line('if %s:' % (size, ))
+        src.indent()
+        src.line('pos += 1')
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_skip(src, thrift_type.key_type)
+        self._emit_skip(src, thrift_type.value_type)
+        src.dedent()
+        src.dedent()
+
+    def _emit_skip_seq(self, src, thrift_type):
+        size = src.local('n')
+        src.line('%s = ord(buf[pos]) >> 4' % (size, ))
+        src.line('pos += 1')
+        src.line('if %s == 15:' % (size, ))
+        src.indent()
+        self._emit_load_varint(src, size)
+        src.dedent()
         value_type = thrift_type.value_type
-        for i in xrange(size):
-            yield self.load(value_type, stream)
-
-    def _load_list(self, thrift_type, stream):
-        """Load a list from a stream"""
-        return list(self._load_seq(thrift_type, stream))
-
-    def _load_set(self, thrift_type, stream):
-        """Load a set from a stream"""
-        return set(self._load_seq(thrift_type, stream))
-
-    def _load_varint(self, stream):
-        """Load a varint"""
-        num = 0
-        shift = 0 
-        while True:
-            byte = ord(stream.read(1))
-            num |= (byte & 0x7f) << shift
-            shift += 7
-            if (byte & 0x80) == 0:
-                break
-        return num
-    
+        if value_type.type_id in (T_DOUBLE, T_BOOL, T_BYTE):
+            src.line('pos += %d * %s' % (_binary_sizes[value_type.type_id], size))
+            return
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_skip(src, value_type)
+        src.dedent()
+
+    def _emit_load_i32(self, src, thrift_type, target):
+        self._emit_load_varint(src, target)
+        src.line('%s = (%s >> 1) ^ -(%s & 1)' % (target, target, target))
+
+    _emit_load_i16 = _emit_load_i32
+    _emit_load_i64 = _emit_load_i32
+
+    def _emit_dump_bytes(self, src, value):
+        size = src.local('n')
+        src.line('%s = len(%s)' % (size, value))
+        self._emit_dump_varint(src, size)
+        src.line('out += %s' % (value, ))
+
+    def _emit_load_bytes(self, src, target):
+        size = src.local('n')
+        self._emit_load_varint(src, size)
+        src.line('%s = buf[pos:pos + %s]' % (target, size))
+        src.line('pos += %s' % (size, ))
+
+    def _emit_dump_map(self, src, thrift_type, value):
+        key_type = thrift_type.key_type
+        value_type = thrift_type.value_type
+        size = src.local('n')
+        src.line('%s = len(%s)' % (size, value))
+        self._emit_dump_varint(src, size)
+        src.line('if %s:' % (size, ))
+        src.indent()
+        kv_type_id = (_type_to_symbol[key_type.type_id] << 4) | _type_to_symbol[value_type.type_id]
+        src.line('out.append(%d)' % (kv_type_id, ))
+        key, item = src.local('k'), src.local('v')
+        src.line('for %s, %s in %s.iteritems():' % (key, item, value))
+        src.indent()
+        self._emit_dump(src, key_type, key)
+        self._emit_dump(src, value_type, item)
+        src.dedent()
+        src.dedent()
+
+    def _emit_load_map(self, src, thrift_type, target):
+        size, key, item = src.local('n'), src.local('k'), src.local('v')
+        self._emit_load_varint(src, size)
+        src.line('%s = %s()' % (target, src.const(thrift_type, 'map')))
+        src.line('if %s:' % (size, ))
+        src.indent()
+        src.line('pos += 1')
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_load(src, thrift_type.key_type, key)
+        self._emit_load(src, thrift_type.value_type, item)
+        src.line('%s[%s] = %s' % (target, key, item))
+        src.dedent()
+        src.dedent()
+
+    def _emit_dump_seq(self, src, thrift_type, value):
+        value_type = thrift_type.value_type
+        elem_type = value_type.type_id
+        size = src.local('n')
+        src.line('%s = len(%s)' % (size, value))
+        src.line('if %s <= 14:' % (size, ))
+        src.line('    out.append((%s << 4) | %d)' % (size, elem_type))
+        src.line('else:')
+        src.line('    out.append(%d)' % (0xF0 | elem_type, ))
+        src.line('    _write_varint(out, %s)' % (size, ))
+        fmt = _binary_fixed_formats.get(elem_type)
+        if fmt is not None:
+            src.line('if %s.__class__ in _ARRAY_TYPES:' % (value, ))
+            if elem_type in _varint_types:
+                src.line('    out += _dump_varint_array(%s, %r)' % (value, fmt))
+            else:
+                src.line('    out += _dump_fixed_array(%s, %r)' % (value, fmt))
+            src.line('else:')
+            src.indent()
+        if elem_type == T_DOUBLE:
+            # Pack every element of a double sequence in one call:
+            src.line("out += _pack('!%%dd' %% %s, *%s)" % (size, value))
+        else:
+            item = src.local('v')
+            src.line('for %s in %s:' % (item, value))
+            src.indent()
+            self._emit_dump(src, value_type, item)
+            src.dedent()
+        if fmt is not None:
+            src.dedent()
+
+    def _emit_load_seq(self, src, thrift_type, target):
+        value_type = thrift_type.value_type
+        container = 'list' if thrift_type.type_id == T_LIST else 'set'
+        size = src.local('n')
+        src.line('%s = ord(buf[pos]) >> 4' % (size, ))
+        src.line('pos += 1')
+        src.line('if %s == 15:' % (size, ))
+        src.indent()
+        self._emit_load_varint(src, size)
+        src.dedent()
+        fmt = _binary_fixed_formats.get(value_type.type_id)
+        if self.arrays and container == 'list' and fmt is not None:
+            if value_type.type_id in _varint_types:
+                src.line('%s, pos = _load_varint_array(buf, pos, %s, %r)' % (target, size, fmt))
+            else:
+                src.line('%s = _load_fixed_array(buf, pos, %s, %r)' % (target, size, fmt))
+                src.line('pos += %d * %s' % (_fixed_sizes[fmt], size))
+            return
+        if value_type.type_id == T_DOUBLE:
+            src.line("%s = %s(_unpack_from('!%%dd' %% %s, buf, pos))" % (target, container, size))
+            src.line('pos += 8 * %s' % (size, ))
+            return
+        item = src.local('v')
+        src.line('%s = %s()' % (target, container))
+        src.line('for _ in xrange(%s):' % (size, ))
+        src.indent()
+        self._emit_load(src, value_type, item)
+        src.line('%s.%s(%s)' % (target, 'append' if container == 'list' else 'add', item))
+        src.dedent()
 
 def long_to_zigzag(num):
     """Convert a long to a zigzag integer"""
@@ -483,6 +2419,7 @@ def zigzag_to_int(num):
     return (num >> 1) ^ -(num & 1) 
 
 class Type(object):
+    __slots__ = ()
     type_id = None
 
 class I64Type(Type):
@@ -522,27 +2459,48 @@ class BooleanType(Type):
     type_id = T_BOOL
 
 class Field(object):
-    """A Struct Field"""
-    def __init__(self, type, tag, initial, optional):
+    """A Struct Field
+
+    Decoded strings of fields with intern, including their map keys and
+    set members, are shared through the codec's InternTable.
+    """
+    def __init__(self, type, tag, initial, optional, intern=False):
         self.type = type
-        if tag <= 0:
-            raise ValueError("expected tag to be greater than 0")
+        if tag < 0:
+            raise ValueError("expected tag to be at least 0")
         self.tag = tag
         self.initial = initial
         self.optional = optional
+        self.intern = intern
 
     def __repr__(self):
         return 'Field(%r, %r, %r, %r)' % (self.type, self.tag, self.initial, self.optional)
 
 class StructType(type):
     """Metaclass for structs"""
-    def __init__(self, name, bases, dictionary):
-        self.__fields = {}
+    # Bumped whenever a struct's fields change so codecs drop stale plans
+    revision = 0
+
+    def __new__(mcs, name, bases, dictionary):
+        fields = {}
         for key, value in dictionary.items():
             if isinstance(value, Field):
-                dictionary.pop(key)
-                self.add_field(key, value)
-        super(StructType, self).__init__(name, bases, dictionary)
+                fields[key] = dictionary.pop(key)
+        if any(getattr(base, '_compact', False) for base in bases):
+            # Compact structs keep their fields in slots.  Fields added
+            # after the class is created need their names listed in the
+            # class's own __slots__.
+            slots = set(dictionary.get('__slots__', ()))
+            slots.update(fields)
+            dictionary['__slots__'] = tuple(sorted(slots))
+        cls = super(StructType, mcs).__new__(mcs, name, bases, dictionary)
+        cls.__fields = {}
+        cls._revision = StructType.revision
+        if cls._compact:
+            cls._reset_compact()
+        for key, value in fields.iteritems():
+            cls.add_field(key, value)
+        return cls
 
     def add_field(self, name, field):
         if name in self.__fields:
@@ -550,20 +2508,87 @@ class StructType(type):
         for field_i in self.__fields.itervalues():
             if field.tag == field_i.tag:
                 raise ValueError("Field with tag %r already defined" % (field.tag, ))
+        if self._compact:
+            if not isinstance(getattr(self, name, None), MemberDescriptorType):
+                raise ValueError("compact struct %s has no slot for field %r" % (self.__name__, name))
+            self._reset_compact()
         self.__fields[name] = field
+        StructType.revision += 1
+        self._revision = StructType.revision
 
     def fields(self):
         return self.__fields
 
+    def _reset_compact(self):
+        """Install stand-ins which generate the compact struct methods the
+        first time one of them is called"""
+        def make(cls, *values):
+            cls._compile_compact()
+            return cls._make(*values)
+        self._make = classmethod(make)
+        for name in ('__eq__', '__ne__', '__repr__'):
+            setattr(self, name, _generate_on_first_call(name))
+
+    def _compile_compact(self):
+        """Generate the positional constructor, __eq__, __ne__ and __repr__
+        of a compact struct from its fields"""
+        if isinstance(vars(self).get('_make'), staticmethod):
+            # Already generated
+            return
+        namespace = {'_cls': self}
+        exec compile('\n'.join(self._compact_source()) + '\n', '<thriftit %s compact struct>' % (self.__name__, ), 'exec') in namespace
+        self._set_compact(namespace)
+
+    def _compact_source(self):
+        """Get the lines of source defining the compact struct methods,
+        given the class as _cls"""
+        names = [name for name, _ in _sorted_fields(self)]
+        lines = ['def _make(%s):' % (', '.join(names), ),
+                 '    self = _cls.__new__(_cls)']
+        lines.extend('    self.%s = %s' % (name, name) for name in names)
+        lines.append('    return self')
+        lines.append('def __eq__(self, other):')
+        lines.append('    return ' + ' and '.join(['type(other) is _cls'] +
+            ['self.%s == other.%s' % (name, name) for name in names]))
+        lines.append('def __ne__(self, other):')
+        lines.append('    return not self == other')
+        lines.append('def __repr__(self):')
+        lines.append('    return %r %% ({%s}, )' % (self.__name__ + '(%r)',
+            ', '.join('%r: self.%s' % (name, name) for name in names)))
+        return lines
+
+    def _set_compact(self, namespace):
+        """Install the compact struct methods defined in namespace"""
+        self._make = staticmethod(namespace['_make'])
+        for name in ('__eq__', '__ne__', '__repr__'):
+            setattr(self, name, namespace[name])
+
     def __repr__(self):
         return '<%s.%s fields:%r at 0x%x>' % (self.__module__, self.__name__, self.fields(), id(self))
 
+def _generate_on_first_call(name):
+    """A stand-in for a generated compact struct method"""
+    def method(self, *args):
+        type(self)._compile_compact()
+        return getattr(self, name)(*args)
+    method.__name__ = name
+    return method
+
 class Struct(Type):
     """Struct Type (things with named, tagged fields)"""
     __metaclass__ = StructType
+    __slots__ = ()
     type_id = T_STRUCT
+    _compact = False
+    _frozen = False
 
     def __init__(self, *args, **kwargs):
+        for field_name, value in self._field_values(args, kwargs):
+            setattr(self, field_name, value)
+
+    @classmethod
+    def _field_values(cls, args, kwargs):
+        """Get the (name, value) of every field from constructor arguments"""
         if (len(args) > 1) or (args and kwargs):
             raise TypeError("unexpected arguments")
         if args:
@@ -571,11 +2596,12 @@ class Struct(Type):
         else:
             values = kwargs
 
-        for field_name, field in type(self).fields().iteritems():
-            value = values.pop(field_name, field.initial())
-            setattr(self, field_name, value)
+        result = []
+        for field_name, field in cls.fields().iteritems():
+            result.append((field_name, values.pop(field_name, field.initial())))
         for key in kwargs:
             raise TypeError("unexpected keyword argument %r" % (key, ))
+        return result
 
     def __repr__(self):
         class_name = self.__class__.__name__
@@ -606,6 +2632,785 @@ class Exception(Struct, Exception):
     """Exception structures"""
     type_id = T_STRUCT
 
+class CompactStruct(Struct):
+    """Struct whose instances keep their fields in __slots__
+
+    Subclasses get a slot for every field declared in the class body, a
+    positional constructor, _make, taking the field values in tag order,
+    and __eq__/__repr__ which read the slots directly.
+    """
+    __slots__ = ()
+    __hash__ = None
+    _compact = True
+
+class FrozenStruct(Struct):
+    """Struct whose instances are immutable and hashable
+
+    Frozen structs compare equal when their fields are, so they can be map
+    keys and set members.  Codecs save the encoding of each instance the
+    first time it's encoded, and copy the saved bytes whenever it's
+    encoded again, on its own or inside another struct.  Containers held
+    by a frozen struct must not be changed either.
+    """
+    _frozen = True
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(self._field_values(args, kwargs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is frozen" % (type(self).__name__, ))
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is frozen" % (type(self).__name__, ))
+
+    def replace(self, **changes):
+        """Get a copy with some fields changed"""
+        values = dict((name, getattr(self, name)) for name in type(self).fields())
+        for name, value in changes.iteritems():
+            if name not in values:
+                raise TypeError("unexpected keyword argument %r" % (name, ))
+            values[name] = value
+        return type(self)(**values)
+
+    def _key(self):
+        return tuple(_hashable(getattr(self, name)) for name, _ in _sorted_fields(type(self)))
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self is other or self._key() == other._key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        value = self.__dict__.get('_FrozenStruct__hash')
+        if value is None:
+            value = self.__dict__['_FrozenStruct__hash'] = hash((type(self), self._key()))
+        return value
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in type(self).fields())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+def _hashable(value):
+    """Get a hashable equivalent of a field value"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((_hashable(key), _hashable(item)) for key, item in value.iteritems())
+    if isinstance(value, array) or (numpy is not None and isinstance(value, numpy.ndarray)):
+        # Numeric lists decoded by codecs with arrays
+        return tuple(value.tolist())
+    return value
+
+class StructPool(object):
+    """A free list of struct instances to decode into with
+    Codec.load_into, so a decoding loop can recycle instances instead of
+    allocating new ones
+
+    For example:
+
+        pool = StructPool(Event)
+        for buf in bufs:
+            event = pool.loads(codec, buf)
+            handle(event)
+            pool.put(event)
+    """
+    def __init__(self, thrift_type, max_size=1024):
+        self.thrift_type = thrift_type
+        self.max_size = max_size
+        self._free = []
+
+    def get(self):
+        """Get a free instance, or a new one if there are none"""
+        try:
+            return self._free.pop()
+        except IndexError:
+            return self.thrift_type()
+
+    def put(self, instance):
+        """Return an instance which is no longer used to the pool"""
+        if type(instance) is not self.thrift_type:
+            raise TypeError("expected a %s" % (self.thrift_type.__name__, ))
+        if len(self._free) < self.max_size:
+            self._free.append(instance)
+
+    def loads(self, codec, buf, offset=0):
+        """Decode the struct encoded in buf at offset into a free instance"""
+        instance = self.get()
+        codec.load_into(instance, buf, offset)
+        return instance
+
+    def __len__(self):
+        return len(self._free)
+
+class _Reference(Struct):
+    """The encoding of a struct repeated in a value by a reference tracking
+    codec: the index of its first appearance, counting structs in the
+    order they start"""
+    index = Field(I32Type, 32767, int, False)
+
+class LazyStruct(object):
+    """A view of an encoded struct which decodes each field on first access
+
+    Nested structs are returned as views too.  Encoding a view with a codec
+    of the same wire format copies the original bytes of every field that
+    was never read or assigned.  Views keep a reference to the buffer they
+    were read from.
+    """
+    __slots__ = ('_codec', '_type', '_buf', '_offsets', '_values')
+
+    def __init__(self, codec, thrift_type, buf, offsets, values):
+        object.__setattr__(self, '_codec', codec)
+        object.__setattr__(self, '_type', thrift_type)
+        object.__setattr__(self, '_buf', buf)
+        object.__setattr__(self, '_offsets', offsets)
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name):
+        values = self._values
+        if name in values:
+            return values[name]
+        field = self._type.fields().get(name)
+        if field is None:
+            raise AttributeError(name)
+        offsets = self._offsets.get(name)
+        if offsets is None:
+            value = field.initial()
+        elif field.type.type_id == T_STRUCT:
+            value = self._codec._view(field.type, self._buf, offsets[0])[0]
+        else:
+            value = self._codec._run(self._codec._function(field.type, 'load'), self._buf, offsets[0])[0]
+        values[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        if name not in self._type.fields():
+            raise AttributeError(name)
+        self._values[name] = value
+
+    def _splice(self, out):
+        self._codec._function(self._type, 'splice')(self, out)
+
+    def materialize(self):
+        """Decode the remaining fields and return a regular struct"""
+        values = {}
+        for name in self._type.fields():
+            value = getattr(self, name)
+            if isinstance(value, LazyStruct):
+                value = value.materialize()
+            values[name] = value
+        return self._type(**values)
+
+    def __repr__(self):
+        return '<LazyStruct of %s decoded:%r>' % (self._type.__name__, self._values)
+
+class StreamDecoder(object):
+    """Decode objects from data pushed to it as it arrives, as from a
+    non-blocking socket
+
+    feed() returns the objects completed by each piece of data.  Partial
+    objects are kept between calls; without framing, the progress of
+    finding where the object ends is kept too, so each byte is scanned
+    once however the data is split up.  Each object is decoded once it's
+    complete, straight from the data buffered.
+
+    For example, from an asyncore dispatcher:
+
+        def handle_read(self):
+            for message in self.decoder.feed(self.recv(65536)):
+                self.handle_message(message)
+    """
+    def __init__(self, codec, thrift_type, framing='none'):
+        self.codec = codec
+        self.thrift_type = thrift_type
+        self.framed = _framed(framing)
+        self._function = codec._function(thrift_type, 'load')
+        self._data = bytearray()
+        # Without framing: the scan stack of the object being read, and
+        # how far it has got
+        self._stack = None
+        self._scanned = 0
+
+    def feed(self, data):
+        """Add data, returning a list of the objects it completes"""
+        self._data += data
+        buf = buffer(self._data)
+        end = len(buf)
+        pos = 0
+        results = []
+        while pos < end:
+            if self.framed:
+                if end - pos < 4:
+                    break
+                size, = _S_I.unpack_from(buf, pos)
+                if end - pos - 4 < size:
+                    break
+                value, stop = self.codec._run(self._function, buf, pos + 4)
+                if stop != pos + 4 + size:
+                    raise Error("record of %d bytes decoded as %d" % (size, stop - pos - 4))
+                pos = stop
+            else:
+                if self._stack is None:
+                    self._stack = _scan_stack(self.thrift_type)
+                    self._scanned = pos
+                self._scanned = self.codec._scan(buf, self._scanned, self._stack)
+                if self._stack:
+                    break
+                self._stack = None
+                value, pos = self.codec._run(self._function, buf, pos)
+            results.append(value)
+        if pos:
+            del buf
+            del self._data[:pos]
+            self._scanned -= pos
+        return results
+
+    def pending(self):
+        """Get the number of bytes of an incomplete object held"""
+        return len(self._data)
+
+    def close(self):
+        """Check the data ended at the end of an object"""
+        if self._data:
+            raise TruncatedError("data ends in the middle of an object")
+
+def _scan_stack(thrift_type):
+    """Get the initial scan stack of a value of a type"""
+    if thrift_type.type_id == T_STRUCT:
+        return [['struct']]
+    return [[1, (_type_to_symbol[thrift_type.type_id], )]]
+
+_COLUMNS_MAGIC = 'TCOL'
+# magic, rows, columns
+_S_columns = struct.Struct('!4sII')
+# tag, type_id, nullable, size
+_S_column = struct.Struct('!HBBI')
+
+# Array formats of the fixed width columns
+_column_formats = dict(_binary_fixed_formats)
+_column_formats[T_BOOL] = 'B'
+
+def _dump_bitmap(flags):
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    return bitmap
+
+def _load_bitmap(buf, pos, count):
+    bitmap = bytearray(buf[pos:pos + (count + 7) // 8])
+    return [bool(bitmap[i >> 3] & (1 << (i & 7))) for i in xrange(count)]
+
+class ColumnBatch(object):
+    """A batch of structs encoded by Codec.dumps_columns
+
+    Only the directory of columns is read up front.  column() decodes one
+    field of every row, numbers to a numpy array (or array.array), so a
+    few fields of a large batch can be scanned without building any
+    structs.  Indexing or iterating a batch builds the rows as structs.
+    Columns of fields the struct doesn't have are ignored.
+    """
+    def __init__(self, codec, thrift_type, buf):
+        self.codec = codec
+        self.thrift_type = thrift_type
+        self._buf = buf
+        try:
+            magic, self._count, columns = _S_columns.unpack_from(buf, 0)
+        except struct.error:
+            raise TruncatedError("unexpected end of buffer")
+        if magic != _COLUMNS_MAGIC:
+            raise Error("not a column batch")
+        by_tag = dict((field.tag, (name, field)) for name, field in thrift_type.fields().iteritems())
+        # name -> (position of the column data, nullable)
+        self._columns = {}
+        pos = _S_columns.size
+        for i in xrange(columns):
+            try:
+                tag, type_id, nullable, size = _S_column.unpack_from(buf, pos)
+            except struct.error:
+                raise TruncatedError("unexpected end of buffer")
+            pos += _S_column.size
+            if tag in by_tag:
+                name, field = by_tag[tag]
+                if field.type.type_id != type_id:
+                    raise Error("column %r has type %d, not %d" % (name, type_id, field.type.type_id))
+                self._columns[name] = pos, bool(nullable)
+            pos += size
+        if pos > len(buf):
+            raise TruncatedError("unexpected end of buffer")
+        self._values = {}
+        self._masks = {}
+        self._rows = {}
+
+    def __len__(self):
+        return self._count
+
+    def mask(self, name):
+        """Get a list of whether each row has a value for an optional field,
+        or None for other fields"""
+        if name not in self._masks:
+            pos, nullable = self._column(name)
+            self._masks[name] = _load_bitmap(self._buf, pos, self._count) if nullable else None
+        return self._masks[name]
+
+    def column(self, name):
+        """Get the values of a field in every row
+
+        Numbers and bools are returned as a numpy array, or an array.array
+        when numpy isn't installed, with 0 for missing optional values
+        (see mask).  Other fields are returned as lists, with None for
+        missing values.
+        """
+        values = self._values.get(name)
+        if values is not None:
+            return values
+        pos, nullable = self._column(name)
+        count = self._count
+        if nullable:
+            pos += (count + 7) // 8
+        field_type = self.thrift_type.fields()[name].type
+        fmt = _column_formats.get(field_type.type_id)
+        if fmt is not None:
+            values = _load_fixed_array(self._buf, pos, count, fmt)
+            if field_type.type_id == T_BOOL:
+                values = values.astype(bool) if numpy is not None else [bool(value) for value in values]
+        else:
+            offsets = _load_fixed_array(self._buf, pos, count + 1, 'i').tolist()
+            pos += 4 * (count + 1)
+            if offsets[-1] + pos > len(self._buf):
+                raise TruncatedError("unexpected end of buffer")
+            values = [self._buf[pos + start:pos + end] for start, end in zip(offsets, offsets[1:])]
+            mask = self.mask(name)
+            if mask is not None:
+                values = [value if present else None for value, present in zip(values, mask)]
+            encoding = _string_encoding(field_type)
+            if field_type.type_id != T_STRING:
+                loads = self.codec.loads
+                values = [None if value is None else loads(field_type, value) for value in values]
+            elif encoding:
+                values = [None if value is None else value.decode(encoding) for value in values]
+        self._values[name] = values
+        return values
+
+    def _column(self, name):
+        if name not in self.thrift_type.fields():
+            raise KeyError(name)
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise Error("batch has no column for %r" % (name, ))
+
+    def _row_values(self, name):
+        """Get the values of a field as a list of Python values"""
+        values = self._rows.get(name)
+        if values is None:
+            values = self.column(name)
+            if not isinstance(values, list):
+                values = values.tolist()
+            mask = self.mask(name)
+            if mask is not None:
+                values = [value if present else None for value, present in zip(values, mask)]
+            self._rows[name] = values
+        return values
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        values = {}
+        for name, field in self.thrift_type.fields().iteritems():
+            if name in self._columns:
+                values[name] = self._row_values(name)[index]
+        return self.thrift_type(**values)
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+_COMPRESSED_MAGIC = 0xdc
+
+class CompressedCodec(object):
+    """Compress each encoding of another codec with zlib, using a preset
+    dictionary
+
+    Small encodings don't compress well on their own, but a dictionary of
+    the byte strings that recur across many of them, from
+    train_dictionary, lets each one refer back to it.  Each frame starts
+    with a header of a magic byte, the 4 byte id of the dictionary it was
+    compressed with (0 for none) and the length of the encoding as a
+    varint, so readers can be given several dictionaries, such as the
+    current and the previous one.
+
+    Arguments:
+    codec -- the codec to compress the encodings of
+    dictionary -- str, the dictionary to compress with, at most 32KB
+    dictionaries -- sequence of other dictionaries to decompress with
+    level -- zlib compression level
+    """
+    def __init__(self, codec, dictionary=None, dictionaries=(), level=6):
+        self.codec = codec
+        self.level = level
+        # dictionary id -> (primed compressor, primed decompressor)
+        self._dictionaries = {0: self._prime('')}
+        for a_dictionary in dictionaries:
+            self._dictionaries[dictionary_id(a_dictionary)] = self._prime(a_dictionary)
+        if dictionary is None:
+            self.dictionary_id = 0
+        else:
+            self.dictionary_id = dictionary_id(dictionary)
+            self._dictionaries[self.dictionary_id] = self._prime(dictionary)
+
+    def _prime(self, dictionary):
+        """Get a compressor and decompressor which have seen dictionary
+
+        Python 2's zlib can't set a dictionary, so the dictionary is
+        compressed first and copies of the compressor carry on from it.
+        """
+        if len(dictionary) > _zlib_window:
+            raise ValueError("dictionaries can be at most %d bytes" % (_zlib_window, ))
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        prefix = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        decompressor = zlib.decompressobj(-15)
+        decompressor.decompress(prefix)
+        return compressor, decompressor
+
+    def compress(self, data):
+        """Compress an encoding into a frame"""
+        out = bytearray(_S_BI.pack(_COMPRESSED_MAGIC, self.dictionary_id))
+        _write_varint(out, len(data))
+        compressor = self._dictionaries[self.dictionary_id][0].copy()
+        out += compressor.compress(str(data))
+        out += compressor.flush()
+        return str(out)
+
+    def decompress(self, frame):
+        """Get the encoding compressed in a frame"""
+        frame = _readable(frame)
+        try:
+            magic, the_id = _S_BI.unpack_from(frame, 0)
+            size, pos = _varint_at(frame, _S_BI.size)
+        except (struct.error, IndexError):
+            raise TruncatedError("unexpected end of buffer")
+        if magic != _COMPRESSED_MAGIC:
+            raise Error("not a compressed frame")
+        primed = self._dictionaries.get(the_id)
+        if primed is None:
+            raise Error("unknown dictionary %08x" % (the_id, ))
+        decompressor = primed[1].copy()
+        try:
+            data = decompressor.decompress(frame[pos:], max(size, 1))
+        except zlib.error, e:
+            raise Error("corrupt compressed frame: %s" % (e, ))
+        if len(data) != size or decompressor.unconsumed_tail:
+            raise Error("compressed frame has the wrong size")
+        return data
+
+    def dumps(self, thrift_type, object):
+        """Encode and compress an object"""
+        return self.compress(self.codec.dumps(thrift_type, object))
+
+    def loads(self, thrift_type, buf):
+        """Decompress and decode an object"""
+        return self.codec.loads(thrift_type, self.decompress(buf))
+
+    def dump(self, thrift_type, object, stream):
+        """Encode and compress an object to an output stream"""
+        stream.write(self.dumps(thrift_type, object))
+
+    def load(self, thrift_type, stream):
+        """Decompress and decode an object from the rest of an input stream"""
+        return self.loads(thrift_type, stream.read())
+
+    def dump_many(self, thrift_type, objects, stream):
+        """Write objects to a stream as length-prefixed frames, returning the
+        number written"""
+        count = 0
+        for obj in objects:
+            frame = self.dumps(thrift_type, obj)
+            stream.write(_S_I.pack(len(frame)) + frame)
+            count += 1
+        return count
+
+    def iter_load(self, thrift_type, stream):
+        """Iterate over the objects in a stream of length-prefixed frames"""
+        while True:
+            prefix = _read_exactly(stream, _S_I.size)
+            if not prefix:
+                return
+            if len(prefix) < _S_I.size:
+                raise TruncatedError("unexpected end of stream")
+            size, = _S_I.unpack(prefix)
+            frame = _read_exactly(stream, size)
+            if len(frame) < size:
+                raise TruncatedError("unexpected end of stream")
+            yield self.loads(thrift_type, frame)
+
+_zlib_window = 32768
+
+def dictionary_id(dictionary):
+    """Get the id of a compression dictionary written in frame headers"""
+    return zlib.crc32(dictionary) & 0xffffffff
+
+def train_dictionary(samples, size=16384, segment_size=48, gram_size=6):
+    """Build a dictionary for CompressedCodec from sample encodings
+
+    Substrings are scored by how many samples contain their gram_size
+    byte substrings, and segments of the samples are picked greedily by
+    the score of the grams they add, so the dictionary is made of the
+    content which recurs across the most records.  The best segments go
+    at the end of the dictionary, nearest the data.
+    """
+    if size > _zlib_window:
+        raise ValueError("dictionaries can be at most %d bytes" % (_zlib_window, ))
+    samples = [str(sample) for sample in samples]
+    counts = collections.defaultdict(int)
+    for sample in samples:
+        for gram in set(sample[i:i + gram_size] for i in xrange(len(sample) - gram_size + 1)):
+            counts[gram] += 1
+
+    def grams(segment):
+        return set(segment[i:i + gram_size] for i in xrange(len(segment) - gram_size + 1))
+
+    def score(segment):
+        # Only grams found in more than one sample help
+        return sum(counts[gram] for gram in grams(segment) if counts[gram] > 1)
+
+    segments = set()
+    step = max(segment_size // 2, 1)
+    for sample in samples:
+        for start in xrange(0, max(len(sample) - gram_size, 0) + 1, step):
+            segments.add(sample[start:start + segment_size])
+    heap = [(-score(segment), segment) for segment in segments]
+    heapq.heapify(heap)
+    chosen = []
+    total = 0
+    while heap and total < size:
+        negative_score, segment = heapq.heappop(heap)
+        if not negative_score:
+            break
+        # Scores fall as the grams of chosen segments are used up, so
+        # check the score is still the best before taking it:
+        current = score(segment)
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, segment))
+            continue
+        if not current:
+            break
+        chosen.append(segment)
+        total += len(segment)
+        for gram in grams(segment):
+            counts[gram] = 0
+    return ''.join(reversed(chosen))[-size:]
+
+class RecordWriter(object):
+    """Append structs to a record file
+
+    A record file holds length-prefixed records, the same framing as
+    Codec.dump_many(..., framing='length-prefixed').  Next to it, in
+    path + '.idx', is an index of the offset of each record as an 8 byte
+    big-endian integer.  Existing files are appended to.
+    """
+    def __init__(self, path, thrift_type, codec):
+        self.thrift_type = thrift_type
+        self.codec = codec
+        self._data = open(path, 'ab')
+        self._index = open(path + '.idx', 'ab')
+        self._data.seek(0, os.SEEK_END)
+        self._index.seek(0, os.SEEK_END)
+        self._offset = self._data.tell()
+        self._count = self._index.tell() // _S_Q.size
+
+    def __len__(self):
+        return self._count
+
+    def append(self, object):
+        """Append a record, returning its index"""
+        out = bytearray(4)
+        self.codec.dumps(self.thrift_type, object, out)
+        _S_I.pack_into(out, 0, len(out) - 4)
+        self._data.write(out)
+        self._index.write(_S_Q.pack(self._offset))
+        self._offset += len(out)
+        self._count += 1
+        return self._count - 1
+
+    def extend(self, objects):
+        """Append a sequence of records"""
+        for object in objects:
+            self.append(object)
+
+    def flush(self):
+        """Flush the records and then the index to disk"""
+        # The data goes first so the index never points past the end of it
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _map_file(path):
+    """Memory map a file for reading, returning a bytestring if it's empty"""
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+class RecordReader(object):
+    """Random access to the records of a file written by RecordWriter
+
+    The file and its index are memory mapped; reader[i] finds a record
+    through the index and decodes it straight from the mapping.  Slicing
+    returns a list of records.
+    """
+    def __init__(self, path, thrift_type, codec):
+        self.thrift_type = thrift_type
+        self.codec = codec
+        self._data = _map_file(path)
+        self._index = _map_file(path + '.idx')
+        self._count = len(self._index) // _S_Q.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._load(i) for i in xrange(*index.indices(self._count))]
+        return self._load(self._position(index))
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self._load(i)
+
+    def lazy(self, index):
+        """Get a LazyStruct view of a record
+
+        The view reads from the mapping, so it's only usable until the
+        reader is closed.
+        """
+        offset, size = self._record(self._position(index))
+        return self.codec._view(self.thrift_type, self._data, offset)[0]
+
+    def _position(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("record index out of range")
+        return index
+
+    def _record(self, index):
+        """Get the offset and size of a record's encoding"""
+        offset, = _S_Q.unpack_from(self._index, index * _S_Q.size)
+        if offset + 4 > len(self._data):
+            raise TruncatedError("record %d is past the end of the file" % (index, ))
+        size, = _S_I.unpack_from(self._data, offset)
+        return offset + 4, size
+
+    def _load(self, index):
+        offset, size = self._record(index)
+        value, end = self.codec.load_from(self.thrift_type, self._data, offset)
+        if end != offset + size:
+            raise Error("record %d has the wrong length" % (index, ))
+        return value
+
+    def close(self):
+        for mapping in (self._data, self._index):
+            if isinstance(mapping, mmap.mmap):
+                mapping.close()
+        self._data = self._index = ''
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CodecPool(object):
+    """A pool of processes to encode and decode big batches in
+
+    See Codec.dumps_many and Codec.loads_many.  The workers are forked
+    with a copy of the codec which has already compiled its encoders and
+    decoders for types.  Tasks refer to those types by position, so they
+    needn't be importable, but objects travel between processes by pickling
+    so their struct classes must be.
+
+    Arguments:
+    codec -- the Codec the pool is used with
+    types -- the Types the pool is used for
+    processes -- int, the number of worker processes, by default the
+        number of CPUs
+    threshold -- int, smaller batches are handled in-process
+    chunk_size -- int, the number of objects sent to a worker at a time
+    """
+    def __init__(self, codec, types=(), processes=None, threshold=4096, chunk_size=1024):
+        self.codec = codec
+        self.types = list(types)
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        for thrift_type in self.types:
+            codec._function(thrift_type, 'dump')
+            codec._function(thrift_type, 'load')
+        self._pool = multiprocessing.Pool(processes, _init_pool_worker, (codec, self.types))
+
+    def _map(self, codec, kind, thrift_type, items):
+        if codec._wire_format != self.codec._wire_format or codec.arrays != self.codec.arrays:
+            raise ValueError("the pool was made for a different codec")
+        if thrift_type in self.types:
+            thrift_type = self.types.index(thrift_type)
+        size = self.chunk_size
+        tasks = [(kind, thrift_type, items[i:i + size]) for i in xrange(0, len(items), size)]
+        results = []
+        for chunk in self._pool.imap(_pool_task, tasks):
+            results.extend(chunk)
+        return results
+
+    def close(self):
+        """Stop the worker processes once they're idle and wait for them"""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+_pool_codec = None
+_pool_types = None
+
+def _init_pool_worker(codec, types):
+    global _pool_codec, _pool_types
+    _pool_codec = codec
+    _pool_types = types
+
+def _pool_task((kind, thrift_type, items)):
+    if isinstance(thrift_type, int):
+        thrift_type = _pool_types[thrift_type]
+    if kind == 'dump':
+        return _pool_codec.dumps_many(thrift_type, items)
+    return _pool_codec.loads_many(thrift_type, items)
+
 class MapType(dict, Type):
     type_id = T_MAP
 
@@ -617,6 +3422,10 @@ class MapType(dict, Type):
         name = '%sOf%sTo%s' % (cls.__name__, key_type.__name__, value_type.__name__)
         return type(name, (cls, ), {'key_type': key_type, 'value_type': value_type})
 
+    def __reduce__(self):
+        # Subtypes are made on the fly and can't be pickled by name
+        return (dict, (dict(self), ))
+
 class _SeqType(Type):
     value_type = None
 
@@ -631,12 +3440,602 @@ class ListType(list, _SeqType):
 class SetType(set, _SeqType):
     type_id = T_SET
 
+class Method(object):
+    """A Service Method
+
+    Arguments:
+    return_type -- Type of the result, or None for methods without one
+    arguments -- dict of argument name to Field
+    exceptions -- dict of name to Field of the Exception structs the method
+        may raise
+    oneway -- bool, callers don't wait for a reply
+    """
+    def __init__(self, return_type=None, arguments=None, exceptions=None, oneway=False):
+        self.return_type = return_type
+        self.arguments = dict(arguments or {})
+        self.exceptions = dict(exceptions or {})
+        self.oneway = oneway
+        self.name = None
+        self.args_type = None
+        self.result_type = None
+        self.argument_names = None
+
+    def _bind(self, service_name, name):
+        """Name the method and create the structs of its arguments and its
+        result"""
+        self.name = name
+        self.args_type = StructType('%s_%s_args' % (service_name, name), (Struct, ), dict(self.arguments))
+        self.argument_names = [arg for arg, _ in _sorted_fields(self.args_type)]
+        # The result holds the return value, as field 0, or one of the
+        # exceptions:
+        result_fields = {}
+        for key, field in self.exceptions.iteritems():
+            result_fields[key] = Field(field.type, field.tag, lambda: None, True)
+        if self.return_type is not None:
+            result_fields['success'] = Field(self.return_type, 0, lambda: None, True)
+        self.result_type = StructType('%s_%s_result' % (service_name, name), (Struct, ), result_fields)
+
+    def __repr__(self):
+        return 'Method(%r, %r, %r, %r)' % (self.return_type, self.arguments, self.exceptions, self.oneway)
+
 class ServiceType(type):
-    pass
+    """Metaclass for services"""
+    def __new__(mcs, name, bases, dictionary):
+        methods = {}
+        for base in bases:
+            if isinstance(base, ServiceType):
+                methods.update(base.methods())
+        for key, value in dictionary.items():
+            if isinstance(value, Method):
+                value._bind(name, key)
+                methods[key] = dictionary.pop(key)
+        cls = super(ServiceType, mcs).__new__(mcs, name, bases, dictionary)
+        cls.__methods = methods
+        return cls
+
+    def methods(self):
+        return self.__methods
 
 class Service(Type):
+    """Services (named collections of methods)"""
     __metaclass__ = ServiceType
 
+class ApplicationError(Exception):
+    """Failed calls (TApplicationException in other Thrift libraries)"""
+    UNKNOWN = 0
+    UNKNOWN_METHOD = 1
+    INVALID_MESSAGE_TYPE = 2
+    WRONG_METHOD_NAME = 3
+    BAD_SEQUENCE_ID = 4
+    MISSING_RESULT = 5
+    INTERNAL_ERROR = 6
+    PROTOCOL_ERROR = 7
+
+    message = Field(ByteStringType, 1, str, False)
+    type = Field(I32Type, 2, int, False)
+
+    def __str__(self):
+        return self.message
+
+class _AnyStruct(Struct):
+    """A struct without fields, for skipping the arguments of unknown
+    methods"""
+
+class Server(object):
+    """Serve a Service over TCP or Unix sockets
+
+    Connections are handled by a single asyncore event loop.  Calls are
+    decoded as soon as they arrive, so clients may pipeline them, and are
+    run by a pool of worker threads; each reply is written as soon as it's
+    ready and carries the seqid of its call.  With workers=0 calls run in
+    the event loop itself and are answered in order.
+
+    Arguments:
+    service -- the Service class
+    handler -- an object with a method for each method of the service,
+        called with the arguments in tag order
+    codec -- Codec, BinaryCodec() by default
+    framed -- bool, prefix each message with its length as a 4 byte
+        big-endian integer (Thrift's framed transport)
+    workers -- int, the number of threads to run calls in
+    """
+    def __init__(self, service, handler, codec=None, framed=True, workers=8):
+        self.service = service
+        self.handler = handler
+        self.codec = codec if codec is not None else BinaryCodec()
+        self.framed = framed
+        self.workers = workers
+        self._map = {}
+        self._calls = Queue.Queue()
+        self._replies = collections.deque()
+        self._closed = False
+        self._unix_paths = []
+        self._trigger = _Trigger(self._map, self._deliver)
+
+    def listen(self, address, backlog=128):
+        """Listen on a (host, port) address or a Unix socket path
+
+        Returns the address the server is bound to.
+        """
+        if isinstance(address, basestring):
+            family = socket.AF_UNIX
+            self._unix_paths.append(address)
+        elif ':' in address[0]:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        return _Listener(self, family, address, backlog).address
+
+    def serve_forever(self, timeout=30.0):
+        """Handle connections until close is called"""
+        threads = [threading.Thread(target=self._work) for i in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while not self._closed:
+                asyncore.loop(timeout, True, self._map, 1)
+        finally:
+            for thread in threads:
+                self._calls.put(None)
+            asyncore.close_all(self._map)
+            for path in self._unix_paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        """Stop serving; this may be called from any thread"""
+        self._closed = True
+        self._trigger.pull()
+
+    def _decode_call(self, buf, pos):
+        """Decode a call, returning the call and the offset just past it"""
+        codec = self.codec
+        (name, message_type, seqid), pos = codec.load_message_header(buf, pos)
+        method = self.service.methods().get(name)
+        args, pos = codec.load_from(_AnyStruct if method is None else method.args_type, buf, pos)
+        return (name, message_type, seqid, method, args), pos
+
+    def _dispatch(self, connection, call):
+        if self.workers:
+            self._calls.put((connection, call))
+        else:
+            reply = self._call(*call)
+            if reply is not None:
+                connection.out += reply
+
+    def _work(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                break
+            connection, call = item
+            reply = self._call(*call)
+            if reply is not None:
+                self._replies.append((connection, reply))
+                self._trigger.pull()
+
+    def _deliver(self):
+        """Queue the replies of the worker threads on their connections"""
+        replies = self._replies
+        while replies:
+            connection, reply = replies.popleft()
+            if connection.connected:
+                connection.out += reply
+
+    def _call(self, name, message_type, seqid, method, args):
+        """Run a call, returning the encoded reply or None for oneway calls"""
+        # Nothing is sent back for oneway calls, not even errors
+        oneway = message_type == MESSAGE_ONEWAY or (method is not None and method.oneway)
+        if method is None:
+            return self._error(oneway, name, seqid, ApplicationError.UNKNOWN_METHOD, "unknown method %r" % (name, ))
+        if message_type not in (MESSAGE_CALL, MESSAGE_ONEWAY):
+            return self._error(oneway, name, seqid, ApplicationError.INVALID_MESSAGE_TYPE, "invalid message type %d" % (message_type, ))
+        result = method.result_type()
+        try:
+            value = getattr(self.handler, name)(*[getattr(args, arg) for arg in method.argument_names])
+        except exceptions.Exception, error:
+            for key, field in method.exceptions.iteritems():
+                if isinstance(error, field.type):
+                    setattr(result, key, error)
+                    break
+            else:
+                return self._error(oneway, name, seqid, ApplicationError.INTERNAL_ERROR, "%s: %s" % (type(error).__name__, error))
+        else:
+            if method.return_type is not None:
+                result.success = value
+        if oneway:
+            return None
+        try:
+            return self._message(name, MESSAGE_REPLY, seqid, method.result_type, result)
+        except exceptions.Exception, error:
+            return self._error(oneway, name, seqid, ApplicationError.INTERNAL_ERROR, "can't encode the result: %s" % (error, ))
+
+    def _error(self, oneway, name, seqid, error_type, message):
+        """Encode an ApplicationError reply, or drop the error of a oneway
+        call"""
+        if oneway:
+            return None
+        error = ApplicationError(message=message, type=error_type)
+        return self._message(name, MESSAGE_EXCEPTION, seqid, ApplicationError, error)
+
+    def _message(self, name, message_type, seqid, thrift_type, object):
+        return _frame_message(self.codec, self.framed, name, message_type, seqid, thrift_type, object)
+
+def _frame_message(codec, framed, name, message_type, seqid, thrift_type, object):
+    """Encode a message, prefixed with its length if framed is True"""
+    if not framed:
+        return codec.dumps_message(name, message_type, seqid, thrift_type, object, bytearray())
+    out = bytearray(4)
+    codec.dumps_message(name, message_type, seqid, thrift_type, object, out)
+    _S_I.pack_into(out, 0, len(out) - 4)
+    return out
+
+def _split_messages(buf, framed, decode):
+    """Decode the complete messages at the start of buf with
+    decode(buf, offset), which returns the message and the offset after it
+
+    Returns the messages and the number of bytes they took.
+    """
+    messages = []
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        if framed:
+            if size - pos < 4:
+                break
+            length, = _S_I.unpack_from(buf, pos)
+            if size - pos - 4 < length:
+                break
+            message, end = decode(buffer(buf, pos + 4, length), 0)
+            if end != length:
+                raise Error("message of %d bytes has %d trailing bytes" % (length, length - end))
+            pos += 4 + length
+        else:
+            try:
+                message, pos = decode(buf, pos)
+            except TruncatedError:
+                break
+        messages.append(message)
+    return messages, pos
+
+class _Trigger(asyncore.file_dispatcher):
+    """Wakes an event loop from other threads"""
+    def __init__(self, map, callback):
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def pull(self):
+        with self._lock:
+            if self._write_fd is None:
+                return
+            try:
+                os.write(self._write_fd, 'x')
+            except OSError, error:
+                # A full pipe will wake the loop anyway
+                if error.errno != errno.EAGAIN:
+                    raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self._callback()
+
+    def close(self):
+        with self._lock:
+            asyncore.file_dispatcher.close(self)
+            if self._write_fd is not None:
+                os.close(self._write_fd)
+                self._write_fd = None
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, server, family, address, backlog):
+        asyncore.dispatcher.__init__(self, map=server._map)
+        self.server = server
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(backlog)
+        self.address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _ServerConnection(self.server, pair[0])
+
+    def writable(self):
+        return False
+
+class _ServerConnection(asyncore.dispatcher):
+    def __init__(self, server, sock):
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        asyncore.dispatcher.__init__(self, sock, server._map)
+        self.server = server
+        self.data = bytearray()
+        self.out = bytearray()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.data += data
+        server = self.server
+        try:
+            calls, used = _split_messages(buffer(self.data), server.framed, server._decode_call)
+        except Error:
+            # The stream can't be resynchronized after garbage
+            self.close()
+            return
+        del self.data[:used]
+        for call in calls:
+            server._dispatch(self, call)
+
+    def writable(self):
+        return bool(self.out)
+
+    def handle_write(self):
+        sent = self.send(self.out)
+        del self.out[:sent]
+
+    def handle_close(self):
+        self.close()
+
+class Call(object):
+    """The pending result of a call made with Client.call_async"""
+    def __init__(self, method):
+        self.method = method
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._value = None
+        self._error = None
+        self._callbacks = []
+        self._cancel = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result, raising the
+        exception it failed with, or TimeoutError after timeout seconds"""
+        if not self._event.wait(timeout):
+            if self._cancel is not None:
+                self._cancel()
+            raise TimeoutError("no reply to %s after %r seconds" % (self.method.name, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def add_done_callback(self, callback):
+        """Call callback(call) from the connection's thread once the call is
+        finished, or right away if it already is"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, message_type, result):
+        if message_type == MESSAGE_EXCEPTION:
+            self._fail(result)
+            return
+        for key in self.method.exceptions:
+            error = getattr(result, key)
+            if error is not None:
+                self._fail(error)
+                return
+        if self.method.return_type is not None:
+            if result.success is None:
+                self._fail(ApplicationError(message="%s returned no result" % (self.method.name, ), type=ApplicationError.MISSING_RESULT))
+                return
+            self._value = result.success
+        self._set()
+
+    def _fail(self, error):
+        self._error = error
+        self._set()
+
+    def _set(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class Client(object):
+    """Call the methods of a Service served at an address
+
+    Clients are thread safe.  Up to pool_size connections are kept open and
+    calls are spread over them; each connection carries any number of calls
+    at once, whose replies are matched up by seqid.  Methods can be called
+    as methods of the client:
+
+        client = Client(Calculator, ('localhost', 9090))
+        client.add(1, 2)
+
+    Arguments:
+    service -- the Service class
+    address -- (host, port) or a Unix socket path
+    codec -- Codec, BinaryCodec() by default
+    framed -- bool, as for Server
+    pool_size -- int, the most connections to open
+    timeout -- seconds to wait for each reply, or None to wait forever
+    """
+    def __init__(self, service, address, codec=None, framed=True, pool_size=2, timeout=None):
+        self.service = service
+        self.address = address
+        self.codec = codec if codec is not None else BinaryCodec()
+        self.framed = framed
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._connections = [None] * pool_size
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def call(self, name, *args, **kwargs):
+        """Call a method and wait for its result"""
+        call = self.call_async(name, *args, **kwargs)
+        if call is None:
+            return None
+        return call.result(self.timeout)
+
+    def call_async(self, name, *args, **kwargs):
+        """Send a call and return a Call, without waiting for the reply
+
+        Returns None for oneway methods, which aren't answered.
+        """
+        method = self.service.methods().get(name)
+        if method is None:
+            raise AttributeError("%s has no method %r" % (self.service.__name__, name))
+        if len(args) > len(method.argument_names):
+            raise TypeError("%s takes at most %d arguments" % (name, len(method.argument_names)))
+        for arg, value in zip(method.argument_names, args):
+            if arg in kwargs:
+                raise TypeError("got multiple values for argument %r" % (arg, ))
+            kwargs[arg] = value
+        arguments = method.args_type(**kwargs)
+        call = None if method.oneway else Call(method)
+        self._connection().send(method, arguments, call)
+        return call
+
+    def close(self):
+        """Close the connections; calls which are waiting fail"""
+        with self._lock:
+            connections, self._connections = self._connections, [None] * self.pool_size
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.service.methods():
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connection(self):
+        index = next(self._counter) % self.pool_size
+        with self._lock:
+            connection = self._connections[index]
+            if connection is None or connection.closed:
+                connection = self._connections[index] = _ClientConnection(self)
+        return connection
+
+class _ClientConnection(object):
+    def __init__(self, client):
+        self.client = client
+        if isinstance(client.address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(client.address)
+        else:
+            self.sock = socket.create_connection(client.address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self.pending = {}
+        self.seqid = 0
+        # Guards pending, seqid and writes to the socket:
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, method, arguments, call):
+        client = self.client
+        with self.lock:
+            if self.closed:
+                raise Error("connection closed")
+            self.seqid = seqid = (self.seqid + 1) & 0x7fffffff
+            message_type = MESSAGE_ONEWAY if method.oneway else MESSAGE_CALL
+            message = _frame_message(client.codec, client.framed, method.name, message_type, seqid, method.args_type, arguments)
+            if call is not None:
+                self.pending[seqid] = call
+                call._cancel = lambda: self._cancel(seqid)
+            try:
+                self.sock.sendall(message)
+            except socket.error:
+                self.pending.pop(seqid, None)
+                failed = self._close()
+            else:
+                return
+        _fail_calls(failed)
+        raise Error("connection closed")
+
+    def _cancel(self, seqid):
+        with self.lock:
+            self.pending.pop(seqid, None)
+
+    def _decode(self, buf, pos):
+        codec = self.client.codec
+        (name, message_type, seqid), pos = codec.load_message_header(buf, pos)
+        call = self.pending.get(seqid)
+        if message_type == MESSAGE_EXCEPTION:
+            result_type = ApplicationError
+        elif call is None:
+            # The call timed out
+            result_type = _AnyStruct
+        else:
+            result_type = call.method.result_type
+        result, pos = codec.load_from(result_type, buf, pos)
+        return (seqid, message_type, result), pos
+
+    def _read(self):
+        data = bytearray()
+        try:
+            while True:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+                replies, used = _split_messages(buffer(data), self.client.framed, self._decode)
+                del data[:used]
+                for seqid, message_type, result in replies:
+                    with self.lock:
+                        call = self.pending.pop(seqid, None)
+                    if call is not None:
+                        call._finish(message_type, result)
+        except (socket.error, Error):
+            pass
+        self.close()
+
+    def close(self):
+        with self.lock:
+            failed = self._close()
+        _fail_calls(failed)
+
+    def _close(self):
+        """Close the connection and return the calls waiting on it; the lock
+        must be held"""
+        if self.closed:
+            return []
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        pending, self.pending = self.pending, {}
+        return pending.values()
+
+def _fail_calls(calls):
+    for call in calls:
+        call._fail(Error("connection closed"))
+
 def _atom_type(atom_dict):
     atom_type = atom_dict.get("type")
     if atom_type is None:
@@ -644,18 +4043,38 @@ def _atom_type(atom_dict):
     atom_type = atom_type.lower()
     return atom_type
 
-def types_from_json(jsbuf):
-    type_config = json.loads(jsbuf)
-    return types_from_config(type_config)
+def types_from_json(jsbuf, compact=False, cache_dir=None, codecs=(), lazy=False):
+    """Get a mapping of types from a JSON type configuration
+
+    See types_from_config.  With a cache_dir, a cached schema is found by
+    hashing jsbuf itself, so it isn't parsed at all.
+    """
+    if cache_dir is None:
+        return types_from_config(json.loads(jsbuf), compact, codecs=codecs, lazy=lazy)
+    if lazy:
+        raise ValueError("lazy types can't be cached or precompiled")
+    if isinstance(jsbuf, unicode):
+        jsbuf = jsbuf.encode('utf-8')
+    return _cached_types(jsbuf, lambda: json.loads(jsbuf), compact, cache_dir, codecs)
 
 def _handle_enum(enum, the_atom, context):
     initial = 0 
 
-def types_from_config(type_config):
+def types_from_config(type_config, compact=False, cache_dir=None, codecs=(), lazy=False):
     """Get a mapping of types from a configuration mapping
 
     Arguments:
     type_config -- dict, a type name to type configuration.  
+    compact -- bool, build structs as CompactStruct classes.  Structs
+        configured with "frozen": true are always FrozenStruct classes.
+    cache_dir -- str, a directory to cache the built types in, keyed by a
+        hash of type_config.  Later calls with the same configuration load
+        the cached types instead of building them again.
+    codecs -- sequence of codecs to compile the encoders and decoders of
+        every struct for.  With a cache_dir these are cached too.
+    lazy -- bool, return a LazyTypes mapping which only builds each type
+        when it's first looked up.  Can't be combined with cache_dir or
+        codecs.
 
     For example, the type configuration for a simple calculator AST might look like the following:
     {
@@ -697,33 +4116,397 @@ def types_from_config(type_config):
         }
     }
     """
+    if lazy:
+        if cache_dir is not None or codecs:
+            raise ValueError("lazy types can't be cached or precompiled")
+        return LazyTypes(type_config, compact)
+    if cache_dir is None:
+        types = _build_types(type_config, compact)
+        for codec in codecs:
+            codec._precompile(types)
+        return types
+    return _cached_types(json.dumps(type_config, sort_keys=True), lambda: type_config, compact, cache_dir, codecs)
+
+def _build_types(type_config, compact):
     result = _default_types.copy()
 
     # Do a first pass so that recursive references work:
     for name, atom in type_config.iteritems():
-        if isinstance(name, unicode):
-            name = name.encode('utf-8')
-        result[name] = type(name, (_atom_type_to_type[_atom_type(atom)], ), {})
+        result[_utf8(name)] = _make_type(name, atom, compact)
 
     for name, atom in type_config.iteritems():
         atom_handler = _atom_type_to_handler[_atom_type(atom)]
-        atom_handler(result[name], atom, result)
+        atom_handler(result[_utf8(name)], atom, result)
     return result
 
+def _make_type(name, atom, compact):
+    """Create the (empty) class of a type configuration"""
+    name = _utf8(name)
+    base = _atom_type_to_type[_atom_type(atom)]
+    dictionary = {}
+    if atom.get("frozen") and base is Struct:
+        base = FrozenStruct
+    elif compact and base is Struct:
+        base = CompactStruct
+        dictionary['__slots__'] = tuple(_utf8(field_tup[0]) for field_tup in atom.get("fields", ()))
+    return type(name, (base, ), dictionary)
+
+class LazyTypes(collections.Mapping):
+    """A mapping of types like types_from_config's which builds each type
+    the first time it's looked up
+
+    Looking up a struct also builds the types of its fields, and theirs,
+    since a struct can't be encoded or decoded without them.  Recursive
+    references work as they do with types_from_config.
+    """
+    def __init__(self, type_config, compact=False):
+        self._config = dict((_utf8(name), atom) for name, atom in type_config.iteritems())
+        self._compact = compact
+        self._types = _default_types.copy()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        thrift_type = self._types.get(name)
+        if thrift_type is not None:
+            return thrift_type
+        with self._lock:
+            if name in self._types:
+                return self._types[name]
+            # Types are created before their fields are filled in, so
+            # populating one type only creates the types it refers to and
+            # queues them, rather than recursing.  Nothing is published
+            # until the whole set is populated.
+            created = _LazyScope(self)
+            thrift_type = created[name]
+            while created.pending:
+                a_name = created.pending.pop()
+                atom = self._config[a_name]
+                _atom_type_to_handler[_atom_type(atom)](created.types[a_name], atom, created)
+            self._types.update(created.types)
+            return thrift_type
+
+    def __contains__(self, name):
+        return name in self._types or name in self._config
+
+    def __iter__(self):
+        return itertools.chain(_default_types, (name for name in self._config if name not in _default_types))
+
+    def __len__(self):
+        return len(set(_default_types) | set(self._config))
+
+    def materialized(self):
+        """Get the names of the types built so far"""
+        return [name for name in self._types if name not in _default_types]
+
+class _LazyScope(object):
+    """The types LazyTypes is building for one lookup"""
+    def __init__(self, lazy_types):
+        self.lazy_types = lazy_types
+        self.types = {}
+        self.pending = []
+
+    def __getitem__(self, name):
+        thrift_type = self.lazy_types._types.get(name)
+        if thrift_type is None:
+            thrift_type = self.types.get(name)
+        if thrift_type is None:
+            atom = self.lazy_types._config[name]
+            thrift_type = self.types[name] = _make_type(name, atom, self.lazy_types._compact)
+            self.pending.append(name)
+        return thrift_type
+
+def _cached_types(text, load_config, compact, cache_dir, codecs):
+    """Get the types of a configuration from the cache, building and
+    caching them if they aren't there"""
+    key = hashlib.sha1('%s\0%d\0%s' % (_cache_salt(), compact, text)).hexdigest()
+    path = os.path.join(cache_dir, key)
+    code = _read_cache(path + '.types')
+    if code is not None:
+        namespace = {'_m': sys.modules[__name__], '__name__': __name__}
+        exec code in namespace
+        types = namespace['types']
+    else:
+        types = _build_types(load_config(), compact)
+        source = _types_source(types)
+        if source is not None:
+            _write_cache(path + '.types', compile(source, '<thriftit schema>', 'exec'))
+    for codec in codecs:
+        plans_path = '%s.%s.plans' % (path, codec._cache_key())
+        plans = _read_cache(plans_path)
+        if plans is None or not codec._restore_plans(types, plans):
+            codec._precompile(types, record=True)
+            plans = codec._saved_plans(types)
+            if plans is not None:
+                _write_cache(plans_path, plans)
+    return types
+
+_salt = []
+
+def _cache_salt():
+    """Something which changes whenever cached types or plans might, so
+    they're never read by a different version of this module or Python"""
+    if not _salt:
+        try:
+            with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb') as f:
+                source = f.read()
+        except IOError:
+            source = ''
+        _salt.append(hashlib.sha1(source + sys.version).hexdigest())
+    return _salt[0]
+
+def _read_cache(path):
+    """Load a marshalled cache file, or None if it's missing or corrupt"""
+    try:
+        with open(path, 'rb') as f:
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def _write_cache(path, value):
+    """Marshal value to a cache file.  Files appear whole, so concurrent
+    readers and writers are safe.  Failures are ignored; the value is
+    built again next time."""
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            return
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            marshal.dump(value, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError, ValueError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+
+_initial_names = dict((initial, initial.__name__) for initial in (bool, int, long, float, str, unicode, list, dict, set))
+
+def _literal(value):
+    """Whether repr(value) evaluates to an equal value"""
+    if value is None or type(value) in (bool, int, long, float, str, unicode):
+        return True
+    if type(value) in (list, tuple, set, frozenset):
+        return all(_literal(item) for item in value)
+    if type(value) is dict:
+        return all(_literal(k) and _literal(v) for k, v in value.iteritems())
+    return False
+
+def _types_source(types):
+    """Get Python source which builds a mapping like types, as returned by
+    types_from_config, into its variable types.  The source expects this
+    module as _m.  Returns None if some type or initial value can't be
+    written as source."""
+    rendered = _types_lines(types)
+    if rendered is None:
+        return None
+    return '\n'.join(rendered[0]) + '\n'
+
+def _types_lines(types):
+    """Get the lines of _types_source, and a dict of the name of the
+    variable holding each type, or None"""
+    lines = ['types = dict(_m._default_types)']
+    names = {}
+    for name, thrift_type in _default_types.iteritems():
+        names[thrift_type] = 'types[%r]' % (name, )
+    schema = sorted((name, thrift_type) for name, thrift_type in types.iteritems()
+                    if _default_types.get(name) is not thrift_type)
+    created = []
+    services = []
+    aliases = []
+    for name, thrift_type in schema:
+        if isinstance(thrift_type, ServiceType):
+            services.append((name, thrift_type))
+            continue
+        if thrift_type in names or thrift_type.__name__ != name.rpartition('.')[2]:
+            # Another name for a type, from a typedef or an include
+            aliases.append((name, thrift_type))
+            continue
+        base, = thrift_type.__bases__
+        if base not in (Struct, CompactStruct, FrozenStruct, Exception, Enum):
+            aliases.append((name, thrift_type))
+            continue
+        dictionary = {}
+        if '__slots__' in vars(thrift_type):
+            dictionary['__slots__'] = thrift_type.__slots__
+        if base is Enum:
+            for key, value in vars(thrift_type).iteritems():
+                if not key.startswith('_') and type(value) in (int, long):
+                    dictionary[key] = value
+        names[thrift_type] = variable = '_t%d' % (len(created), )
+        created.append(thrift_type)
+        lines.append('%s = types[%r] = type(%r, (_m.%s, ), %r)' % (variable, name, thrift_type.__name__, base.__name__, dictionary))
+
+    def type_expression(thrift_type):
+        if thrift_type in names:
+            return names[thrift_type]
+        base = thrift_type.__bases__[0]
+        if base not in (ListType, SetType, MapType):
+            return None
+        dictionary = []
+        for attribute in ('key_type', 'value_type'):
+            if attribute in vars(thrift_type):
+                expression = type_expression(getattr(thrift_type, attribute))
+                if expression is None:
+                    return None
+                dictionary.append('%r: %s' % (attribute, expression))
+        names[thrift_type] = variable = '_c%d' % (len(names), )
+        lines.append('%s = type(%r, (_m.%s, ), {%s})' % (variable, thrift_type.__name__, base.__name__, ', '.join(dictionary)))
+        return variable
+
+    def field_expression(field):
+        field_type = type_expression(field.type)
+        if field.initial in _initial_names:
+            initial = _initial_names[field.initial]
+        elif hasattr(field.initial, 'default') and _literal(field.initial.default):
+            initial = '_m.d(%r)' % (field.initial.default, )
+        else:
+            return None
+        if field_type is None:
+            return None
+        return '_m.Field(%s, %r, %s, %r, %r)' % (field_type, field.tag, initial, field.optional, field.intern)
+
+    def fields_expression(fields):
+        items = []
+        for field_name, field in sorted(fields.iteritems(), key=lambda item: item[1].tag):
+            expression = field_expression(field)
+            if expression is None:
+                return None
+            items.append('%r: %s' % (field_name, expression))
+        return '{%s}' % (', '.join(items), )
+
+    for thrift_type in created:
+        if thrift_type.type_id != T_STRUCT:
+            continue
+        for field_name, field in _sorted_fields(thrift_type):
+            expression = field_expression(field)
+            if expression is None:
+                return None
+            lines.append('%s.add_field(%r, %s)' % (names[thrift_type], field_name, expression))
+    for name, thrift_type in aliases:
+        expression = type_expression(thrift_type)
+        if expression is None:
+            return None
+        lines.append('types[%r] = %s' % (name, expression))
+
+    def service_expression(service):
+        if service in names:
+            return names[service]
+        base, = service.__bases__
+        if base is Service:
+            base_expression = '_m.Service'
+        else:
+            base_expression = service_expression(base)
+            if base_expression is None:
+                return None
+        methods = []
+        inherited = base.methods() if base is not Service else {}
+        for method_name, method in sorted(service.methods().iteritems()):
+            if inherited.get(method_name) is method:
+                continue
+            if method.return_type is None:
+                return_type = 'None'
+            else:
+                return_type = type_expression(method.return_type)
+            arguments = fields_expression(method.arguments)
+            exceptions = fields_expression(method.exceptions)
+            if None in (return_type, arguments, exceptions):
+                return None
+            methods.append('%r: _m.Method(%s, %s, %s, %r)' % (method_name, return_type, arguments, exceptions, method.oneway))
+        names[service] = variable = '_s%d' % (len(names), )
+        lines.append('%s = type(%r, (%s, ), {%s})' % (variable, service.__name__, base_expression, ', '.join(methods)))
+        return variable
+
+    for name, service in services:
+        expression = service_expression(service)
+        if expression is None:
+            return None
+        lines.append('types[%r] = %s' % (name, expression))
+    return lines, names
+
+
+def _schema_paths(types):
+    """Map the id of every type and initial value function reachable from
+    a mapping of types to a path which finds it again with _schema_object.
+    Also returns a mapping of the _make of every compact struct to its
+    path."""
+    paths = {}
+    makes = {}
+    structs = []
+
+    def visit(value, path):
+        if id(value) in paths:
+            return
+        paths[id(value)] = path
+        if not isinstance(value, type):
+            return
+        if issubclass(value, Struct):
+            structs.append((value, path))
+        elif isinstance(value, ServiceType):
+            for name, method in sorted(value.methods().iteritems()):
+                visit(method.args_type, ('args', path, name))
+                visit(method.result_type, ('result', path, name))
+        for attribute in ('key_type', 'value_type'):
+            if getattr(value, attribute, None) is not None:
+                visit(getattr(value, attribute), (attribute[:-5], path))
+
+    for name in sorted(types):
+        visit(types[name], ('type', name))
+    while structs:
+        thrift_type, path = structs.pop()
+        if thrift_type._compact:
+            makes[thrift_type._make] = ('make', path)
+        for field_name, field in thrift_type.fields().iteritems():
+            visit(field.initial, ('initial', path, field_name))
+            visit(field.type, ('field', path, field_name))
+    return paths, makes
+
+def _schema_object(types, path):
+    """Find the object at a path made by _schema_paths"""
+    kind = path[0]
+    if kind == 'type':
+        return types[path[1]]
+    value = _schema_object(types, path[1])
+    if kind == 'field':
+        return value.fields()[path[2]].type
+    elif kind == 'initial':
+        return value.fields()[path[2]].initial
+    elif kind == 'key':
+        return value.key_type
+    elif kind == 'value':
+        return value.value_type
+    elif kind == 'make':
+        return value._make
+    elif kind == 'args':
+        return value.methods()[path[2]].args_type
+    elif kind == 'result':
+        return value.methods()[path[2]].result_type
+    raise ValueError("unknown schema path %r" % (path, ))
+
+def _utf8(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name
+
 def _handle_struct(struct, atom, context):
     fields = atom.get("fields")
     if isinstance(fields, (tuple, list)):
         for idx, field_tup in enumerate(fields):
             if len(field_tup) > 2:
                 options = field_tup[2]
+            else:
+                options = {}
             type_name = field_tup[1]
-            field_name = field_tup[0]
+            field_name = _utf8(field_tup[0])
             if type_name == "list":
                 value_type_name = options["value"]
                 list_type_name = "ListOf%s" % (value_type_name.title(), )
                 if isinstance(list_type_name, unicode):
                     list_type_name = list_type_name.encode('utf-8')
-                field_type = type(list_type_name, (List, ), {'value_type': context[value_type_name]})
+                field_type = type(list_type_name, (ListType, ), {'value_type': context[value_type_name]})
             elif type_name == "set":
                 value_type_name = options["value"]
                 set_type_name = "SetOf%s" % (value_type_name.title(), )
@@ -738,20 +4521,46 @@ def _handle_struct(struct, atom, context):
                 key_type = context[key_type_name]
                 if isinstance(map_type_name, unicode):
                     map_type_name = map_type_name.encode('utf-8')
-                field_type = type(map_type_name, (Map, ), {'value_type': value_type, 'key_type': key_type})
+                field_type = type(map_type_name, (MapType, ), {'value_type': value_type, 'key_type': key_type})
             else: 
                 field_type = context[type_name]
-            options = {}
-            default = options.get("default")
-            tag = options.get("tag", idx)
+            if "default" in options:
+                initial = d(options["default"])
+            else:
+                initial = _initial_for(field_type)
+            tag = options.get("tag", idx + 1)
             optional = options.get("optional", False)
             optional = bool(optional)
-            struct.add_field(field_name, Field(field_type, tag, _bind(default), optional))
+            intern = bool(options.get("intern", False))
+            struct.add_field(field_name, Field(field_type, tag, initial, optional, intern))
     else:
         raise TypeError("unexpected field sequence")
 
 def d(x):
-    return lambda: x
+    """Make an initial value function returning x"""
+    initial = lambda: x
+    # So the types can be written out as source
+    initial.default = x
+    return initial
+
+_type_id_to_initial = {
+    T_BOOL   : bool,
+    T_BYTE   : int,
+    T_DOUBLE : float,
+    T_I16    : int,
+    T_I32    : int,
+    T_I64    : int,
+    T_STRING : str,
+    T_MAP    : dict,
+    T_SET    : set,
+    T_LIST   : list,
+}
+
+def _initial_for(field_type):
+    """Get the initial value of a field configured without a default"""
+    if _string_encoding(field_type):
+        return unicode
+    return _type_id_to_initial.get(field_type.type_id, d(None))
 
 class Enum(int, I32Type):
     pass 
@@ -779,3 +4588,711 @@ _default_types = {
     'double': DoubleType,
     'bool': BooleanType,
 }
+
+_idl_token_re = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>"[^"]*"|'[^']*')
+  | (?P<number>[+-]?(?:0[xX][0-9A-Fa-f]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?))
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<symbol>[{}()<>\[\]=,;:*])
+""", re.VERBOSE | re.DOTALL)
+
+_idl_containers = frozenset(['list', 'set', 'map'])
+
+class _IdlParser(object):
+    """Parse Thrift IDL into a list of definitions
+
+    Types are written as names, or ('list', type), ('set', type) or
+    ('map', key type, value type).  Constant values are ('literal', value),
+    ('name', name), ('list', values) or ('map', pairs).  Fields are
+    (tag, requiredness, type, name, default value or None, line).
+    Annotations are skipped.
+    """
+    def __init__(self, text, path=None):
+        self.path = path or '<idl>'
+        self.tokens = []
+        pos = 0
+        line = 1
+        while pos < len(text):
+            match = _idl_token_re.match(text, pos)
+            if match is None:
+                raise ParseError("%s:%d: unexpected %r" % (self.path, line, text[pos]))
+            if match.lastgroup != 'space':
+                self.tokens.append((match.lastgroup, match.group(), line))
+            line += match.group().count('\n')
+            pos = match.end()
+        self.tokens.append(('end', '', line))
+        self.pos = 0
+        self.includes = []
+        self.definitions = []
+
+    def error(self, message, line=None):
+        if line is None:
+            kind, text, line = self.tokens[self.pos]
+            if kind == 'end':
+                message = "unexpected end of file"
+        return ParseError("%s:%d: %s" % (self.path, line, message))
+
+    def peek(self):
+        return self.tokens[self.pos][1]
+
+    def next(self):
+        kind, text, line = self.tokens[self.pos]
+        if kind == 'end':
+            raise self.error("expected more")
+        self.pos += 1
+        return text
+
+    def accept(self, text):
+        if self.tokens[self.pos][1] == text and self.tokens[self.pos][0] != 'string':
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, text):
+        if not self.accept(text):
+            raise self.error("expected %r, found %r" % (text, self.peek()))
+
+    def name(self):
+        kind, text, line = self.tokens[self.pos]
+        if kind != 'name':
+            raise self.error("expected a name, found %r" % (text, ))
+        self.pos += 1
+        return text
+
+    def string(self):
+        kind, text, line = self.tokens[self.pos]
+        if kind != 'string':
+            raise self.error("expected a string, found %r" % (text, ))
+        self.pos += 1
+        return text[1:-1]
+
+    def separator(self):
+        self.accept(',') or self.accept(';')
+
+    def annotations(self):
+        if not self.accept('('):
+            return
+        depth = 1
+        while depth:
+            text = self.next()
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+
+    def parse(self):
+        while self.tokens[self.pos][0] != 'end':
+            line = self.tokens[self.pos][2]
+            keyword = self.name()
+            if keyword == 'include':
+                self.includes.append((self.string(), line))
+            elif keyword == 'cpp_include':
+                self.string()
+            elif keyword == 'namespace':
+                if not self.accept('*'):
+                    self.name()
+                self.name()
+                self.annotations()
+            elif keyword == 'const':
+                field_type = self.field_type()
+                name = self.name()
+                self.expect('=')
+                self.definitions.append(('const', name, line, field_type, self.value()))
+            elif keyword == 'typedef':
+                field_type = self.field_type()
+                self.definitions.append(('typedef', self.name(), line, field_type))
+                self.annotations()
+            elif keyword == 'enum':
+                self.definitions.append(('enum', self.name(), line, self.enum_values()))
+                self.annotations()
+            elif keyword in ('struct', 'union', 'exception'):
+                name = self.name()
+                self.accept('xsd_all')
+                self.definitions.append((keyword, name, line, self.fields('{', '}')))
+                self.annotations()
+            elif keyword == 'service':
+                name = self.name()
+                extends = self.name() if self.accept('extends') else None
+                self.definitions.append(('service', name, line, extends, self.functions()))
+                self.annotations()
+            else:
+                raise self.error("unexpected %r" % (keyword, ), line)
+            self.separator()
+        return self
+
+    def field_type(self):
+        name = self.name()
+        if name in _idl_containers:
+            if name == 'map' and self.accept('cpp_type'):
+                self.string()
+            self.expect('<')
+            types = [self.field_type()]
+            if name == 'map':
+                self.expect(',')
+                types.append(self.field_type())
+            self.expect('>')
+            if name != 'map' and self.accept('cpp_type'):
+                self.string()
+            result = (name, ) + tuple(types)
+        else:
+            result = name
+        self.annotations()
+        return result
+
+    def value(self):
+        kind, text, line = self.tokens[self.pos]
+        if kind == 'number':
+            self.pos += 1
+            if re.match(r'[+-]?0[xX]', text):
+                return ('literal', int(text, 16))
+            if re.search(r'[.eE]', text):
+                return ('literal', float(text))
+            return ('literal', int(text))
+        if kind == 'string':
+            return ('literal', self.string())
+        if kind == 'name':
+            return ('name', self.name())
+        if self.accept('['):
+            values = []
+            while not self.accept(']'):
+                values.append(self.value())
+                self.separator()
+            return ('list', values)
+        if self.accept('{'):
+            pairs = []
+            while not self.accept('}'):
+                key = self.value()
+                self.expect(':')
+                pairs.append((key, self.value()))
+                self.separator()
+            return ('map', pairs)
+        raise self.error("expected a value, found %r" % (text, ))
+
+    def enum_values(self):
+        values = []
+        self.expect('{')
+        while not self.accept('}'):
+            line = self.tokens[self.pos][2]
+            name = self.name()
+            value = None
+            if self.accept('='):
+                value = self.value()
+                if value[0] != 'literal' or type(value[1]) not in (int, long):
+                    raise self.error("expected an integer value for %s" % (name, ), line)
+                value = value[1]
+            values.append((name, value, line))
+            self.annotations()
+            self.separator()
+        return values
+
+    def fields(self, start, end):
+        fields = []
+        self.expect(start)
+        while not self.accept(end):
+            line = self.tokens[self.pos][2]
+            tag = None
+            if self.tokens[self.pos][0] == 'number':
+                tag = self.value()[1]
+                self.expect(':')
+            requiredness = None
+            if self.peek() in ('required', 'optional'):
+                requiredness = self.next()
+            field_type = self.field_type()
+            name = self.name()
+            default = None
+            if self.accept('='):
+                default = self.value()
+            self.annotations()
+            self.separator()
+            fields.append((tag, requiredness, field_type, name, default, line))
+        return fields
+
+    def functions(self):
+        functions = []
+        self.expect('{')
+        while not self.accept('}'):
+            line = self.tokens[self.pos][2]
+            oneway = self.accept('oneway')
+            if self.accept('void'):
+                return_type = None
+            else:
+                return_type = self.field_type()
+            name = self.name()
+            arguments = self.fields('(', ')')
+            exceptions = []
+            if self.accept('throws'):
+                exceptions = self.fields('(', ')')
+            self.annotations()
+            self.separator()
+            functions.append((name, line, oneway, return_type, arguments, exceptions))
+        return functions
+
+def _idl_name(field_type):
+    """Spell a parsed type as it's written in IDL"""
+    if isinstance(field_type, tuple):
+        return '%s<%s>' % (field_type[0], ','.join(_idl_name(t) for t in field_type[1:]))
+    return field_type
+
+class _IdlSchema(object):
+    """The types and constants of one IDL file and the files it includes"""
+    def __init__(self, text, compact, include_dirs, path=None, loading=()):
+        self.parser = _IdlParser(text, path).parse()
+        self.compact = compact
+        self.include_dirs = include_dirs
+        self.types = {}
+        self.constants = {}
+        self.includes = {}
+        self.containers = {}
+        self.typedefs = {}
+        self.pending_constants = {}
+        self.pending_defaults = {}
+        loading = loading + (os.path.abspath(path), ) if path else loading
+        directories = list(include_dirs)
+        if path:
+            directories.insert(0, os.path.dirname(path))
+        for include, line in self.parser.includes:
+            self.includes[os.path.splitext(os.path.basename(include))[0]] = self.include(include, line, directories, loading)
+        self.build()
+
+    def include(self, include, line, directories, loading):
+        for directory in directories or ['.']:
+            candidate = os.path.join(directory, include)
+            if os.path.exists(candidate):
+                break
+        else:
+            raise self.parser.error("can't find included %r" % (include, ), line)
+        if os.path.abspath(candidate) in loading:
+            raise self.parser.error("%r includes itself" % (include, ), line)
+        with open(candidate) as f:
+            text = f.read()
+        return _IdlSchema(text, self.compact, self.include_dirs, candidate, loading)
+
+    def define(self, name, value, line):
+        if name in self.types or name in self.constants or name in _default_types:
+            raise self.parser.error("%s is already defined" % (name, ), line)
+        self.types[name] = value
+
+    def build(self):
+        typedefs = {}
+        constants = {}
+        structs = []
+        services = []
+        for definition in self.parser.definitions:
+            kind, name, line = definition[:3]
+            if kind in ('struct', 'union', 'exception'):
+                fields = definition[3]
+                if kind == 'exception':
+                    base, dictionary = Exception, {}
+                elif self.compact:
+                    base, dictionary = CompactStruct, {'__slots__': tuple(field[3] for field in fields)}
+                else:
+                    base, dictionary = Struct, {}
+                self.define(name, type(name, (base, ), dictionary), line)
+                structs.append((kind, name, fields))
+            elif kind == 'enum':
+                values = {}
+                value = -1
+                for member, explicit, member_line in definition[3]:
+                    value = value + 1 if explicit is None else explicit
+                    if member in values:
+                        raise self.parser.error("%s.%s is already defined" % (name, member), member_line)
+                    values[member] = value
+                self.define(name, type(name, (Enum, ), values), line)
+            elif kind == 'typedef':
+                self.define(name, None, line)
+                typedefs[name] = definition
+            elif kind == 'const':
+                if name in self.types or name in constants:
+                    raise self.parser.error("%s is already defined" % (name, ), line)
+                constants[name] = definition
+            elif kind == 'service':
+                services.append(definition)
+        self.typedefs = typedefs
+        for name in typedefs:
+            self.resolve_typedef(name, ())
+        # Fields start with the initial values of their types, and defaults
+        # are filled in once every field exists, since constants of struct
+        # types need them
+        for kind, name, fields in structs:
+            thrift_type = self.types[name]
+            for tag, requiredness, field_type, field_name, default, line in fields:
+                if tag is None:
+                    raise self.parser.error("field %s.%s has no id" % (name, field_name), line)
+                field_type = self.lookup(field_type, line)
+                optional = requiredness == 'optional' or kind == 'union'
+                initial = d(None) if optional else _initial_for(field_type)
+                try:
+                    thrift_type.add_field(field_name, Field(field_type, tag, initial, optional))
+                except ValueError, e:
+                    raise self.parser.error('%s.%s: %s' % (name, field_name, e), line)
+                if default is not None:
+                    self.pending_defaults.setdefault(thrift_type, []).append((thrift_type.fields()[field_name], default, line))
+        self.pending_constants = constants
+        for name in list(constants):
+            self.resolve_constant(name, ())
+        for kind, name, fields in structs:
+            self.resolve_defaults(self.types[name], ())
+        for kind, name, line, extends, functions in services:
+            self.define(name, self.service(name, line, extends, functions), line)
+
+    def service(self, name, line, extends, functions):
+        base = Service
+        if extends is not None:
+            base = self.lookup(extends, line)
+            if not isinstance(base, ServiceType):
+                raise self.parser.error("%s isn't a service" % (extends, ), line)
+        methods = {}
+        for method_name, method_line, oneway, return_type, arguments, exceptions in functions:
+            if return_type is not None:
+                return_type = self.lookup(return_type, method_line)
+            method_arguments = {}
+            for tag, requiredness, field_type, field_name, default, field_line in arguments:
+                if tag is None:
+                    raise self.parser.error("argument %s of %s has no id" % (field_name, method_name), field_line)
+                field_type = self.lookup(field_type, field_line)
+                initial = _initial_for(field_type)
+                if default is not None:
+                    initial = d(self.value(default, field_type, field_line, ()))
+                method_arguments[field_name] = Field(field_type, tag, initial, False)
+            method_exceptions = {}
+            for tag, requiredness, field_type, field_name, default, field_line in exceptions:
+                if tag is None:
+                    raise self.parser.error("exception %s of %s has no id" % (field_name, method_name), field_line)
+                method_exceptions[field_name] = Field(self.lookup(field_type, field_line), tag, d(None), True)
+            methods[method_name] = Method(return_type, method_arguments, method_exceptions, oneway)
+        return ServiceType(name, (base, ), methods)
+
+    def resolve_typedef(self, name, resolving):
+        if self.types[name] is None:
+            if name in resolving:
+                raise self.parser.error("typedef %s refers to itself" % (name, ), self.typedefs[name][2])
+            definition = self.typedefs[name]
+            self.types[name] = self.lookup(definition[3], definition[2], resolving + (name, ))
+        return self.types[name]
+
+    def lookup(self, field_type, line, resolving=()):
+        """Get the type a parsed type refers to"""
+        if isinstance(field_type, tuple):
+            key = repr(field_type)
+            container = self.containers.get(key)
+            if container is None:
+                if field_type[0] == 'map':
+                    dictionary = {'key_type': self.lookup(field_type[1], line, resolving),
+                                  'value_type': self.lookup(field_type[2], line, resolving)}
+                    base = MapType
+                else:
+                    dictionary = {'value_type': self.lookup(field_type[1], line, resolving)}
+                    base = ListType if field_type[0] == 'list' else SetType
+                container = self.containers[key] = type(_idl_name(field_type), (base, ), dictionary)
+            return container
+        if field_type in _default_types:
+            return _default_types[field_type]
+        if field_type in self.types:
+            if field_type in self.typedefs:
+                return self.resolve_typedef(field_type, resolving)
+            return self.types[field_type]
+        prefix, _, rest = field_type.partition('.')
+        if rest and prefix in self.includes:
+            schema = self.includes[prefix]
+            if rest in schema.types:
+                return schema.types[rest]
+        raise self.parser.error("unknown type %s" % (field_type, ), line)
+
+    def resolve_defaults(self, thrift_type, resolving):
+        for field, default, line in self.pending_defaults.pop(thrift_type, ()):
+            field.initial = d(self.value(default, field.type, line, resolving))
+
+    def resolve_constant(self, name, resolving):
+        if name not in self.constants:
+            if name in resolving:
+                raise self.parser.error("constant %s refers to itself" % (name, ), self.pending_constants[name][2])
+            kind, name, line, field_type, value = self.pending_constants[name]
+            field_type = self.lookup(field_type, line)
+            self.constants[name] = self.value(value, field_type, line, resolving + (name, ))
+        return self.constants[name]
+
+    def named_value(self, name, line, resolving):
+        """Get the value of a constant or enum member"""
+        if name == 'true':
+            return True
+        if name == 'false':
+            return False
+        if name in self.pending_constants:
+            return self.resolve_constant(name, resolving)
+        prefix, _, rest = name.partition('.')
+        if rest and prefix in self.includes and rest in self.includes[prefix].constants:
+            return self.includes[prefix].constants[rest]
+        type_name, _, member = name.rpartition('.')
+        if type_name:
+            try:
+                enum = self.lookup(type_name, line)
+            except ParseError:
+                enum = None
+            if isinstance(enum, type) and issubclass(enum, Enum) and member in vars(enum):
+                return vars(enum)[member]
+        raise self.parser.error("unknown constant %s" % (name, ), line)
+
+    def value(self, value, field_type, line, resolving):
+        """Convert a parsed constant value to a value of field_type"""
+        kind, contents = value
+        if kind == 'name':
+            result = self.named_value(contents, line, resolving)
+        elif kind == 'literal':
+            result = contents
+        elif issubclass(field_type, MapType) and kind == 'map':
+            return dict((self.value(k, field_type.key_type, line, resolving), self.value(v, field_type.value_type, line, resolving))
+                        for k, v in contents)
+        elif issubclass(field_type, Struct) and kind == 'map':
+            values = {}
+            fields = field_type.fields()
+            self.resolve_defaults(field_type, resolving)
+            for k, v in contents:
+                if k[0] != 'literal' or k[1] not in fields:
+                    raise self.parser.error("%s has no field %s" % (field_type.__name__, k[1]), line)
+                values[k[1]] = self.value(v, fields[k[1]].type, line, resolving)
+            return field_type(**values)
+        elif issubclass(field_type, _SeqType) and kind == 'list':
+            items = [self.value(item, field_type.value_type, line, resolving) for item in contents]
+            return set(items) if issubclass(field_type, SetType) else items
+        else:
+            raise self.parser.error("a %s value can't be a %s" % (kind, field_type.__name__), line)
+        type_id = field_type.type_id
+        if type(result) in (int, long, bool) and type_id in (T_BOOL, T_BYTE, T_I16, T_I32, T_I64, T_DOUBLE):
+            if type_id == T_BOOL:
+                return bool(result)
+            if type_id == T_DOUBLE:
+                return float(result)
+            return int(result)
+        if type(result) is float and type_id == T_DOUBLE:
+            return result
+        if isinstance(result, str) and type_id == T_STRING:
+            if _string_encoding(field_type):
+                return result.decode('utf-8')
+            return result
+        if isinstance(result, (Struct, list, set, dict)) and kind == 'name':
+            # Another constant
+            return result
+        raise self.parser.error("%r isn't a %s value" % (result, field_type.__name__), line)
+
+    def all_types(self):
+        result = dict(self.types)
+        for prefix, schema in self.includes.iteritems():
+            for name, thrift_type in schema.all_types().iteritems():
+                result['%s.%s' % (prefix, name)] = thrift_type
+        return result
+
+    def all_constants(self):
+        result = dict(self.constants)
+        for prefix, schema in self.includes.iteritems():
+            for name, value in schema.all_constants().iteritems():
+                result['%s.%s' % (prefix, name)] = value
+        return result
+
+def parse_idl(text, compact=False, include_dirs=(), path=None):
+    """Get a mapping of types, like types_from_config's, and a dict of the
+    constants defined by Thrift IDL
+
+    Arguments:
+    text -- str, the IDL
+    compact -- bool, build structs and unions as CompactStruct classes
+    include_dirs -- directories to look for included files in, after the
+        directory of path
+    path -- str, the path of the file text came from, used to find included
+        files and in error messages
+
+    Types and constants of included files are named with the included
+    file's name as a prefix, as they're referred to in the IDL, for
+    example 'shared.SharedStruct'.  Fields without a requiredness are
+    always encoded, starting with the initial value of their type, as with
+    types_from_config; optional fields and the fields of unions start as
+    None and are left out then.  Namespaces and annotations are ignored.
+    Raises ParseError.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    schema = _IdlSchema(text, compact, include_dirs, path)
+    types = _default_types.copy()
+    types.update(schema.all_types())
+    return types, schema.all_constants()
+
+def types_from_idl(text, compact=False, include_dirs=(), path=None):
+    """Get a mapping of types from Thrift IDL; see parse_idl"""
+    return parse_idl(text, compact, include_dirs, path)[0]
+
+def _value_source(value, names):
+    """Get a Python expression for a constant value, or None"""
+    if _literal(value):
+        return repr(value)
+    if isinstance(value, Struct):
+        if type(value) not in names:
+            return None
+        items = []
+        for name, _ in _sorted_fields(type(value)):
+            expression = _value_source(getattr(value, name), names)
+            if expression is None:
+                return None
+            items.append('%s=%s' % (name, expression))
+        return '%s(%s)' % (names[type(value)], ', '.join(items))
+    if type(value) in (list, set):
+        items = [_value_source(item, names) for item in value]
+        if None in items:
+            return None
+        if type(value) is set:
+            return 'set([%s])' % (', '.join(items), )
+        return '[%s]' % (', '.join(items), )
+    if type(value) is dict:
+        items = [(_value_source(k, names), _value_source(v, names)) for k, v in value.iteritems()]
+        if any(None in item for item in items):
+            return None
+        return '{%s}' % (', '.join('%s: %s' % item for item in items), )
+    return None
+
+def _schema_source(path):
+    """Get a Python expression for an object at a path made by
+    _schema_paths, given the mapping of types as types and a codec as
+    codec"""
+    kind = path[0]
+    if kind == 'type':
+        return 'types[%r]' % (path[1], )
+    if kind == 'wire':
+        return 'codec._wire_format'
+    value = _schema_source(path[1])
+    if kind == 'field':
+        return '%s.fields()[%r].type' % (value, path[2])
+    elif kind == 'initial':
+        return '%s.fields()[%r].initial' % (value, path[2])
+    elif kind in ('key', 'value'):
+        return '%s.%s_type' % (value, kind)
+    elif kind == 'make':
+        return '%s._make' % (value, )
+    elif kind in ('args', 'result'):
+        return '%s.methods()[%r].%s_type' % (value, path[2], kind)
+    raise ValueError("unknown schema path %r" % (path, ))
+
+_module_names = frozenset(['types', 'constants'])
+
+def module_source(types, constants=None, codecs=None, origin=None):
+    """Get the source of a Python module defining a mapping of types, such
+    as parse_idl's or types_from_config's, with encoders and decoders
+    generated ahead of time
+
+    Importing the module builds the types as written out, without reading
+    any schema, and the codecs from the already generated encoders and
+    decoders of every struct, and of the arguments and results of every
+    service method, without generating or compiling any code.  It defines:
+
+    types -- the mapping of types
+    constants -- dict, constants
+    binary_codec, compact_codec -- the codecs, one per codec in codecs,
+        named after their class.  Defaults to a BinaryCodec and a
+        CompactCodec.
+    every type and constant whose name is a Python identifier
+
+    Compact structs get their positional constructor, __eq__ and __repr__
+    written out too.  Other encoders and decoders (for lazy or partial
+    decoding, say) are still generated when they're first used.  The
+    module imports this one.  Raises ValueError if a type, initial value
+    or constant can't be written as source.
+    """
+    constants = constants or {}
+    if codecs is None:
+        codecs = [BinaryCodec(), CompactCodec()]
+    rendered = _types_lines(types)
+    if rendered is None:
+        raise ValueError("types can't be written as source")
+    type_lines, names = rendered
+    lines = ['"""Generated by thriftit%s.  Don\'t edit."""' % (' from %s' % (origin, ) if origin else '', ),
+             '',
+             'import struct as _struct',
+             '',
+             'import thriftit as _m',
+             '']
+    lines.extend(type_lines)
+    public = set(_module_names)
+    for thrift_type, variable in sorted(names.iteritems(), key=lambda item: item[1]):
+        if not getattr(thrift_type, '_compact', False) or not variable.startswith('_t'):
+            continue
+        lines.append('')
+        lines.append('def %s_methods(_cls):' % (variable, ))
+        lines.extend('    ' + line for line in thrift_type._compact_source())
+        lines.append('    _cls._set_compact(locals())')
+        lines.append('%s_methods(%s)' % (variable, variable))
+    lines.append('')
+    lines.append('constants = {}')
+    for name, value in sorted(constants.iteritems()):
+        expression = _value_source(value, names)
+        if expression is None:
+            raise ValueError("constant %s can't be written as source" % (name, ))
+        lines.append('constants[%r] = %s' % (name, expression))
+
+    lines.append('')
+    for name in sorted(set(types) | set(constants)):
+        if name in _default_types or not _identifier_re.match(name) or name.startswith('_') \
+                or keyword.iskeyword(name) or name in public:
+            continue
+        public.add(name)
+        lines.append('%s = %s[%r]' % (name, 'types' if name in types else 'constants', name))
+
+    codec_names = []
+    for codec in codecs:
+        # A codec with the same options but no plans yet
+        codec = type(codec)(arrays=codec.arrays, intern=codec.intern, references=codec.references)
+        helpers = sorted(codec._namespace)
+        codec._precompile(types, record=True)
+        plans = codec._saved_plans(types)
+        if plans is None:
+            raise ValueError("the plans of %s can't be written as source" % (type(codec).__name__, ))
+        code, consts, structs, entries, counter = plans
+        name = '%s_codec' % (type(codec).__name__.replace('Codec', '').lower(), )
+        if name in codec_names:
+            name = '%s_%d' % (name, len(codec_names))
+        codec_names.append(name)
+        lines.append('')
+        lines.append('def _%s():' % (name, ))
+        lines.append('    codec = _m.%s(arrays=%r, intern=%r, references=%r)' % (
+            type(codec).__name__, codec.arrays, codec.intern, codec.references))
+        lines.append('    _ns = codec._namespace')
+        lines.extend('    %s = _ns[%r]' % (helper, helper) for helper in helpers)
+        lines.extend('    %s = %s' % (const, _schema_source(path)) for const, prefix, path in sorted(consts))
+        lines.extend('    %s = _struct.Struct(%r)' % (struct_name, '!' + struct_name[3:]) for struct_name in sorted(structs))
+        for chunk in codec._plan_source:
+            lines.extend('    ' + line for line in chunk.splitlines())
+        lines.append('    codec._adopt_plans([')
+        for path, kind, function in sorted(entries, key=lambda entry: entry[2]):
+            lines.append('        (%s, %r, %s),' % (_schema_source(path), kind, function))
+        lines.append('    ], %d)' % (counter, ))
+        lines.append('    return codec')
+        lines.append('')
+        lines.append('%s = _%s()' % (name, name))
+    return '\n'.join(lines) + '\n'
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] FILE.thrift',
+                                   description='Write a Python module for Thrift IDL; see module_source')
+    parser.add_option('-o', '--output', help='the module to write [standard output]')
+    parser.add_option('-I', '--include', action='append', default=[], metavar='DIR',
+                      help='look for included files in DIR too')
+    parser.add_option('--no-compact', action='store_false', dest='compact', default=True,
+                      help="don't make structs compact")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected one IDL file")
+    path, = args
+    with open(path) as f:
+        text = f.read()
+    try:
+        types, constants = parse_idl(text, options.compact, options.include, path)
+    except ParseError, e:
+        sys.stderr.write('%s\n' % (e, ))
+        return 1
+    source = module_source(types, constants, origin=os.path.basename(path))
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(source)
+    else:
+        sys.stdout.write(source)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())